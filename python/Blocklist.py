@@ -0,0 +1,244 @@
+import subprocess
+import ipaddress
+import threading
+import logging
+import math
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+class CommandExecutor:
+  """Runs firewall commands on the host"""
+
+  def run(self, args: list[str], input: str = None) -> bool:
+    try:
+      result = subprocess.run(args, input=input, capture_output=True, text=True, timeout=10)
+    except Exception as e:
+      _LOGGER.error(f"Error running {args[0]}: {e}")
+      return False
+    if result.returncode != 0:
+      _LOGGER.debug(f"{' '.join(args)} returned {result.returncode}: {result.stderr.strip()}")
+      return False
+    return True
+
+class DryRunExecutor(CommandExecutor):
+  """Records firewall commands instead of running them"""
+
+  def __init__(self) -> None:
+    self.commands: list[tuple[list[str], str]] = []
+
+  def run(self, args: list[str], input: str = None) -> bool:
+    self.commands.append((args, input))
+    _LOGGER.info(f"[dry-run] {' '.join(args)}{' <<< ' + repr(input) if input else ''}")
+    # Pretend rule checks failed so the setup path is exercised as well
+    return args[:2] != ["iptables", "-C"]
+
+class FirewallBlocklist:
+  """
+  Deduplicated set of blocked (destination, port, source) tuples.
+
+  Entries are collected in memory and written to a single ipset or nftables set
+  from a background thread, so blocking a destination never forks a shell on the
+  mitmproxy event loop and the FORWARD chain only ever holds one rule.
+
+  Every entry is written with its own timeout, so a changed timeout applies to
+  new entries right away and the set itself never has to be recreated.
+
+  The set only holds IPv4 addresses, anything else is refused by block(). If a
+  batch is rejected, its entries are written one by one, so a single bad entry
+  does not hold back the others. Entries that still fail are retried with the
+  next batch and dropped after max_attempts.
+  """
+
+  SET_NAME = "cn360-blocklist"
+  NFT_TABLE = "cn360"
+
+  def __init__(self, backend: str = "ipset", timeout: int = 3600, flush_interval: float = 1.0, retry_interval: float = 30.0,
+               max_attempts: int = 5, executor: CommandExecutor = None) -> None:
+    if backend not in ("ipset", "nftables", "dryrun"):
+      raise ValueError(f"Unknown blocklist backend: {backend}")
+
+    self.backend: str = backend
+    self.timeout: int = timeout
+    self.flush_interval: float = flush_interval
+    self.retry_interval: float = retry_interval
+    self.max_attempts: int = max_attempts
+    self.executor: CommandExecutor = executor or (DryRunExecutor() if backend == "dryrun" else CommandExecutor())
+
+    # Expiry per entry in time.monotonic(), inf for entries that never expire
+    self.entries: dict[tuple[str, int, str], float] = {}
+    self._pending: list[tuple[str, int, str]] = []
+    # Failed writes per pending entry
+    self._attempts: dict[tuple[str, int, str], int] = {}
+    self._lock = threading.Lock()
+    self._wakeup = threading.Event()
+    self._initialized: bool = False
+    self.running: bool = False
+
+  def start(self) -> None:
+    """Start the flush worker in a new thread"""
+    self.running = True
+    worker = threading.Thread(target=self._run)
+    worker.daemon = True
+    worker.start()
+    _LOGGER.info(f"Blocklist started with backend {self.backend}, timeout {self.timeout}s")
+
+  def stop(self) -> None:
+    self.running = False
+    self._wakeup.set()
+
+  def block(self, src_ip: str, dst_ip: str, dst_port: int) -> bool:
+    """Queue a destination for blocking. Returns False if it is already blocked or cannot be blocked."""
+    src, dst = self._ipv4(src_ip), self._ipv4(dst_ip)
+    if src is None or dst is None or not 0 < int(dst_port) < 65536:
+      _LOGGER.warning(f"Not blocking {dst_ip}:{dst_port} from {src_ip}, only IPv4 destinations can be blocked")
+      return False
+    key = (dst, int(dst_port), src)
+    now = time.monotonic()
+    with self._lock:
+      expires = self.entries.get(key)
+      if expires is not None and expires > now:
+        return False
+      self.entries[key] = now + self.timeout if self.timeout > 0 else math.inf
+      self._pending.append(key)
+    self._wakeup.set()
+    return True
+
+  @staticmethod
+  def _ipv4(address: str) -> str | None:
+    """The IPv4 address, also of an IPv4-mapped IPv6 address (::ffff:a.b.c.d) as mitmproxy reports them, None otherwise"""
+    try:
+      ip = ipaddress.ip_address(address)
+    except ValueError:
+      return None
+    if ip.version == 6:
+      ip = ip.ipv4_mapped
+    return str(ip) if ip is not None else None
+
+  def is_blocked(self, src_ip: str, dst_ip: str, dst_port: int) -> bool:
+    src, dst = self._ipv4(src_ip), self._ipv4(dst_ip)
+    expires = self.entries.get((dst, int(dst_port), src))
+    return expires is not None and expires > time.monotonic()
+
+  def flush(self) -> int:
+    """Write all pending entries to the firewall in one batch"""
+    with self._lock:
+      self._expire()
+      # Entries that expired before they were written are not worth adding anymore
+      pending = [(key, self.entries[key]) for key in self._pending if key in self.entries]
+      self._pending = []
+
+    if not pending:
+      return 0
+
+    if not self._initialized:
+      self._initialized = self._setup()
+      if not self._initialized:
+        _LOGGER.error(f"Failed to set up firewall blocklist, retrying in {self.retry_interval}s")
+        self._requeue([key for key, _ in pending])
+        return 0
+
+    failed = [] if self._write(pending) else pending
+    if failed and len(pending) > 1:
+      # Find the entries the firewall rejects, the others must not wait for them
+      failed = [entry for entry in pending if not self._write([entry])]
+    failed_keys = [key for key, _ in failed]
+    with self._lock:
+      for key, _ in pending:
+        if key not in failed_keys:
+          self._attempts.pop(key, None)
+    if failed_keys:
+      self._retry_later(failed_keys)
+    written = len(pending) - len(failed)
+    if written:
+      _LOGGER.info(f"Added {written} entries to firewall blocklist")
+    return written
+
+  def _write(self, entries: list[tuple[tuple[str, int, str], float]]) -> bool:
+    if self.backend == "nftables":
+      return self._flush_nftables(entries)
+    return self._flush_ipset(entries)
+
+  def _retry_later(self, keys: list[tuple[str, int, str]]) -> None:
+    retry = []
+    with self._lock:
+      for key in keys:
+        attempts = self._attempts.get(key, 0) + 1
+        if attempts < self.max_attempts:
+          self._attempts[key] = attempts
+          retry.append(key)
+          continue
+        # Blocking it again later starts over
+        self._attempts.pop(key, None)
+        self.entries.pop(key, None)
+        _LOGGER.error(f"Giving up adding {key[0]}:{key[1]} from {key[2]} to firewall blocklist after {attempts} attempts")
+    if retry:
+      _LOGGER.error(f"Failed to add {len(retry)} entries to firewall blocklist, retrying in {self.retry_interval}s")
+      self._requeue(retry)
+
+  def _requeue(self, keys: list[tuple[str, int, str]]) -> None:
+    with self._lock:
+      self._pending = keys + self._pending
+
+  @staticmethod
+  def _remaining(expires: float, now: float) -> int:
+    """Seconds the firewall should keep an entry, 0 for never expiring ones"""
+    return 0 if expires == math.inf else max(math.ceil(expires - now), 1)
+
+  def _run(self) -> None:
+    while self.running:
+      # Failed batches are retried on a timer, not only when the next entry is blocked
+      self._wakeup.wait(self.retry_interval if self._pending else None)
+      self._wakeup.clear()
+      try:
+        self.flush()
+      except Exception as e:
+        _LOGGER.exception("Error flushing blocklist", exc_info=e)
+      # Coalesce bursts of connection attempts into a single update
+      time.sleep(self.flush_interval)
+
+  def _expire(self) -> None:
+    now = time.monotonic()
+    expired = [key for key, expires in self.entries.items() if expires <= now]
+    for key in expired:
+      del self.entries[key]
+    if expired:
+      _LOGGER.debug(f"Expired {len(expired)} blocklist entries")
+
+  def _setup(self) -> bool:
+    if self.backend == "nftables":
+      script = (
+        f"add table inet {self.NFT_TABLE}\n"
+        f"add set inet {self.NFT_TABLE} blocklist {{ type ipv4_addr . inet_service . ipv4_addr; flags timeout; }}\n"
+        f"add chain inet {self.NFT_TABLE} forward {{ type filter hook forward priority 0; policy accept; }}\n"
+        f"flush chain inet {self.NFT_TABLE} forward\n"
+        f"add rule inet {self.NFT_TABLE} forward ip daddr . tcp dport . ip saddr @blocklist reject with tcp reset\n"
+      )
+      return self.executor.run(["nft", "-f", "-"], input=script)
+
+    # timeout 0 enables per entry timeouts with entries kept forever by default
+    create = ["ipset", "create", self.SET_NAME, "hash:ip,port,ip", "timeout", "0", "-exist"]
+    if not self.executor.run(create):
+      # Sets created by older versions had the timeout as default, entry timeouts still override it
+      if not self.executor.run(["ipset", "list", "-n", self.SET_NAME]):
+        return False
+      _LOGGER.warning(f"Using existing ipset {self.SET_NAME} with different settings")
+
+    rule = ["FORWARD", "-p", "tcp", "-m", "set", "--match-set", self.SET_NAME, "dst,dst,src", "-j", "REJECT"]
+    if not self.executor.run(["iptables", "-C"] + rule):
+      return self.executor.run(["iptables", "-I"] + rule)
+    return True
+
+  def _flush_ipset(self, entries: list[tuple[tuple[str, int, str], float]]) -> bool:
+    now = time.monotonic()
+    lines = [f"add {self.SET_NAME} {dst},tcp:{port},{src} timeout {self._remaining(expires, now)}" for (dst, port, src), expires in entries]
+    return self.executor.run(["ipset", "restore", "-exist"], input="\n".join(lines) + "\n")
+
+  def _flush_nftables(self, entries: list[tuple[tuple[str, int, str], float]]) -> bool:
+    now = time.monotonic()
+    elements = []
+    for (dst, port, src), expires in entries:
+      timeout = self._remaining(expires, now)
+      elements.append(f"{dst} . {port} . {src}" + (f" timeout {timeout}s" if timeout else ""))
+    script = f"add element inet {self.NFT_TABLE} blocklist {{ {', '.join(elements)} }}\n"
+    return self.executor.run(["nft", "-f", "-"], input=script)
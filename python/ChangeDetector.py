@@ -0,0 +1,58 @@
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+class ChangeDetector:
+  """
+  Drops keys of an update that did not change compared to the cached value.
+
+  Every keyframe_interval seconds an update is passed through unchanged, so
+  clients that missed something catch up without reconnecting.
+  """
+
+  def __init__(self, enabled: bool = True, keyframe_interval: float = 60.0) -> None:
+    self.enabled: bool = enabled
+    self.keyframe_interval: float = keyframe_interval
+    self.last_keyframe: float = time.monotonic()
+
+    self.events_emitted: int = 0
+    self.events_suppressed: int = 0
+    self.keys_emitted: int = 0
+    self.keys_suppressed: int = 0
+    self.keyframes: int = 0
+
+  def changes(self, cache: dict, update: dict) -> dict:
+    """Return the part of update that differs from cache, an empty dict if nothing changed"""
+    if not self.enabled:
+      self.events_emitted += 1
+      self.keys_emitted += len(update)
+      return update
+
+    now = time.monotonic()
+    if self.keyframe_interval > 0 and now - self.last_keyframe >= self.keyframe_interval:
+      self.last_keyframe = now
+      self.keyframes += 1
+      self.events_emitted += 1
+      self.keys_emitted += len(update)
+      return update
+
+    missing = object()
+    changed = {key: value for key, value in update.items() if cache.get(key, missing) != value}
+    self.keys_emitted += len(changed)
+    self.keys_suppressed += len(update) - len(changed)
+    if changed:
+      self.events_emitted += 1
+    else:
+      self.events_suppressed += 1
+      _LOGGER.debug(f"Suppressed unchanged update with keys {list(update.keys())}")
+    return changed
+
+  def stats(self) -> dict:
+    return {
+      "events_emitted": self.events_emitted,
+      "events_suppressed": self.events_suppressed,
+      "keys_emitted": self.keys_emitted,
+      "keys_suppressed": self.keys_suppressed,
+      "keyframes": self.keyframes,
+    }
@@ -0,0 +1,291 @@
+from DataCache import CachePolicy
+import threading
+import logging
+import signal
+import json
+import time
+import sys
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+_LOG_LEVELS = ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG")
+
+# LOG_LEVEL_<suffix> -> logger name
+_LOGGER_NAMES = {
+  "BLOCKLIST": "Blocklist",
+  "CACHE": "DataCache",
+  "CHANGES": "ChangeDetector",
+  "CONFIG": "Config",
+  "CRYPTO": "CryptoHelper",
+  "ECHO": "EchoServer",
+  "HEALTH": "Health",
+  "HTTP": "HttpHandler",
+  "HTTPSERVER": "HttpServer",
+  "MITM": "CN360_mitm",
+  "PACKET": "PacketParser",
+  "SHAREDRING": "SharedRing",
+  "TELEMETRY": "Telemetry",
+  "UPDATES": "UpdateMirror",
+  "ROBOTSOCKETSERVER": "RobotSocketServer",
+  "LOCALCONTROLSOCKETSERVER": "LocalControlSocketServer",
+  "LOCALCONTROLUNIXSOCKETSERVER": "LocalControlUnixSocketServer",
+  "LOCALCONTROLWEBSOCKETSERVER": "LocalControlWebSocketServer",
+  "CLOUDSOCKET": "CloudSocket",
+}
+
+def _parse_bool(value: str) -> bool:
+  if value.lower() in ("true", "1", "yes", "on"):
+    return True
+  if value.lower() in ("false", "0", "no", "off"):
+    return False
+  raise ValueError(f"expected true or false, got {value!r}")
+
+def _parse_count(value: str) -> int:
+  number = int(value)
+  if number < 0:
+    raise ValueError(f"must not be negative, got {number}")
+  return number
+
+def _parse_seconds(value: str) -> float:
+  number = float(value)
+  if number < 0:
+    raise ValueError(f"must not be negative, got {number}")
+  return number
+
+def _parse_backend(value: str) -> str:
+  if value.lower() not in ("ipset", "nftables", "dryrun"):
+    raise ValueError(f"expected ipset, nftables or dryrun, got {value!r}")
+  return value.lower()
+
+def _parse_list(value: str) -> list[str]:
+  return [item.strip() for item in value.split(",") if item.strip()]
+
+def _parse_command(value: str) -> dict:
+  try:
+    command = json.loads(value)
+  except json.JSONDecodeError as e:
+    raise ValueError(f"invalid JSON: {e}")
+  if not isinstance(command, dict):
+    raise ValueError(f"expected a JSON object, got {value!r}")
+  return command
+
+def _parse_policies(value: str) -> str:
+  CachePolicy.parse(value)
+  return value
+
+# attribute, environment variable, parser, default, reloadable
+_FIELDS = [
+  ("local_proxy_ip", "LOCAL_PROXY_IP", str, "192.168.0.254", False),
+  ("robot_host", "LOCAL_PROXY_IP", str, "0.0.0.0", False),
+  ("robot_port", "ROBOT_PORT", _parse_count, "80", False),
+  ("robot_fast_forward", "ROBOT_FAST_FORWARD", _parse_bool, "false", False),
+
+  ("http_host", "HTTP_HOST", str, "0.0.0.0", False),
+  ("http_port", "HTTP_PORT", _parse_count, "0", False),
+
+  ("local_control_host", "LOCAL_CONTROL_HOST", str, "0.0.0.0", False),
+  ("local_control_port", "LOCAL_CONTROL_PORT", _parse_count, "4468", False),
+  ("local_control_compress_threshold", "LOCAL_CONTROL_COMPRESS_THRESHOLD", _parse_count, "1024", True),
+  ("local_control_socket", "LOCAL_CONTROL_SOCKET", str, "", False),
+  ("local_control_shm", "LOCAL_CONTROL_SHM", str, "", False),
+  ("local_control_shm_threshold", "LOCAL_CONTROL_SHM_THRESHOLD", _parse_count, "16384", True),
+  ("local_control_shm_slot_size", "LOCAL_CONTROL_SHM_SLOT_SIZE", _parse_count, str(1024 * 1024), False),
+  ("local_control_ws_port", "LOCAL_CONTROL_WS_PORT", _parse_count, "0", False),
+  ("local_control_ws_origins", "LOCAL_CONTROL_WS_ORIGINS", _parse_list, "", True),
+  ("local_control_ws_compress_threshold", "LOCAL_CONTROL_WS_COMPRESS_THRESHOLD", _parse_count, "1024", True),
+
+  ("block_update", "BLOCK_UPDATE", _parse_bool, "true", True),
+  ("update_mirror", "UPDATE_MIRROR", _parse_bool, "false", True),
+  ("update_path", "UPDATE_PATH", str, "", False),
+  ("update_versions", "UPDATE_VERSIONS", _parse_list, "", True),
+  ("blocklist_backend", "BLOCKLIST_BACKEND", _parse_backend, "ipset", False),
+  ("blocklist_timeout", "BLOCKLIST_TIMEOUT", _parse_count, "3600", True),
+
+  ("change_detection", "CHANGE_DETECTION", _parse_bool, "true", True),
+  ("change_keyframe_interval", "CHANGE_KEYFRAME_INTERVAL", _parse_seconds, "60", True),
+
+  ("cache_max_bytes", "CACHE_MAX_BYTES", _parse_count, str(8 * 1024 * 1024), True),
+  ("cache_max_keys", "CACHE_MAX_KEYS", _parse_count, "512", True),
+  ("cache_max_key_bytes", "CACHE_MAX_KEY_BYTES", _parse_count, str(4 * 1024 * 1024), True),
+  ("cache_policies", "CACHE_POLICIES", _parse_policies, "", True),
+
+  ("cache_static", "CACHE_STATIC", _parse_bool, "true", True),
+  ("data_path", "DATA_PATH", str, os.path.join(os.path.dirname(__file__), "data"), False),
+  ("telemetry_file", "TELEMETRY_FILE", str, "", False),
+  ("telemetry_capacity", "TELEMETRY_CAPACITY", _parse_count, "10000", False),
+  ("telemetry_flush_interval", "TELEMETRY_FLUSH_INTERVAL", _parse_seconds, "60", True),
+
+  ("map_intv", "MAP_INTV", _parse_count, "1", True),
+  ("path_intv", "PATH_INTV", _parse_count, "1", True),
+  ("status_intv", "STATUS_INTV", _parse_count, "1", True),
+
+  ("health_interval", "HEALTH_INTERVAL", _parse_seconds, "10", False),
+  ("health_stale_after", "HEALTH_STALE_AFTER", _parse_seconds, "300", True),
+  ("health_stuck_after", "HEALTH_STUCK_AFTER", _parse_seconds, "30", True),
+  ("health_probe_interval", "HEALTH_PROBE_INTERVAL", _parse_seconds, "0", True),
+  ("health_probe_timeout", "HEALTH_PROBE_TIMEOUT", _parse_seconds, "15", True),
+  ("health_probe_command", "HEALTH_PROBE_COMMAND", _parse_command, '{"infoType": "30000", "data": {}}', True),
+  ("health_reconnect", "HEALTH_RECONNECT", _parse_bool, "true", True),
+  ("health_file", "HEALTH_FILE", str, "", False),
+
+  ("log_path", "LOG_PATH", str, "/root/logs", False),
+]
+
+class ProxyConfig:
+  """
+  Settings of the proxy, read once from the environment and validated.
+
+  If CONFIG_FILE points to a file with KEY=VALUE lines, its values override the
+  environment. The file is read again on SIGHUP or when it changes. Only
+  settings marked as reloadable are applied at runtime, the others need a restart.
+  """
+
+  def __init__(self, values: dict, log_levels: dict[str, str], config_file: str = None) -> None:
+    for name, value in values.items():
+      setattr(self, name, value)
+    if not self.telemetry_file:
+      self.telemetry_file = os.path.join(self.data_path, "telemetry.bin")
+    if not self.update_path:
+      self.update_path = os.path.join(self.data_path, "updates")
+    if not self.health_file:
+      self.health_file = os.path.join(self.data_path, "health.json")
+    self.log_levels: dict[str, str] = log_levels
+    self.config_file: str = config_file
+    self.reload_listeners = []
+    self._config_mtime: float = None
+    self._watching: bool = False
+
+  @classmethod
+  def load(cls, environ: dict = None) -> "ProxyConfig":
+    """Read and validate all settings, raises ValueError listing every invalid one"""
+    values, log_levels, config_file = cls._read(os.environ if environ is None else environ)
+    config = cls(values, log_levels, config_file)
+    if config_file:
+      config._config_mtime = config._file_mtime()
+    return config
+
+  @classmethod
+  def load_or_exit(cls, environ: dict = None) -> "ProxyConfig":
+    """Like load, but print the errors and exit the process if a setting is invalid"""
+    try:
+      return cls.load(environ)
+    except ValueError as e:
+      sys.stderr.write(f"{e}\n")
+      sys.stderr.flush()
+      # mitmproxy only logs errors of its scripts and would keep running without the proxy, so don't unwind through it
+      os._exit(2)
+
+  @staticmethod
+  def _read_file(path: str) -> dict[str, str]:
+    settings = {}
+    with open(path, "r") as f:
+      for line in f:
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+          continue
+        key, value = line.split("=", 1)
+        settings[key.strip()] = value.strip().strip('"').strip("'")
+    return settings
+
+  @classmethod
+  def _read(cls, environ: dict) -> tuple[dict, dict, str]:
+    source = dict(environ)
+    config_file = source.get("CONFIG_FILE") or None
+    if config_file and os.path.isfile(config_file):
+      source.update(cls._read_file(config_file))
+
+    values = {}
+    errors = []
+    for name, env, parser, default, _ in _FIELDS:
+      raw = source.get(env, default)
+      try:
+        values[name] = parser(raw)
+      except ValueError as e:
+        errors.append(f"{env}: {e}")
+
+    log_levels = {}
+    for key, value in source.items():
+      if key.startswith("LOG_LEVEL_"):
+        if value.upper() not in _LOG_LEVELS:
+          errors.append(f"{key}: expected one of {', '.join(_LOG_LEVELS)}, got {value!r}")
+        else:
+          log_levels[key[len("LOG_LEVEL_"):]] = value.upper()
+
+    if errors:
+      raise ValueError("Invalid configuration:\n  " + "\n  ".join(errors))
+    return values, log_levels, config_file
+
+  def log_level(self, name: str) -> str:
+    return self.log_levels.get(name.upper(), "INFO")
+
+  def apply_log_levels(self) -> None:
+    """Set the level of all known loggers"""
+    for suffix, logger_name in _LOGGER_NAMES.items():
+      logging.getLogger(logger_name).setLevel(self.log_level(suffix))
+
+  def add_reload_listener(self, listener) -> None:
+    """listener(config) is called after settings have been reloaded"""
+    self.reload_listeners.append(listener)
+
+  def reload(self) -> bool:
+    """Read settings again and apply the reloadable ones"""
+    try:
+      values, log_levels, _ = self._read(os.environ)
+    except Exception as e:
+      _LOGGER.error(f"Not reloading configuration: {e}")
+      return False
+
+    changed = []
+    for name, env, _, _, reloadable in _FIELDS:
+      if name in ("telemetry_file", "update_path", "health_file") and not values[name]:
+        continue
+      if getattr(self, name) == values[name]:
+        continue
+      if not reloadable:
+        _LOGGER.warning(f"{env} changed, restart the proxy to apply it")
+        continue
+      setattr(self, name, values[name])
+      changed.append(env)
+    if log_levels != self.log_levels:
+      self.log_levels = log_levels
+      changed.append("LOG_LEVEL_*")
+    self.apply_log_levels()
+
+    _LOGGER.info(f"Configuration reloaded, changed: {', '.join(changed) if changed else 'nothing'}")
+    for listener in self.reload_listeners:
+      try:
+        listener(self)
+      except Exception as e:
+        _LOGGER.exception("Error in config reload listener", exc_info=e)
+    return True
+
+  def _file_mtime(self) -> float | None:
+    try:
+      return os.path.getmtime(self.config_file)
+    except OSError:
+      return None
+
+  def watch(self, interval: float = 5.0) -> None:
+    """Reload on SIGHUP and, if a config file is used, when it changes"""
+    try:
+      signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self.reload, daemon=True).start())
+      _LOGGER.info("Reloading configuration on SIGHUP")
+    except (ValueError, AttributeError, OSError) as e:
+      # Only possible from the main thread and not on every platform
+      _LOGGER.warning(f"Cannot install SIGHUP handler: {e}")
+
+    if self.config_file and not self._watching:
+      self._watching = True
+      watcher = threading.Thread(target=self._watch_file, args=(interval,))
+      watcher.daemon = True
+      watcher.start()
+      _LOGGER.info(f"Watching {self.config_file} for changes")
+
+  def _watch_file(self, interval: float) -> None:
+    while self._watching:
+      time.sleep(interval)
+      mtime = self._file_mtime()
+      if mtime != self._config_mtime:
+        self._config_mtime = mtime
+        self.reload()
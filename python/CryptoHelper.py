@@ -3,11 +3,9 @@ from Crypto.Util.Padding import pad, unpad
 from Crypto.Cipher import AES
 import json
 import logging
-import os
 
 # Get logger for this module
 _LOGGER = logging.getLogger(__name__)
-_LOGGER.setLevel(os.environ.get('LOG_LEVEL_CRYPTO', 'INFO').upper())
 
 def decrypt_data(key: str, data_str: str) -> dict:
   if not data_str:
@@ -29,6 +27,13 @@ def decrypt_data(key: str, data_str: str) -> dict:
   return None
 
 def encrypt_data(key: str, data: dict) -> str:
+  encrypted = encrypt_data_raw(key, data)
+  if encrypted is None:
+    return None
+  return encrypted.decode("utf-8")
+
+def encrypt_data_raw(key: str, data: dict) -> bytes:
+  """Same as encrypt_data, but returns the base64 ascii bytes without decoding them"""
   if not data:
     _LOGGER.warning("No data to encrypt")
     return None
@@ -38,9 +43,9 @@ def encrypt_data(key: str, data: dict) -> str:
     json_data = json.dumps(data).encode("utf-8")
     padded_data = pad(json_data, AES.block_size)
     encrypted_data = cipher.encrypt(padded_data)
-    encrypted_str = base64.b64encode(encrypted_data).decode("utf-8")
-    _LOGGER.debug(f"Encrypted data: {encrypted_str}")
-    return encrypted_str
+    encrypted_raw = base64.b64encode(encrypted_data)
+    _LOGGER.debug(f"Encrypted data: {encrypted_raw}")
+    return encrypted_raw
   except Exception as err:
     _LOGGER.exception(f"Encryption error", err)
       
@@ -0,0 +1,208 @@
+from fnmatch import fnmatchcase
+import threading
+import logging
+import json
+import time
+import sys
+
+_LOGGER = logging.getLogger(__name__)
+
+class CachePolicy:
+  """Retention for cache keys matching a glob pattern. 0 means no limit."""
+
+  def __init__(self, pattern: str, ttl: float = 0, max_bytes: int = 0) -> None:
+    self.pattern: str = pattern
+    self.ttl: float = ttl
+    self.max_bytes: int = max_bytes
+
+  @classmethod
+  def parse(cls, config: str) -> list["CachePolicy"]:
+    """Parse "pattern:ttl=300,max=65536;other*:ttl=60" into policies"""
+    policies = []
+    for entry in filter(None, (part.strip() for part in config.split(";"))):
+      pattern, _, options = entry.partition(":")
+      policy = cls(pattern.strip())
+      for option in filter(None, (part.strip() for part in options.split(","))):
+        name, _, value = option.partition("=")
+        if name == "ttl":
+          policy.ttl = float(value)
+        elif name == "max":
+          policy.max_bytes = int(value)
+        else:
+          raise ValueError(f"Unknown cache policy option {name} in {entry}")
+      policies.append(policy)
+    return policies
+
+def approximate_size(value) -> int:
+  """Size of a value in bytes, as it would be sent to local control"""
+  try:
+    return len(json.dumps(value))
+  except (TypeError, ValueError):
+    return sys.getsizeof(value)
+
+class DataCache:
+  """
+  Latest value per key, bounded by total size and key count.
+
+  Keys are kept in order of when they were last seen, so the least recently
+  seen keys are evicted first. Keys that are sent again unchanged are only
+  touched, which counts as seen as well. Values larger than the per-key limit
+  are not cached. Keys with a ttl expire on the next update or snapshot.
+
+  Robot and cloud threads update the cache while local control clients take
+  snapshots, so every access goes through the lock. It is not a dict subclass,
+  dict methods like setdefault or |= would bypass the size accounting.
+  """
+
+  def __init__(self, max_bytes: int = 8 * 1024 * 1024, max_keys: int = 512, max_key_bytes: int = 4 * 1024 * 1024, policies: list[CachePolicy] = None) -> None:
+    self.max_bytes: int = max_bytes
+    self.max_keys: int = max_keys
+    self.max_key_bytes: int = min(max_key_bytes, max_bytes)
+    self.policies: list[CachePolicy] = policies or []
+    self.total_bytes: int = 0
+    self.values: dict = {}
+    self.sizes: dict[str, int] = {}
+    self.updated: dict[str, float] = {}
+    self.evictions: dict[str, int] = {"size": 0, "keys": 0, "ttl": 0, "too_large": 0}
+    self._policy_cache: dict[str, CachePolicy | None] = {}
+    self._lock = threading.RLock()
+
+  def configure(self, max_bytes: int, max_keys: int, max_key_bytes: int, policies: list[CachePolicy]) -> None:
+    """Change limits at runtime, keys over the new limits are evicted right away"""
+    with self._lock:
+      self.max_bytes = max_bytes
+      self.max_keys = max_keys
+      self.max_key_bytes = min(max_key_bytes, max_bytes)
+      self.policies = policies
+      self._policy_cache.clear()
+      self._enforce_limits()
+
+  def _policy(self, key: str) -> CachePolicy | None:
+    if key in self._policy_cache:
+      return self._policy_cache[key]
+    policy = next((policy for policy in self.policies if fnmatchcase(str(key), policy.pattern)), None)
+    if len(self._policy_cache) < 4 * self.max_keys:
+      self._policy_cache[key] = policy
+    return policy
+
+  def __getitem__(self, key):
+    return self.values[key]
+
+  def get(self, key, default=None):
+    return self.values.get(key, default)
+
+  def __contains__(self, key) -> bool:
+    return key in self.values
+
+  def __len__(self) -> int:
+    return len(self.values)
+
+  def __setitem__(self, key, value) -> None:
+    self.set(key, value)
+
+  def set(self, key, value, size: int = None) -> None:
+    """Cache a value, size is its encoded length if the caller already knows it"""
+    size = approximate_size(value) if size is None else size
+    with self._lock:
+      policy = self._policy(key)
+      limit = policy.max_bytes if policy and policy.max_bytes else self.max_key_bytes
+      if size > min(limit, self.max_key_bytes):
+        _LOGGER.debug(f"Not caching {key}: {size} bytes exceed limit of {limit} bytes")
+        self.evictions["too_large"] += 1
+        self._remove(key)
+        return
+
+      # Re-insert to move the key to the end of the update order
+      self._remove(key)
+      self.values[key] = value
+      self.sizes[key] = size
+      self.updated[key] = time.monotonic()
+      self.total_bytes += size
+      self._enforce_limits()
+
+  def touch(self, keys) -> None:
+    """The cached values of keys were sent again unchanged, move them to the end of the eviction order"""
+    now = time.monotonic()
+    with self._lock:
+      for key in keys:
+        if key in self.values:
+          self.values[key] = self.values.pop(key)
+          self.updated[key] = now
+
+  def __delitem__(self, key) -> None:
+    with self._lock:
+      if key not in self.values:
+        raise KeyError(key)
+      self._remove(key)
+
+  def update(self, other: dict, sizes: dict = None) -> None:
+    """Cache all values of other, sizes optionally holds their encoded lengths"""
+    sizes = sizes or {}
+    with self._lock:
+      self.expire()
+      for key, value in other.items():
+        self.set(key, value, sizes.get(key))
+
+  def pop(self, key, *default):
+    with self._lock:
+      if key not in self.values:
+        if default:
+          return default[0]
+        raise KeyError(key)
+      value = self.values[key]
+      self._remove(key)
+      return value
+
+  def clear(self) -> None:
+    with self._lock:
+      self.values.clear()
+      self.sizes.clear()
+      self.updated.clear()
+      self.total_bytes = 0
+
+  def _remove(self, key) -> None:
+    if key in self.values:
+      del self.values[key]
+      self.total_bytes -= self.sizes.pop(key, 0)
+      self.updated.pop(key, None)
+
+  def _enforce_limits(self) -> None:
+    while self.total_bytes > self.max_bytes or len(self.values) > self.max_keys:
+      reason = "size" if self.total_bytes > self.max_bytes else "keys"
+      oldest = next(iter(self.values))
+      _LOGGER.debug(f"Evicting {oldest} ({self.sizes.get(oldest, 0)} bytes) from cache, limit: {reason}")
+      self._remove(oldest)
+      self.evictions[reason] += 1
+
+  def expire(self) -> int:
+    """Remove keys whose ttl has passed, returns the number of removed keys"""
+    if not any(policy.ttl for policy in self.policies):
+      return 0
+    now = time.monotonic()
+    with self._lock:
+      expired = []
+      for key in self.values:
+        policy = self._policy(key)
+        if policy and policy.ttl and now - self.updated[key] > policy.ttl:
+          expired.append(key)
+      for key in expired:
+        self._remove(key)
+      self.evictions["ttl"] += len(expired)
+    return len(expired)
+
+  def snapshot(self) -> dict:
+    """Expire old keys and return a copy of the cache for sending"""
+    with self._lock:
+      self.expire()
+      return dict(self.values)
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "keys": len(self.values),
+        "bytes": self.total_bytes,
+        "max_bytes": self.max_bytes,
+        "max_keys": self.max_keys,
+        "evictions": dict(self.evictions),
+        "largest": sorted(self.sizes.items(), key=lambda item: item[1], reverse=True)[:5],
+      }
@@ -2,21 +2,42 @@ from TCPClient import TCPSocketClient
 from TCPServer import TCPSocketServer
 import json
 import uuid
-from PacketParser import Server_Packet
+from PacketParser import Server_Packet, Packet_Encoder, Frame_Splitter
+from Telemetry import TelemetryStore
+from UpdateMirror import UpdateMirror
+from Health import HealthMonitor
+from ChangeDetector import ChangeDetector
+from DataCache import DataCache, CachePolicy
+from SharedRing import SharedRing
+from WebSocketServer import WebSocketServer
+from Config import ProxyConfig
+from functools import partial
 import logging
+import codecs
 from socket import socket
-import os
 
 _LOGGER = logging.getLogger(__name__)
-_LOGGER.setLevel(os.environ.get('LOG_LEVEL_ECHO', 'INFO').upper())
+
+# A command cut off at the end of a read is kept for the next one up to this many characters
+_MAX_LOCAL_TAIL = 1024 * 1024
 
 class EchoServer:
   
-  def __init__(self):
+  def __init__(self, config: ProxyConfig):
+    self.config: ProxyConfig = config
     self.remote_ip: str = None
     self.remote_port: int = None
     self.last_seq_id: int = 0x5A61111111111111
-    self.data_cache: dict = {}
+    self.data_cache: DataCache = DataCache(
+      max_bytes=config.cache_max_bytes,
+      max_keys=config.cache_max_keys,
+      max_key_bytes=config.cache_max_key_bytes,
+      policies=CachePolicy.parse(config.cache_policies),
+    )
+    self.change_detector: ChangeDetector = ChangeDetector(
+      enabled=config.change_detection,
+      keyframe_interval=config.change_keyframe_interval,
+    )
     self.sn: str = None
     
     self.push_key: str = None
@@ -26,29 +47,111 @@ class EchoServer:
     self.cloud_connected: bool = False
     
     self.local_ack_nr: list[int] = []
+    self.robot_frames: Frame_Splitter = Frame_Splitter()
+    # Per local control client: utf-8 decoder and the incomplete JSON document of the last read
+    self.local_buffers: dict = {}
+    self.cloud_batches: int = 0
+    self.cloud_batch_messages: int = 0
     self.product_id: int = None
     
     self._load_push_key()
     self._load_product_id()
     
+    self.telemetry: TelemetryStore = TelemetryStore(
+      config.telemetry_file,
+      capacity=config.telemetry_capacity,
+      flush_interval=config.telemetry_flush_interval,
+    )
+    self.telemetry.start()
+    
+    # Always records manifests, images are only downloaded for pinned versions unless UPDATE_MIRROR is set
+    self.update_mirror: UpdateMirror = UpdateMirror(config.update_path, versions=config.update_versions, mirror_all=config.update_mirror)
+    self.update_mirror.start()
+    
+    self.packet_encoder: Packet_Encoder = Packet_Encoder(self.push_key)
+    
+    # Started once all servers are up, but needed as soon as clients connect
+    self.health: HealthMonitor = HealthMonitor(
+      self,
+      interval=config.health_interval,
+      stale_after=config.health_stale_after,
+      stuck_after=config.health_stuck_after,
+      probe_interval=config.health_probe_interval,
+      probe_timeout=config.health_probe_timeout,
+      probe_command=config.health_probe_command,
+      reconnect=config.health_reconnect,
+      health_file=config.health_file,
+    )
+    
+    self.local_unix_socket: TCPSocketServer = None
+    self.local_websocket: WebSocketServer = None
+    self.shared_ring: SharedRing = None
+    
     self.cloud_client: TCPSocketClient = None
-    self.robot_socket: TCPSocketServer = TCPSocketServer(os.environ.get("LOCAL_PROXY_IP", "0.0.0.0"), int(os.environ.get("ROBOT_PORT", "80")), loggerName="RobotSocketServer")
+    self.robot_socket: TCPSocketServer = TCPSocketServer(config.robot_host, config.robot_port, loggerName="RobotSocketServer")
     self.robot_socket.add_data_listener(self._handle_robot_data)
     self.robot_socket.add_connection_listener(self._handle_robot_connection)
+    if config.robot_fast_forward:
+      self.robot_socket.set_fast_forward(self._forward_robot_data)
     self.robot_socket.start()
-    _LOGGER.info("Robot server started on port 80")
+    _LOGGER.info(f"Robot server started on port {config.robot_port}")
     
-    self.local_control_socket: TCPSocketServer = TCPSocketServer(os.environ.get("LOCAL_CONTROL_HOST", "0.0.0.0"), int(os.environ.get("LOCAL_CONTROL_PORT", "4468")), includeCustomHeader=True, loggerName="LocalControlSocketServer")
-    self.local_control_socket.add_data_listener(self._handle_local_data)
-    self.local_control_socket.add_connection_listener(self._handle_local_connection)
+    self.local_control_socket: TCPSocketServer = TCPSocketServer(config.local_control_host, config.local_control_port, includeCustomHeader=True, loggerName="LocalControlSocketServer", allowCompression=True, compressThreshold=config.local_control_compress_threshold)
+    self.local_control_socket.add_data_listener(partial(self._handle_local_data, server=self.local_control_socket), withClient=True)
+    self.local_control_socket.add_connection_listener(partial(self._handle_local_connection, server=self.local_control_socket))
     self.local_control_socket.start()
-    _LOGGER.info("Local control server started on port 4468")
+    _LOGGER.info(f"Local control server started on port {config.local_control_port}")
+    
+    if config.local_control_socket:
+      self.local_unix_socket = TCPSocketServer(includeCustomHeader=True, loggerName="LocalControlUnixSocketServer", unixPath=config.local_control_socket, allowCompression=True, compressThreshold=config.local_control_compress_threshold)
+      self.local_unix_socket.add_data_listener(partial(self._handle_local_data, server=self.local_unix_socket), withClient=True)
+      self.local_unix_socket.add_connection_listener(partial(self._handle_local_connection, server=self.local_unix_socket))
+      self.local_unix_socket.start()
+      _LOGGER.info(f"Local control server started on {config.local_control_socket}")
+      
+      if config.local_control_shm:
+        self.shared_ring = SharedRing(config.local_control_shm, slot_size=config.local_control_shm_slot_size)
+    
+    if config.local_control_ws_port:
+      self.local_websocket = WebSocketServer(config.local_control_host, config.local_control_ws_port, compressThreshold=config.local_control_ws_compress_threshold,
+                                             allowedOrigins=config.local_control_ws_origins, loggerName="LocalControlWebSocketServer")
+      self.local_websocket.add_data_listener(partial(self._handle_local_data, server=self.local_websocket), withClient=True)
+      self.local_websocket.add_connection_listener(partial(self._handle_local_connection, server=self.local_websocket))
+      self.local_websocket.set_state_provider(self._local_control_state)
+      self.local_websocket.start()
+      _LOGGER.info(f"Local control websocket started on port {config.local_control_ws_port}")
+    
+    self.health.start()
+    if self.local_websocket:
+      self.local_websocket.set_health_provider(self._health_status)
+    
+    config.add_reload_listener(self._apply_config)
     
     _LOGGER.info("------------------------------------------------")
     _LOGGER.info("Proxy ready! Waiting for connection from robot...")
     _LOGGER.info("------------------------------------------------")
     
   
+  def _apply_config(self, config: ProxyConfig) -> None:
+    """Apply reloaded settings to the running components"""
+    self.data_cache.configure(config.cache_max_bytes, config.cache_max_keys, config.cache_max_key_bytes, CachePolicy.parse(config.cache_policies))
+    self.change_detector.enabled = config.change_detection
+    self.change_detector.keyframe_interval = config.change_keyframe_interval
+    self.telemetry.flush_interval = config.telemetry_flush_interval
+    self.update_mirror.configure(config.update_versions, config.update_mirror)
+    self.health.stale_after = config.health_stale_after
+    self.health.stuck_after = config.health_stuck_after
+    self.health.probe_interval = config.health_probe_interval
+    self.health.probe_timeout = config.health_probe_timeout
+    self.health.probe_command = config.health_probe_command
+    self.health.reconnect = config.health_reconnect
+    self.local_control_socket.compressThreshold = config.local_control_compress_threshold
+    if self.local_unix_socket:
+      self.local_unix_socket.compressThreshold = config.local_control_compress_threshold
+    if self.local_websocket:
+      self.local_websocket.compressThreshold = config.local_control_ws_compress_threshold
+      self.local_websocket.allowedOrigins = config.local_control_ws_origins
+  
   def _load_push_key(self) -> None:
     """Load push key from file if available"""
     try:
@@ -111,67 +214,232 @@ class EchoServer:
   # -------------------------------------
   # Local Control Server functions  
   
-  def _handle_local_connection(self, client: socket, connected: bool) -> None:
+  def _handle_local_connection(self, client: socket, connected: bool, server) -> None:
     _LOGGER.info(f"Local control is {'connected' if connected else 'disconnected'}")
     if connected:
-      self.update_local_control(None)
-    
-  def _handle_local_data(self, message: bytes) -> None:
-    """Handle messages from local control"""
-    message_str = message.decode("utf-8")
-    if "}{" in message_str:
-      messages = message_str.split("}{", maxsplit=1)
-      messages[0] = messages[0] + "}"
-      messages[1] = "{" + messages[1]
-      for msg in messages:
-        self._handle_local_data(msg.encode("utf-8"))
-      return
+      # Only the new client needs the snapshot, the others are up to date
+      self._reply_local_control(self._local_control_state("robot"), client, server)
+    else:
+      self.local_buffers.pop(client, None)
+    
+  def _handle_local_data(self, message: bytes, client, server) -> None:
+    """Handle messages from a client of one of the local control servers"""
+    decoder, tail = self.local_buffers.get(client) or (codecs.getincrementaldecoder("utf-8")(errors="replace"), "")
+    documents, tail = self._split_local_messages(tail + decoder.decode(message))
+    if tail and (server is self.local_websocket or len(tail) > _MAX_LOCAL_TAIL):
+      # Websocket messages are complete, there is nothing more to come for them
+      _LOGGER.warning(f"Dropping incomplete local control message: {tail[:200]!r}")
+      tail = ""
+    self.local_buffers[client] = (decoder, tail)
     
+    commands = []
     try:
-      user_data = json.loads(message.decode("utf-8"))
+      for user_data in documents:
+        for item in user_data if isinstance(user_data, list) else [user_data]:
+          if not isinstance(item, dict):
+            _LOGGER.warning(f"Ignoring local control message that is not an object: {item}")
+            continue
+          if "telemetry" in item:
+            self._handle_telemetry_query(item["telemetry"] or {}, client, server)
+            continue
+          if list(item.keys()) == ["compression"]:
+            # Sent in the same read as other messages, otherwise the server already answered it
+            if isinstance(server, TCPSocketServer):
+              server.negotiate_compression(client, item["compression"])
+            continue
+          commands.append(self._build_local_command(item))
+    except Exception as e:
+      _LOGGER.exception(f"Error handling local control message: {message}")
       
-      data = {
-        "data": json.dumps(user_data.get("data", {})),
-        "extend": {
-          "taskid": str(uuid.uuid4()),
-          "usid": "admin",
-        },
-        "infoType": str(user_data.get("infoType", "30000")),
-        "sn": self.sn
-      }
+    if commands:
+      self._send_local_commands(commands)
       
-      packet = Server_Packet(None, self.push_key)
-      to_send = packet.build(
-        data=data,
-        encrypt=True if user_data.get("encrypt", 1) else False,
-        last_seq_id=self.last_seq_id,
-        product_id=self.product_id if self.product_id else 60008,
-      )
-      _LOGGER.debug(f"Built packet for local control message: seq={packet.seq_nr}, ack_nr={packet.ack_nr}, data={data}")
-      self.local_ack_nr.append(int(packet.ack_nr))
+  @staticmethod
+  def _split_local_messages(message: str) -> tuple[list, str]:
+    """
+    Split concatenated JSON documents, e.g. when several commands arrive in one
+    read. Invalid documents are skipped, returns the documents and the start of
+    a document that was cut off at the end.
+
+    Anything that does not start like a document (e.g. an HTTP request a web
+    page sent to the port) drops the rest of the message, the commands in it
+    must not be picked out.
+    """
+    decoder = json.JSONDecoder()
+    documents = []
+    offset = 0
+    while True:
+      while offset < len(message) and message[offset].isspace():
+        offset += 1
+      if offset >= len(message):
+        return documents, ""
+      if message[offset] not in "{[":
+        _LOGGER.warning(f"Ignoring local control data that is not JSON: {message[offset:offset + 200]!r}")
+        return documents, ""
+      try:
+        document, offset = decoder.raw_decode(message, offset)
+      except json.JSONDecodeError as e:
+        end = EchoServer._document_end(message, offset)
+        if end is None:
+          return documents, message[offset:]
+        _LOGGER.warning(f"Ignoring invalid local control message {message[offset:end][:200]!r}: {e.msg}")
+        offset = end
+        continue
+      documents.append(document)
       
-      self.robot_socket.send_data(to_send)
-      _LOGGER.debug("Forwarded local control message to robot")
+  @staticmethod
+  def _document_end(message: str, offset: int) -> int | None:
+    """End of the object or array starting at offset, None if it is cut off"""
+    closing = {"{": "}", "[": "]"}
+    expected = []
+    in_string = False
+    escaped = False
+    for index in range(offset, len(message)):
+      char = message[index]
+      if in_string:
+        if escaped:
+          escaped = False
+        elif char == "\\":
+          escaped = True
+        elif char == '"':
+          in_string = False
+      elif char == '"':
+        in_string = True
+      elif char in closing:
+        expected.append(closing[char])
+      elif char in "}]":
+        if char != expected.pop():
+          # Mismatched brackets will not become valid with more data
+          return index + 1
+        if not expected:
+          return index + 1
+    return None
+      
+  def _build_local_command(self, user_data: dict) -> tuple[dict, bool]:
+    data = {
+      "data": json.dumps(user_data.get("data", {})),
+      "extend": {
+        "taskid": str(uuid.uuid4()),
+        "usid": "admin",
+      },
+      "infoType": str(user_data.get("infoType", "30000")),
+      "sn": self.sn
+    }
+    return data, True if user_data.get("encrypt", 1) else False
+  
+  def _send_local_commands(self, commands: list[tuple[dict, bool]]) -> list[int]:
+    """Encode all commands into one buffer and send them to the robot with a single write, returns their ack numbers"""
+    try:
+      with self.packet_encoder.lock:
+        self.packet_encoder.push_key = self.push_key
+        frames, ack_nrs = self.packet_encoder.encode(
+          commands,
+          last_seq_id=self.last_seq_id,
+          product_id=self.product_id if self.product_id else 60008,
+        )
+        _LOGGER.debug(f"Built {len(commands)} packets for local control: ack_nrs={ack_nrs}, data={[data for data, _ in commands]}")
+        self.local_ack_nr.extend(ack_nrs)
+        
+        self.robot_socket.send_data(frames)
+      _LOGGER.debug(f"Forwarded {len(commands)} local control messages to robot")
+      return ack_nrs
     except Exception as e:
-      _LOGGER.exception(f"Error handling local control message: {message}")
+      _LOGGER.exception(f"Error sending local control messages: {commands}")
+      return []
+  
+  def send_probe(self, command: dict) -> list[int]:
+    """Send a health probe to the robot, its ack ends up in HealthMonitor.ack_received"""
+    return self._send_local_commands([self._build_local_command(command)])
       
-  def update_local_control(self, toSend: dict = None, origin: str = "robot") -> None:
-    """Update local control connection status"""
+  def _handle_telemetry_query(self, request: dict, client, server) -> None:
+    """Answer a telemetry history request, only the client that asked gets the answer"""
     data = {
+      "origin": "proxy",
+      "telemetry": self.telemetry.handle_query(request) if isinstance(request, dict) else {"error": "Query must be an object"},
+    }
+    _LOGGER.debug(f"Answering telemetry query: {request}")
+    self._reply_local_control(data, client, server)
+    
+  def _reply_local_control(self, data: dict, client, server) -> None:
+    """Send a message to a single client of one of the local control servers"""
+    message = json.dumps(data).encode('utf-8')
+    if server is self.local_unix_socket:
+      message = self._share_large_message(data, message)
+    server.send_to(client, message)
+      
+  def _health_status(self, kind: str) -> tuple[bool, dict]:
+    """Answer /health/live, /health/ready and /health"""
+    if kind == "live":
+      return self.health.liveness()
+    if kind == "ready":
+      return self.health.readiness()
+    return True, self.health.report()
+      
+  def _local_control_state(self, origin: str = "proxy") -> dict:
+    """Connection status and cached data, as sent to local control on connect"""
+    return {
       "origin": origin,
       "sn": self.sn,
       "robot_connected": self.robot_connected,
       "cloud_connected": self.cloud_connected,
+      "cache": self.data_cache.snapshot(),
+      "stats": {
+        "changes": self.change_detector.stats(),
+        "cache": self.data_cache.stats(),
+        "updates": self.update_mirror.stats(),
+        "health": self.health.report(),
+      },
     }
+      
+  def update_local_control(self, toSend: dict = None, origin: str = "robot") -> None:
+    """Update local control connection status"""
     if toSend is not None:
-      data["data"] = toSend
-      self.data_cache.update(toSend)
+      self.telemetry.record(toSend)
+      changes = self.change_detector.changes(self.data_cache, toSend)
+      # Unchanged keys are still current, they must not be the first to be evicted
+      self.data_cache.touch([key for key in toSend if key not in changes])
+      if not changes:
+        return
+      data = {
+        "origin": origin,
+        "sn": self.sn,
+        "robot_connected": self.robot_connected,
+        "cloud_connected": self.cloud_connected,
+      }
+      # Every value is encoded once, its length is the size the cache accounts for
+      encoded = {key: json.dumps(value) for key, value in changes.items()}
+      self.data_cache.update(changes, sizes={key: len(raw) for key, raw in encoded.items()})
+      items = ", ".join(f"{json.dumps(str(key))}: {raw}" for key, raw in encoded.items())
+      message = (json.dumps(data)[:-1] + f', "data": {{{items}}}}}').encode('utf-8')
+      data["data"] = changes
+      topics = ["data", *changes.keys()]
     else:
-      data["cache"] = self.data_cache
+      data = self._local_control_state(origin)
+      topics = ["cache"]
+      message = json.dumps(data).encode('utf-8')
       
     _LOGGER.debug(f"Sending local control update: {data}")
     
-    self.local_control_socket.send_data(json.dumps(data).encode('utf-8'))
+    self.local_control_socket.send_data(message)
+    if self.local_unix_socket and self.local_unix_socket.clients:
+      self.local_unix_socket.send_data(self._share_large_message(data, message))
+    if self.local_websocket:
+      self.local_websocket.send_data(message, topics)
+      
+  def _share_large_message(self, data: dict, message: bytes) -> bytes:
+    """Put large messages into the shared ring and only send a reference to unix socket clients"""
+    if not self.shared_ring or len(message) < self.config.local_control_shm_threshold:
+      return message
+    seq = self.shared_ring.write(message)
+    if seq is None:
+      return message
+    reference = {key: value for key, value in data.items() if key not in ("data", "cache", "telemetry")}
+    reference["shm"] = {
+      "path": self.shared_ring.path,
+      "seq": seq,
+      "size": len(message),
+    }
+    return json.dumps(reference).encode('utf-8')
     
     
   # -------------------------------------
@@ -200,6 +468,21 @@ class EchoServer:
       _LOGGER.error(f"Error connecting to remote server: {e}")
       raise
     
+  def reset_robot_session(self) -> None:
+    """
+    Drop the cloud connection and the robot, e.g. when the cloud stopped delivering frames.
+
+    The cloud expects the robot's handshake on a new connection, so it is not
+    replaced underneath the robot. The robot reconnects by itself and
+    _handle_robot_connection then connects to the cloud again.
+    """
+    if self.cloud_client:
+      self.cloud_client.disconnect()
+    self.cloud_connected = False
+    for client in list(self.robot_socket.clients):
+      self.robot_socket.drop_client(client)
+    self.update_local_control()
+    
   def _handle_cloud_data(self, message) -> None:
     """Handle messages from cloud"""
     
@@ -218,29 +501,38 @@ class EchoServer:
       self.last_seq_id = packet.seq_nr
       _LOGGER.debug(f"Server packet: seq={packet.seq_nr}, payload={packet.payload_json}")
       
-      payload_data = packet.payload_json.get("data", {})
-      if isinstance(payload_data, str):
-        try:
-          payload_data = json.loads(payload_data)
-        except json.JSONDecodeError:
-          _LOGGER.error("Failed to decode payload data as JSON")
-      
-      data = {
-        "origin": "server",
-        "data": payload_data
-      }
-      if data.get("data", None) is None:
-        return
-        
-      self.update_local_control(payload_data, origin="server")
-      _LOGGER.info(f"Forwarded decrypted server payload to local control")
-      
-      with open("server_requests.txt", "a") as f:
-        f.write(f"{json.dumps(payload_data)}\n")
+      if packet.encapsulated:
+        self.cloud_batches += 1
+        self.cloud_batch_messages += len(packet.messages)
+        _LOGGER.info(f"Server batch with {len(packet.messages)} inner messages ({self.cloud_batches} batches, {self.cloud_batch_messages} inner messages so far)")
       
     except Exception as e:
       _LOGGER.error(f"Error handling server message: {e}")
+      return
+    
+    for payload_json in packet.messages:
+      try:
+        self._handle_cloud_payload(payload_json)
+      except Exception as e:
+        _LOGGER.error(f"Error handling server message: {e}")
       
+  def _handle_cloud_payload(self, payload_json: dict) -> None:
+    """Forward a single decrypted server message to local control"""
+    payload_data = payload_json.get("data", {})
+    if isinstance(payload_data, str):
+      try:
+        payload_data = json.loads(payload_data)
+      except json.JSONDecodeError:
+        _LOGGER.error("Failed to decode payload data as JSON")
+    
+    if payload_data is None:
+      return
+      
+    self.update_local_control(payload_data, origin="server")
+    _LOGGER.info(f"Forwarded decrypted server payload to local control")
+    
+    with open("server_requests.txt", "a") as f:
+      f.write(f"{json.dumps(payload_data)}\n")
       
     
   # -------------------------------------
@@ -250,6 +542,7 @@ class EchoServer:
     self.robot_connected = connected
     if connected:
       _LOGGER.info("Robot connected")
+      self.robot_frames.reset()
       if not self.cloud_connected:
         _LOGGER.info("Connecting to remote server")
         self._connect_cloud_server()
@@ -259,20 +552,25 @@ class EchoServer:
     _LOGGER.info("------------------------------------------------")
     self.update_local_control()
     
+  def _take_local_ack(self, ack_nr: int) -> bool:
+    """Acks for locally sent commands end here, the cloud does not know them"""
+    if ack_nr not in self.local_ack_nr:
+      return False
+    self.local_ack_nr.remove(ack_nr)
+    self.health.ack_received(ack_nr)
+    return True
+  
+  def _forward_robot_data(self, message: bytes | memoryview) -> bool:
+    """Forward robot data to the cloud, only the frame heads are looked at to take out acks of local commands"""
+    if not self.cloud_client:
+      return False
+    for part in self.robot_frames.feed(message, self._take_local_ack):
+      self.cloud_client.send_data(part)
+    return True
+    
   def _handle_robot_data(self, message: bytes) -> None:
     """Handle messages from robot clients"""
-    if not self.cloud_client:
+    if not self._forward_robot_data(message):
       _LOGGER.error("No server connected, cannot forward client message")
       raise Exception("No server connected")
-  
-    if message[:4] == b'\x00\x05\x00\x04':
-      ack_len = int.from_bytes(message[4:6], byteorder='big')
-      ack = message[6:6 + ack_len].decode('utf-8')
-      ack_nr = int(ack.split(":")[1])
-      
-      if ack_nr in self.local_ack_nr:
-        self.local_ack_nr.remove(ack_nr)
-        return
-  
-    self.cloud_client.send_data(message)
     _LOGGER.debug(f"Forwarded message to server: {len(message)} bytes")
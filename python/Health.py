@@ -0,0 +1,247 @@
+import threading
+import logging
+import json
+import time
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+class HealthMonitor:
+  """
+  Watchdog for the forwarding paths between robot, cloud and local control.
+
+  A worker thread checks every interval seconds when frames were last seen in
+  each direction, whether a send has been blocked for longer than stuck_after
+  seconds and whether the cloud receive loop is still running. Blocked clients
+  are dropped. If the cloud connection is broken or silent, cloud and robot
+  are disconnected, so that the robot reconnects and does its handshake again.
+
+  If probe_interval is set, probe_command is sent to the robot like a local
+  control command and the time until the robot acks it is recorded.
+
+  After every check the liveness is written to health_file, if set, so that
+  it can be checked without the websocket server (see healthcheck.py).
+  """
+
+  def __init__(self, echo_server, interval: float = 10.0, stale_after: float = 300.0, stuck_after: float = 30.0,
+               probe_interval: float = 0.0, probe_timeout: float = 15.0, probe_command: dict = None,
+               reconnect: bool = True, reconnect_interval: float = 30.0, health_file: str = None) -> None:
+    self.echo_server = echo_server
+    self.interval: float = interval
+    self.stale_after: float = stale_after
+    self.stuck_after: float = stuck_after
+    self.probe_interval: float = probe_interval
+    self.probe_timeout: float = probe_timeout
+    self.probe_command: dict = probe_command or {"infoType": "30000", "data": {}}
+    self.reconnect: bool = reconnect
+    self.reconnect_interval: float = reconnect_interval
+    self.health_file: str = health_file
+
+    self.running: bool = False
+    self.started: float = time.monotonic()
+    self.last_check: float = None
+    self.problems: list[str] = []
+
+    self._lock = threading.Lock()
+    self.pending_probes: dict[int, float] = {}
+    self.last_probe_sent: float = None
+    self.last_probe_ok: bool | None = None
+    self.last_probe_latency: float = None
+    self.probes_sent: int = 0
+    self.probes_failed: int = 0
+
+    self.last_reconnect: float = None
+    self.reconnects: int = 0
+    self.dropped_clients: int = 0
+
+  def start(self) -> None:
+    """Start the watchdog in a new thread"""
+    self.running = True
+    if self.health_file:
+      os.makedirs(os.path.dirname(self.health_file) or ".", exist_ok=True)
+    worker = threading.Thread(target=self._run)
+    worker.daemon = True
+    worker.start()
+    _LOGGER.info(f"Health monitor started, checking every {self.interval}s")
+
+  def stop(self) -> None:
+    self.running = False
+
+  def _run(self) -> None:
+    while self.running:
+      try:
+        self.check()
+      except Exception as e:
+        _LOGGER.exception("Error checking proxy health", exc_info=e)
+      self._write_health_file()
+      time.sleep(self.interval)
+
+  def check(self) -> list[str]:
+    """Run all checks once and act on the problems found, returns the problems"""
+    now = time.monotonic()
+    problems = []
+    echo_server = self.echo_server
+
+    for name, server in (("robot", echo_server.robot_socket), ("local control", echo_server.local_control_socket), ("local control unix socket", echo_server.local_unix_socket),
+                         ("local control websocket", echo_server.local_websocket)):
+      if server is None:
+        continue
+      for client in server.stuck_clients(self.stuck_after):
+        problems.append(f"send to {name} client blocked for more than {self.stuck_after}s")
+        _LOGGER.warning(f"Send to {name} client blocked for more than {self.stuck_after}s, dropping it")
+        server.drop_client(client)
+        self.dropped_clients += 1
+
+    robot = echo_server.robot_socket
+    if echo_server.robot_connected and self._age(robot.last_received or robot.last_connected, now) > self.stale_after:
+      problems.append(f"no frames from robot for more than {self.stale_after}s")
+
+    if echo_server.robot_connected and echo_server.remote_ip:
+      cloud = echo_server.cloud_client
+      problem = None
+      if cloud is None or not cloud.is_alive():
+        problem = "cloud connection lost"
+      elif cloud.sending_since is not None and now - cloud.sending_since > self.stuck_after:
+        problem = f"send to cloud blocked for more than {self.stuck_after}s"
+      elif self._age(cloud.last_received or cloud.connected_at, now) > self.stale_after:
+        problem = f"no frames from cloud for more than {self.stale_after}s"
+      if problem:
+        problems.append(problem)
+        self._reset_robot_session(problem, now)
+
+    problems += self._check_probes(now)
+
+    if problems != self.problems:
+      if problems:
+        _LOGGER.warning(f"Proxy unhealthy: {'; '.join(problems)}")
+      else:
+        _LOGGER.info("Proxy healthy again")
+    self.problems = problems
+    self.last_check = now
+    return problems
+
+  def _write_health_file(self) -> None:
+    if not self.health_file:
+      return
+    live, body = self.liveness()
+    body["time"] = time.time()
+    body["max_age"] = self.max_check_age()
+    try:
+      # Written to a temporary file first, the healthcheck must never read a partial file
+      with open(f"{self.health_file}.tmp", "w") as f:
+        json.dump(body, f)
+      os.replace(f"{self.health_file}.tmp", self.health_file)
+    except OSError as e:
+      _LOGGER.error(f"Error writing {self.health_file}: {e}")
+
+  def _check_probes(self, now: float) -> list[str]:
+    problems = []
+    if not self.echo_server.robot_connected:
+      # A new robot connection starts with a clean slate
+      self.last_probe_ok = None
+    with self._lock:
+      expired = [ack_nr for ack_nr, sent in self.pending_probes.items() if now - sent > self.probe_timeout]
+      for ack_nr in expired:
+        del self.pending_probes[ack_nr]
+        self.probes_failed += 1
+        self.last_probe_ok = False
+      pending = bool(self.pending_probes)
+
+    for ack_nr in expired:
+      # The robot will not ack it anymore, stop inspecting its frames for it
+      try:
+        self.echo_server.local_ack_nr.remove(ack_nr)
+      except ValueError:
+        pass
+    if expired:
+      _LOGGER.warning(f"Robot did not ack probe within {self.probe_timeout}s")
+    if self.last_probe_ok is False:
+      problems.append("robot did not ack the last probe")
+
+    echo_server = self.echo_server
+    if (self.probe_interval and not pending and echo_server.robot_connected and echo_server.push_key
+        and self._age(self.last_probe_sent, now) >= self.probe_interval):
+      ack_nrs = echo_server.send_probe(self.probe_command)
+      if ack_nrs:
+        with self._lock:
+          for ack_nr in ack_nrs:
+            self.pending_probes[ack_nr] = now
+          self.last_probe_sent = now
+          self.probes_sent += 1
+        _LOGGER.debug(f"Sent probe to robot with ack {ack_nrs}")
+    return problems
+
+  def ack_received(self, ack_nr: int) -> None:
+    """Called for every ack of a locally sent command"""
+    with self._lock:
+      sent = self.pending_probes.pop(ack_nr, None)
+      if sent is None:
+        return
+      self.last_probe_latency = time.monotonic() - sent
+      self.last_probe_ok = True
+    _LOGGER.debug(f"Robot acked probe after {self.last_probe_latency * 1000:.1f} ms")
+    self.echo_server.telemetry.record({"health": {"probe_latency": self.last_probe_latency}})
+
+  def _reset_robot_session(self, reason: str, now: float) -> None:
+    if not self.reconnect or self._age(self.last_reconnect, now) < self.reconnect_interval:
+      return
+    self.last_reconnect = now
+    self.reconnects += 1
+    _LOGGER.warning(f"Dropping robot and cloud connection, the robot reconnects: {reason}")
+    try:
+      self.echo_server.reset_robot_session()
+    except Exception as e:
+      _LOGGER.error(f"Dropping robot and cloud connection failed: {e}")
+
+  @staticmethod
+  def _age(timestamp: float | None, now: float) -> float:
+    return now - timestamp if timestamp is not None else float("inf")
+
+  def max_check_age(self) -> float:
+    """Seconds after the last check at which the watchdog is considered hung"""
+    return 3 * self.interval + self.stuck_after
+
+  def liveness(self) -> tuple[bool, dict]:
+    """The proxy is alive as long as the watchdog keeps checking, it would hang on a stuck reconnect as well"""
+    now = time.monotonic()
+    checked = self._age(self.last_check, now)
+    # The first check may still be running right after startup
+    ok = self.running and min(checked, now - self.started) <= self.max_check_age()
+    return ok, {"status": "ok" if ok else "fail", "checked": self._seconds(checked), "problems": self.problems}
+
+  def readiness(self) -> tuple[bool, dict]:
+    """The proxy is ready if it is alive, robot and cloud are connected and no problems were found"""
+    live, body = self.liveness()
+    ok = live and self.echo_server.robot_connected and self.echo_server.cloud_connected and not self.problems
+    body["status"] = "ok" if ok else "fail"
+    body["robot_connected"] = self.echo_server.robot_connected
+    body["cloud_connected"] = self.echo_server.cloud_connected
+    return ok, body
+
+  def report(self) -> dict:
+    """Seconds since the last frame per direction, probe results and watchdog actions"""
+    now = time.monotonic()
+    echo_server = self.echo_server
+    cloud = echo_server.cloud_client
+    return {
+      "problems": self.problems,
+      "last_frame": {
+        "from_robot": self._seconds(self._age(echo_server.robot_socket.last_received, now)),
+        "to_robot": self._seconds(self._age(echo_server.robot_socket.last_sent, now)),
+        "from_cloud": self._seconds(self._age(cloud.last_received if cloud else None, now)),
+        "to_cloud": self._seconds(self._age(cloud.last_sent if cloud else None, now)),
+        "from_local_control": self._seconds(self._age(echo_server.local_control_socket.last_received, now)),
+      },
+      "probe": {
+        "ok": self.last_probe_ok,
+        "latency": self.last_probe_latency,
+        "sent": self.probes_sent,
+        "failed": self.probes_failed,
+      },
+      "reconnects": self.reconnects,
+      "dropped_clients": self.dropped_clients,
+    }
+
+  @staticmethod
+  def _seconds(age: float) -> float | None:
+    return round(age, 3) if age != float("inf") else None
@@ -0,0 +1,101 @@
+from urllib.parse import urlsplit, parse_qsl
+import json
+
+class HttpHeaders:
+    """Case insensitive header map that keeps the original spelling of the names"""
+
+    def __init__(self, headers: dict | list = None) -> None:
+        self._headers: dict[str, tuple[str, str]] = {}
+        for name, value in (headers.items() if isinstance(headers, dict) else headers or []):
+            self[name] = value
+
+    def __getitem__(self, name: str) -> str:
+        return self._headers[name.lower()][1]
+
+    def __setitem__(self, name: str, value: str) -> None:
+        self._headers[name.lower()] = (name, str(value))
+
+    def __delitem__(self, name: str) -> None:
+        del self._headers[name.lower()]
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._headers
+
+    def get(self, name: str, default: str = None) -> str | None:
+        header = self._headers.get(name.lower())
+        return header[1] if header else default
+
+    def pop(self, name: str, default: str = None) -> str | None:
+        header = self._headers.pop(name.lower(), None)
+        return header[1] if header else default
+
+    def items(self) -> list[tuple[str, str]]:
+        return list(self._headers.values())
+
+class HttpRequest:
+    """
+    HTTP request as seen by HttpHandler. The attributes are the subset of
+    mitmproxy's request that the handlers use, so mitmproxy requests fit as well.
+    """
+
+    def __init__(self, method: str, path: str, headers: HttpHeaders, content: bytes = b"", host: str = None, port: int = 80, http_version: str = "HTTP/1.1") -> None:
+        self.method: str = method
+        # Includes the query string, like mitmproxy
+        self.path: str = path
+        self.headers: HttpHeaders = headers
+        self.content: bytes = content
+        self.pretty_host: str = host or headers.get("Host", "").split(":")[0]
+        self.port: int = port
+        self.http_version: str = http_version
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    @property
+    def query(self) -> dict[str, str]:
+        return dict(parse_qsl(urlsplit(self.path).query, keep_blank_values=True))
+
+class HttpResponse:
+    """HTTP response as seen by HttpHandler, see HttpRequest"""
+
+    def __init__(self, status_code: int, headers: HttpHeaders, content: bytes = b"", reason: str = None) -> None:
+        self.status_code: int = status_code
+        self.reason: str = reason
+        self.headers: HttpHeaders = headers
+        self.content: bytes = content
+        # (path, offset, length) of a file sent instead of content, so large files are not read into memory
+        self.file: tuple[str, int, int] | None = None
+
+    @classmethod
+    def make(cls, status_code: int = 200, content: bytes | str = b"", headers: dict = None) -> "HttpResponse":
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        return cls(status_code, HttpHeaders(headers), content)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def set_text(self, text: str) -> None:
+        self.content = text.encode("utf-8")
+        self.headers["Content-Length"] = str(len(self.content))
+
+    def json(self):
+        return json.loads(self.content)
+
+class HttpFlow:
+    """One request and, once it is known, its response"""
+
+    def __init__(self, request: HttpRequest, response: HttpResponse = None) -> None:
+        self.request: HttpRequest = request
+        self.response: HttpResponse | None = response
+
+    def respond(self, status_code: int, content: bytes, headers: dict = None) -> None:
+        """Answer the request locally instead of forwarding it"""
+        self.response = HttpResponse.make(status_code, content, headers)
+
+    def respond_file(self, status_code: int, path: str, offset: int, length: int, headers: dict = None) -> None:
+        """Answer the request with a part of a file"""
+        self.response = HttpResponse.make(status_code, b"", headers)
+        self.response.file = (path, offset, length)
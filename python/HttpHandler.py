@@ -1,4 +1,5 @@
-from mitmproxy import http
+from HttpFlow import HttpFlow
+from UpdateMirror import UpdateMirror
 from urllib.parse import parse_qs
 import logging
 import json
@@ -6,10 +7,14 @@ import EchoServer
 import os
 
 _LOGGER = logging.getLogger(__name__)
-_LOGGER.setLevel(os.environ.get('LOG_LEVEL_HTTP', 'INFO').upper())
 
-def request(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
-    if flow.request.path in [
+# The local mitmproxy CA certificate, served at /ca/cacert.pem
+CA_FILE = os.path.expanduser("~/.mitmproxy/mitmproxy-ca-cert.pem")
+
+def request(echo_server: EchoServer, flow: HttpFlow) -> None:
+    if flow.request.path == "/ca/cacert.pem":
+        _handle_ca_request(flow)
+    elif flow.request.path in [
         "/clean/dev/event",
         "/clean/cmd/response"
     ]:
@@ -18,10 +23,18 @@ def request(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
         _handle_material_status(echo_server, flow)
     elif flow.request.path.startswith("/list/get"):
         _handle_ip_request(echo_server, flow)
-    elif "." in flow.request.path.split("/")[-1] and os.environ.get("CACHE_STATIC", "true").lower() == "true":
+    elif echo_server.update_mirror and echo_server.update_mirror.is_firmware(flow.request.pretty_host, flow.request.path):
+        _handle_firmware_request(echo_server, flow)
+    elif "." in flow.request.path.split("/")[-1] and echo_server.config.cache_static:
         _handle_static_file_request(echo_server, flow)
         
-def response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_ca_request(flow: HttpFlow) -> None:
+    try:
+        flow.respond_file(200, CA_FILE, 0, os.path.getsize(CA_FILE), {"Content-Type": "application/x-pem-file"})
+    except FileNotFoundError:
+        _LOGGER.error(f"CA file not found: {CA_FILE}")
+
+def response(echo_server: EchoServer, flow: HttpFlow) -> None:
     if flow.request.path == "/clean/dev/register":
         _handle_register_response(echo_server, flow)
     elif flow.request.path.startswith("/list/get"):
@@ -30,11 +43,14 @@ def response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
         _handle_update_response(echo_server, flow)
     elif flow.request.path == "/clean/dev/sync":
         _handle_sync_response(echo_server, flow)
-    elif "." in flow.request.path.split("/")[-1] and os.environ.get("CACHE_STATIC", "true").lower() == "true":
+    elif echo_server.update_mirror and echo_server.update_mirror.is_firmware(flow.request.pretty_host, flow.request.path):
+        # Firmware is downloaded and verified by the update mirror, not the static file cache
+        return
+    elif "." in flow.request.path.split("/")[-1] and echo_server.config.cache_static:
         _handle_static_file_response(echo_server, flow)
         
         
-def _handle_register_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_register_response(echo_server: EchoServer, flow: HttpFlow) -> None:
     _LOGGER.info(f"Robot got register response: {flow.response.text}")
     try:
         json_response = flow.response.json()
@@ -49,12 +65,12 @@ def _handle_register_response(echo_server: EchoServer, flow: http.HTTPFlow) -> N
         _LOGGER.error(f"Failed to register with server: {json_response.get('msg', 'Unknown error')}")
         return
     
-def _handle_ip_request(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_ip_request(echo_server: EchoServer, flow: HttpFlow) -> None:
     product_id = flow.request.query.get("product", echo_server.product_id)
     echo_server.set_product_id(int(product_id))
     _LOGGER.info(f"Robot requesting IP for product ID: {product_id}")
     
-def _handle_ip_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_ip_response(echo_server: EchoServer, flow: HttpFlow) -> None:
     _LOGGER.info(f"Robot got ips for socket connection: {flow.response.text}")
     text = flow.response.text
     
@@ -69,17 +85,31 @@ def _handle_ip_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
         host, port = parts[0], int(parts[1])
         echo_server.set_remote_server(host, port)
         
-    ip = os.environ.get("LOCAL_PROXY_IP", "192.168.0.254")
-    port = os.environ.get("ROBOT_PORT", "80")
+    ip = echo_server.config.local_proxy_ip
+    port = echo_server.config.robot_port
     
     flow.response.set_text(f"{ip}:{port}\n{ip}:{port}")
     flow.response.headers["Content-Length"] = str(len(flow.response.text))
     _LOGGER.info(f"Overriding response to: {flow.response.text}")
     
-def _handle_update_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_update_response(echo_server: EchoServer, flow: HttpFlow) -> None:
     _LOGGER.debug(f"Robot got update response: {flow.response.text}")
     
-    if os.environ.get("BLOCK_UPDATE", "true").lower() == "true":
+    images = []
+    if echo_server.update_mirror:
+        try:
+            manifest = flow.response.json()
+        except ValueError:
+            _LOGGER.error("Failed to parse JSON update response")
+            manifest = None
+        if isinstance(manifest, dict):
+            images = echo_server.update_mirror.record_manifest(manifest)
+    
+    if images and echo_server.update_mirror.approved(images):
+        _LOGGER.warning(f"Letting pinned update to version {images[0].version} through, it is served from the local mirror")
+        return
+    
+    if echo_server.config.block_update or echo_server.config.update_versions:
         with open("update.json", "w") as f:
             f.write(flow.response.text)
     
@@ -89,7 +119,40 @@ def _handle_update_response(echo_server: EchoServer, flow: http.HTTPFlow) -> Non
     
     _LOGGER.warning("Update response has not been blocked! Your robot may be updated and this could stop working!")
     
-def _handle_material_status(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_firmware_request(echo_server: EchoServer, flow: HttpFlow) -> None:
+    image = echo_server.update_mirror.lookup(flow.request.pretty_host, flow.request.path)
+    if image is None:
+        _LOGGER.warning(f"Robot requests firmware {flow.request.path}, which is not mirrored yet")
+        return
+    
+    headers = {
+        "cached": "true",
+        "Content-Type": "application/octet-stream",
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{image.sha256}"',
+    }
+    range_header = flow.request.headers.get("Range")
+    if_range = flow.request.headers.get("If-Range")
+    if if_range and if_range != headers["ETag"]:
+        range_header = None
+    
+    try:
+        byte_range = UpdateMirror.parse_range(range_header, image.size)
+    except ValueError as e:
+        _LOGGER.warning(f"Robot requested invalid firmware range: {e}")
+        flow.respond(416, b"", {"cached": "true", "Content-Range": f"bytes */{image.size}"})
+        return
+    
+    if byte_range is None:
+        _LOGGER.info(f"Serving firmware version {image.version} from local mirror")
+        flow.respond_file(200, image.path, 0, image.size, headers)
+    else:
+        start, end = byte_range
+        _LOGGER.debug(f"Serving bytes {start}-{end} of firmware version {image.version} from local mirror")
+        headers["Content-Range"] = f"bytes {start}-{end}/{image.size}"
+        flow.respond_file(206, image.path, start, end - start + 1, headers)
+    
+def _handle_material_status(echo_server: EchoServer, flow: HttpFlow) -> None:
     params = parse_qs(flow.request.text, keep_blank_values=True)
         
     data = {
@@ -115,7 +178,7 @@ def _handle_material_status(echo_server: EchoServer, flow: http.HTTPFlow) -> Non
     
     echo_server.update_local_control(data)
     
-def _handle_event_request(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_event_request(echo_server: EchoServer, flow: HttpFlow) -> None:
     params = parse_qs(flow.request.text, keep_blank_values=True)
 
     data_list = params.get('data')
@@ -139,7 +202,7 @@ def _handle_event_request(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
     
     echo_server.update_local_control(data)
     
-def _handle_sync_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:    
+def _handle_sync_response(echo_server: EchoServer, flow: HttpFlow) -> None:    
     data = json.loads(flow.response.text)
     # set mapIntv, pathIntv, statusIntv to 1
     if data.get("errno") == 0:
@@ -147,9 +210,9 @@ def _handle_sync_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
         if data.get("setting"):
             try:
                 settings = json.loads(data["setting"])
-                settings["mapIntv"] = int(os.environ.get("MAP_INTV", 1))
-                settings["pathIntv"] = int(os.environ.get("PATH_INTV", 1))
-                settings["statusIntv"] = int(os.environ.get("STATUS_INTV", 1))
+                settings["mapIntv"] = echo_server.config.map_intv
+                settings["pathIntv"] = echo_server.config.path_intv
+                settings["statusIntv"] = echo_server.config.status_intv
                 data["setting"] = json.dumps(settings)
             except json.JSONDecodeError:
                 _LOGGER.error("Failed to decode JSON settings")
@@ -160,8 +223,8 @@ def _handle_sync_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
         _LOGGER.error(f"Failed to sync with server: {data.get('errmsg', 'Unknown error')}")
         return
     
-def _get_static_file_path(flow: http.HTTPFlow) -> str | None:
-    data_path = os.environ.get("DATA_PATH", os.path.join(os.path.dirname(__file__), "data"))
+def _get_static_file_path(echo_server: EchoServer, flow: HttpFlow) -> str | None:
+    data_path = echo_server.config.data_path
     filename = flow.request.pretty_host + "/" + flow.request.path[1:]
     if not filename:
         _LOGGER.error("No filename found in request")
@@ -170,27 +233,25 @@ def _get_static_file_path(flow: http.HTTPFlow) -> str | None:
     _LOGGER.debug(f"Static file path: {os.path.join(data_path, filename)}")
     return os.path.join(data_path, filename)
     
-def _handle_static_file_request(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
+def _handle_static_file_request(echo_server: EchoServer, flow: HttpFlow) -> None:
     _LOGGER.debug(f"Robot requesting static file: {flow.request.path}")
     
-    filepath = _get_static_file_path(flow)
+    filepath = _get_static_file_path(echo_server, flow)
     
     if os.path.isfile(filepath):
         _LOGGER.debug(f"Static file cached: {filepath}")
-        f = open(filepath, "rb")
-        content = f.read()
-        flow.response = http.Response.make(
-            200, content, {"cached": "true"}
-        )
+        with open(filepath, "rb") as f:
+            content = f.read()
+        flow.respond(200, content, {"cached": "true"})
             
-def _handle_static_file_response(echo_server: EchoServer, flow: http.HTTPFlow) -> None:
-    filepath = _get_static_file_path(flow)
+def _handle_static_file_response(echo_server: EchoServer, flow: HttpFlow) -> None:
+    filepath = _get_static_file_path(echo_server, flow)
     
     if flow.response.headers.get("cached", "false") == "true":
         return
     
     _LOGGER.debug(f"Robot got static file response for file: {filepath}")
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, "w") as f:
-        f.write(flow.response.text)
+    with open(filepath, "wb") as f:
+        f.write(flow.response.content)
     _LOGGER.warning(f"Saved static file to {filepath}")
\ No newline at end of file
@@ -0,0 +1,359 @@
+from HttpFlow import HttpFlow, HttpRequest, HttpResponse, HttpHeaders
+import EchoServer
+import HttpHandler
+import threading
+import logging
+import asyncio
+import socket
+import struct
+import gzip
+import zlib
+
+_REASONS = {
+    100: "Continue", 200: "OK", 204: "No Content", 206: "Partial Content", 301: "Moved Permanently", 302: "Found",
+    304: "Not Modified", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 411: "Length Required",
+    413: "Payload Too Large", 416: "Range Not Satisfiable", 500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+# Not forwarded between robot and cloud, they only describe the connection they were sent on
+_HOP_BY_HOP = ("Connection", "Keep-Alive", "Proxy-Connection", "Transfer-Encoding", "TE", "Upgrade", "Expect")
+_MAX_HEAD_SIZE = 64 * 1024
+_MAX_BODY_SIZE = 64 * 1024 * 1024
+# From linux/netfilter_ipv4.h, not exported by the socket module
+_SO_ORIGINAL_DST = 80
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status: int = status
+
+class HttpServer:
+    """
+    Plain HTTP front end for the requests the robot sends to port 80.
+
+    Every request is passed to HttpHandler like a mitmproxy flow. If no handler
+    answers it, it is forwarded to the address the robot connected to before the
+    firewall redirected it here, like mitmproxy's transparent mode does, and the
+    response is passed to HttpHandler before it is sent back to the robot. The
+    Host header is only used for connections that were not redirected. This
+    avoids running plain HTTP through mitmproxy, which is only needed for TLS.
+
+    HttpHandler reads and writes files, so it runs in the default executor
+    instead of blocking the event loop.
+
+    The firewall rule may also redirect connections that are not HTTP, like
+    mitmproxy's raw TCP mode gets them. Connections to the robot port of the
+    proxy (the robot's echo connection) are relayed unchanged. If the first
+    request of a connection to any other host is not valid HTTP, the connection
+    is closed and the destination blocked, like TcpPacketAddon.tcp_start does.
+    """
+
+    def __init__(self, echo_server: EchoServer, host: str = "0.0.0.0", port: int = 8082, timeout: float = 30.0, blocklist=None,
+                 loggerName="HttpServer") -> None:
+        self.logger = logging.getLogger(loggerName)
+        self.echo_server: EchoServer = echo_server
+        self.host: str = host
+        self.port: int = port
+        self.timeout: float = timeout
+        self.blocklist = blocklist
+        # Bind right away so a port conflict is reported on startup
+        self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(16)
+        self.running: bool = False
+        self.loop: asyncio.AbstractEventLoop = None
+        self.server: asyncio.AbstractServer = None
+        self.logger.info(f"Server initialized on port {self.port}")
+
+    def start(self):
+        """Start the event loop of the server in a new thread"""
+        self.running = True
+        worker = threading.Thread(target=asyncio.run, args=(self._serve(),))
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        self.running = False
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._handle_client, sock=self.socket, limit=_MAX_HEAD_SIZE)
+        self.logger.info(f"Listening for robot http requests on {self.host}:{self.port}")
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        self.logger.info("Server stopped")
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")
+        destination = self._original_destination(writer)
+        config = self.echo_server.config
+        if destination == (config.local_proxy_ip, config.robot_port):
+            await self._relay(reader, writer, destination)
+            return
+
+        requests = 0
+        try:
+            while self.running:
+                try:
+                    request = await self._read_request(reader, writer)
+                except (HttpError, asyncio.TimeoutError) as e:
+                    if requests == 0 and destination and destination[0] != config.local_proxy_ip:
+                        self._block(address, destination)
+                        break
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise
+                    self.logger.warning(f"Bad request from {address}: {e}")
+                    await self._write_response(writer, HttpResponse.make(e.status, str(e)), False)
+                    break
+                if request is None:
+                    break
+                requests += 1
+
+                self.logger.debug(f"{address[0]} {request.method} {request.pretty_host}{request.path}")
+                flow = HttpFlow(request)
+                await self._handle_flow(flow, destination)
+                keep_alive = self._keep_alive(request.headers, request.http_version)
+                await self._write_response(writer, flow.response, keep_alive, head=request.method == "HEAD")
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            self.logger.exception(f"Error handling http client {address}", exc_info=e)
+        finally:
+            writer.close()
+
+    def _block(self, address: tuple, destination: tuple[str, int]):
+        """The robot sent something else than HTTP to a non-local server"""
+        self.logger.warning(f"Robot tried to connect to non-local server: {destination}")
+        if self.blocklist and self.blocklist.block(address[0], destination[0], destination[1]):
+            self.logger.warning(f"Blocked connection from {address[0]} to {destination[0]}")
+
+    async def _relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, destination: tuple[str, int]):
+        """Pass the connection through to destination unchanged"""
+        try:
+            upstream_reader, upstream_writer = await asyncio.wait_for(asyncio.open_connection(*destination), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.error(f"Failed to relay connection to {destination}: {e!r}")
+            writer.close()
+            return
+        self.logger.debug(f"Relaying connection to {destination}")
+        await asyncio.gather(self._pipe(reader, upstream_writer), self._pipe(upstream_reader, writer))
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            # Closing one direction ends the other one as well
+            writer.close()
+
+    def _original_destination(self, writer: asyncio.StreamWriter) -> tuple[str, int] | None:
+        """Address the robot connected to if the firewall redirected the connection here, None otherwise"""
+        try:
+            raw = writer.get_extra_info("socket").getsockopt(socket.SOL_IP, _SO_ORIGINAL_DST, 16)
+        except (OSError, AttributeError):
+            return None
+        port, ip = struct.unpack_from("!2xH4s", raw)
+        destination = (socket.inet_ntoa(ip), port)
+        if destination == writer.get_extra_info("sockname")[:2]:
+            # Connected to this server directly
+            return None
+        return destination
+
+    async def _handle_flow(self, flow: HttpFlow, destination: tuple[str, int] = None):
+        try:
+            await self.loop.run_in_executor(None, HttpHandler.request, self.echo_server, flow)
+        except Exception as e:
+            self.logger.exception(f"Error handling request {flow.request.path}", exc_info=e)
+
+        if flow.response is None:
+            try:
+                flow.response = await self._forward(flow.request, destination)
+            except HttpError as e:
+                self.logger.error(f"Failed to forward {flow.request.pretty_host}{flow.request.path}: {e}")
+                flow.response = HttpResponse.make(e.status, str(e))
+                return
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                self.logger.error(f"Failed to forward {flow.request.pretty_host}{flow.request.path}: {e!r}")
+                flow.response = HttpResponse.make(504 if isinstance(e, asyncio.TimeoutError) else 502, "Upstream unreachable")
+                return
+
+        try:
+            await self.loop.run_in_executor(None, HttpHandler.response, self.echo_server, flow)
+        except Exception as e:
+            self.logger.exception(f"Error handling response {flow.request.path}", exc_info=e)
+
+    async def _read_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> HttpRequest | None:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise HttpError(400, "Incomplete request head")
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(400, "Request head too large")
+
+        start_line, headers = self._parse_head(head)
+        parts = start_line.split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise HttpError(400, f"Invalid request line {start_line!r}")
+        method, target, version = parts
+
+        host, port = None, 80
+        if target.startswith("http://"):
+            # Absolute form, sent if the robot thinks it talks to a proxy
+            authority, _, path = target[len("http://"):].partition("/")
+            target = "/" + path
+            headers["Host"] = authority
+        authority = headers.get("Host", "")
+        if authority:
+            host, _, port_raw = authority.partition(":")
+            port = int(port_raw) if port_raw.isdigit() else 80
+
+        if headers.get("Expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        content = await self._read_body(reader, headers, until_eof=False)
+
+        return HttpRequest(method, target, headers, content, host, port, version)
+
+    async def _forward(self, request: HttpRequest, destination: tuple[str, int] = None) -> HttpResponse:
+        if destination is None:
+            if not request.pretty_host:
+                raise HttpError(400, "Missing Host header")
+            destination = (request.pretty_host, request.port)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*destination), self.timeout)
+        try:
+            headers = HttpHeaders(request.headers.items())
+            for name in _HOP_BY_HOP:
+                headers.pop(name)
+            # Handlers read and rewrite bodies, so ask for them uncompressed
+            headers.pop("Accept-Encoding")
+            if request.content or request.method in ("POST", "PUT", "PATCH"):
+                headers["Content-Length"] = str(len(request.content))
+            headers["Connection"] = "close"
+            writer.write(self._encode_head(f"{request.method} {request.path} HTTP/1.1", headers) + request.content)
+            await writer.drain()
+
+            while True:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+                status_line, response_headers = self._parse_head(head)
+                parts = status_line.split(" ", 2)
+                if len(parts) < 2 or not parts[1].isdigit():
+                    raise HttpError(502, f"Invalid status line {status_line!r}")
+                status = int(parts[1])
+                if not 100 <= status < 200:
+                    break
+
+            if request.method == "HEAD" or status in (204, 304):
+                content = b""
+            else:
+                content = await self._read_body(reader, response_headers, until_eof=True)
+            content = self._decode_content(content, response_headers)
+            for name in _HOP_BY_HOP:
+                response_headers.pop(name)
+            return HttpResponse(status, response_headers, content, parts[2] if len(parts) > 2 else None)
+        finally:
+            writer.close()
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: HttpHeaders, until_eof: bool) -> bytes:
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            chunks = []
+            size = 0
+            while True:
+                line = await asyncio.wait_for(reader.readuntil(b"\r\n"), self.timeout)
+                try:
+                    length = int(line.split(b";")[0].strip(), 16)
+                except ValueError:
+                    raise HttpError(400, "Invalid chunk size")
+                if length == 0:
+                    break
+                size += length
+                if size > _MAX_BODY_SIZE:
+                    raise HttpError(413, "Body too large")
+                chunks.append(await asyncio.wait_for(reader.readexactly(length), self.timeout))
+                await reader.readexactly(2)
+            # Trailers are dropped
+            while await asyncio.wait_for(reader.readuntil(b"\r\n"), self.timeout) != b"\r\n":
+                pass
+            return b"".join(chunks)
+
+        length = headers.get("Content-Length")
+        if length is not None:
+            if not length.strip().isdigit():
+                raise HttpError(400, f"Invalid Content-Length {length!r}")
+            if int(length) > _MAX_BODY_SIZE:
+                raise HttpError(413, "Body too large")
+            return await asyncio.wait_for(reader.readexactly(int(length)), self.timeout)
+
+        if until_eof:
+            content = await asyncio.wait_for(reader.read(_MAX_BODY_SIZE + 1), self.timeout)
+            if len(content) > _MAX_BODY_SIZE:
+                raise HttpError(502, "Body too large")
+            return content
+        return b""
+
+    @staticmethod
+    def _decode_content(content: bytes, headers: HttpHeaders) -> bytes:
+        encoding = headers.get("Content-Encoding", "").lower()
+        try:
+            if encoding in ("gzip", "x-gzip"):
+                content = gzip.decompress(content)
+            elif encoding == "deflate":
+                content = zlib.decompress(content)
+            else:
+                return content
+        except (OSError, zlib.error) as e:
+            raise HttpError(502, f"Invalid {encoding} body: {e}")
+        headers.pop("Content-Encoding")
+        return content
+
+    @staticmethod
+    def _parse_head(head: bytes) -> tuple[str, HttpHeaders]:
+        lines = head.decode("latin-1").split("\r\n")
+        headers = HttpHeaders()
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip()] = value.strip()
+        return lines[0], headers
+
+    @staticmethod
+    def _encode_head(start_line: str, headers: HttpHeaders) -> bytes:
+        lines = [start_line] + [f"{name}: {value}" for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1", errors="replace")
+
+    @staticmethod
+    def _keep_alive(headers: HttpHeaders, version: str) -> bool:
+        connection = headers.get("Connection", "").lower()
+        if version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    async def _write_response(self, writer: asyncio.StreamWriter, response: HttpResponse, keep_alive: bool, head: bool = False):
+        headers = response.headers
+        headers.pop("Transfer-Encoding")
+        headers["Content-Length"] = str(response.file[2] if response.file else len(response.content))
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        reason = response.reason or _REASONS.get(response.status_code, "Unknown")
+        writer.write(self._encode_head(f"HTTP/1.1 {response.status_code} {reason}", headers))
+        if head:
+            await writer.drain()
+        elif response.file:
+            await writer.drain()
+            path, offset, length = response.file
+            with open(path, "rb") as f:
+                await self.loop.sendfile(writer.transport, f, offset, length)
+        else:
+            writer.write(response.content)
+            await writer.drain()
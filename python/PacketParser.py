@@ -1,12 +1,45 @@
 import json
-from CryptoHelper import decrypt_data, encrypt_data
+from CryptoHelper import decrypt_data, encrypt_data, encrypt_data_raw
+import threading
 import random
+import struct
 import logging
-import os
 
 # Get logger for this module
 _LOGGER = logging.getLogger(__name__)
-_LOGGER.setLevel(os.environ.get('LOG_LEVEL_PACKET', 'INFO').upper())
+
+# magic bytes, type, ack length
+_FRAME_HEAD = struct.Struct(">HHH")
+# remaining size, sequence number, product id, payload size
+_FRAME_BODY = struct.Struct(">IQII")
+
+def iter_encapsulated(payload: bytes | memoryview):
+  """
+  Yield the inner messages of an encapsulated payload as memoryviews.
+  
+  An encapsulated payload starts with four zero bytes, followed by inner messages
+  that are each prefixed with their length (4 bytes, big endian). Inner messages
+  can be encapsulated again and are unpacked as well.
+  """
+  stack = [(memoryview(payload), 4)]
+  while stack:
+    view, offset = stack.pop()
+    if offset + 4 > len(view):
+      if offset < len(view):
+        _LOGGER.warning(f"Dropping {len(view) - offset} trailing bytes of encapsulated payload")
+      continue
+    
+    length = int.from_bytes(view[offset:offset + 4], byteorder='big')
+    if length == 0 or offset + 4 + length > len(view):
+      _LOGGER.warning(f"Invalid inner message length {length} at offset {offset}, dropping {len(view) - offset} bytes")
+      continue
+    
+    message = view[offset + 4:offset + 4 + length]
+    stack.append((view, offset + 4 + length))
+    if len(message) >= 4 and int.from_bytes(message[:4], byteorder='big') == 0x0000:
+      stack.append((message, 4))
+    else:
+      yield message
 
 class Server_Packet:
   
@@ -18,6 +51,8 @@ class Server_Packet:
       self.data: dict = data
       self._offset: int = 0
       self.payload_json: dict = None
+      self.encapsulated: bool = False
+      self.messages: list[dict] = []
       
       self.magic_bytes: int = self._get_bytes(2)
       if self.magic_bytes != 0x0005:
@@ -37,19 +72,18 @@ class Server_Packet:
       self.payload_size: int = self._get_bytes(4)
       
       self.payload: bytes = self._get_bytes(self.payload_size, False)
-      if int.from_bytes(self.payload[:4], byteorder='big') == 0x0000:
-        _LOGGER.error("Encapsulated packet detected. Not supported yet!")
-        raise Exception("Encapsulated packet detected. Not supported yet!")
+      self.encapsulated = len(self.payload) >= 4 and int.from_bytes(self.payload[:4], byteorder='big') == 0x0000
+      if self.encapsulated:
+        for inner in iter_encapsulated(self.payload):
+          inner_json = self._parse_payload(inner)
+          if inner_json is not None:
+            self.messages.append(inner_json)
+        _LOGGER.debug(f"Encapsulated packet with {len(self.messages)} inner messages")
+        return
 
-      try:
-        self.payload_json: dict = json.loads(self.payload.decode("utf-8"))
-        if self.payload_json.get("encrypt", 0) == 1:
-          self._decrypt()
-      except json.JSONDecodeError:
-        self.payload_json = None
-        _LOGGER.warning("Failed to decode payload as JSON")
-      except Exception as e:
-        _LOGGER.error(f"Error decrypting payload: {e}")
+      self.payload_json = self._parse_payload(self.payload)
+      if self.payload_json is not None:
+        self.messages.append(self.payload_json)
     
   def build(self, data: dict, last_seq_id: int = 0x5A61FFFFFFFFFFFF, encrypt: bool = True, product_id: int = 60008) -> bytes:
     _LOGGER.debug(f"Building packet with data: {data}")
@@ -84,27 +118,44 @@ class Server_Packet:
       _LOGGER.error("Payload not set")
       raise Exception("Payload not set")
     
-    packet = bytearray()
-    packet.extend(self.magic_bytes.to_bytes(2, byteorder='big'))
-    packet.extend(self.type.to_bytes(2, byteorder='big'))
-    packet.extend(self.len_ack.to_bytes(2, byteorder='big'))
-    packet.extend(("ack:" + str(self.ack_nr)).encode('utf-8'))
-    packet.extend(self.remaining_size.to_bytes(4, byteorder='big'))
-    packet.extend(self.seq_nr.to_bytes(8, byteorder='big'))
-    packet.extend(self.product_id.to_bytes(4, byteorder='big'))
-    packet.extend(self.payload_size.to_bytes(4, byteorder='big'))
-    packet.extend(self.payload)
+    ack = ("ack:" + str(self.ack_nr)).encode('utf-8')
+    packet = bytearray(_FRAME_HEAD.size + len(ack) + _FRAME_BODY.size + self.payload_size)
+    _FRAME_HEAD.pack_into(packet, 0, self.magic_bytes, self.type, self.len_ack)
+    packet[_FRAME_HEAD.size:_FRAME_HEAD.size + len(ack)] = ack
+    offset = _FRAME_HEAD.size + len(ack)
+    _FRAME_BODY.pack_into(packet, offset, self.remaining_size, self.seq_nr, self.product_id, self.payload_size)
+    packet[offset + _FRAME_BODY.size:] = self.payload
     
     _LOGGER.debug(f"Built packet with size: {len(packet)} bytes")
     return bytes(packet)
     
     
-  def _decrypt(self) -> None:
+  def _parse_payload(self, payload: bytes | memoryview) -> dict | None:
+    """Decode a JSON payload and decrypt its data if needed"""
+    try:
+      payload_json: dict = json.loads(bytes(payload).decode("utf-8"))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+      _LOGGER.warning("Failed to decode payload as JSON")
+      return None
+    if not isinstance(payload_json, dict):
+      _LOGGER.warning("Payload is not a JSON object")
+      return None
+    
+    if payload_json.get("encrypt", 0) == 1:
+      try:
+        self._decrypt(payload_json)
+      except Exception as e:
+        _LOGGER.error(f"Error decrypting payload: {e}")
+    return payload_json
+    
+  def _decrypt(self, payload_json: dict = None) -> None:
+    if payload_json is None:
+      payload_json = self.payload_json
     if not self._push_key:
       _LOGGER.error("Push key not set")
       raise Exception("Push key not set")
     
-    encrypted_data = self.payload_json.get("data", None)
+    encrypted_data = payload_json.get("data", None)
     if not encrypted_data:
       _LOGGER.error("No data to decrypt")
       raise Exception("No data to decrypt")
@@ -114,7 +165,7 @@ class Server_Packet:
       _LOGGER.error("Failed to decrypt data")
       raise Exception("Failed to decrypt data")
     
-    self.payload_json.update({"data": decrypted_data})
+    payload_json.update({"data": decrypted_data})
     _LOGGER.info(f"Decrypted payload data: {decrypted_data}")
     _LOGGER.debug("Successfully decrypted payload data")
     
@@ -130,4 +181,139 @@ class Server_Packet:
     return bytes_data
     
   def __str__(self) -> str:
-    return f"Ack Number: {self.ack_nr}, Sequence Number: {self.seq_nr}, Payload Size: {self.payload_size}, Payload: {self.payload}, Data: {self.payload_json}"
\ No newline at end of file
+    return f"Ack Number: {self.ack_nr}, Sequence Number: {self.seq_nr}, Payload Size: {self.payload_size}, Payload: {self.payload}, Data: {self.payload_json}"
+
+class Packet_Encoder:
+  """
+  Encodes local commands into type 0x0003 frames.
+  
+  All frames of a batch are written back to back into one reused buffer, so a
+  batch of commands can be sent to the robot with a single sendall. The returned
+  view is only valid until the next call, hold `lock` while encoding and sending.
+  """
+  
+  def __init__(self, push_key: str = None) -> None:
+    self.push_key: str = push_key
+    self.lock = threading.Lock()
+    self._buffer: bytearray = bytearray(4096)
+    
+  def encode(self, commands: list[tuple[dict, bool]], last_seq_id: int = 0x5A61FFFFFFFFFFFF, product_id: int = 60008) -> tuple[memoryview, list[int]]:
+    """Encode (data, encrypt) commands, returns the frames and their ack numbers"""
+    frames = []
+    total = 0
+    for data, encrypt in commands:
+      payload = self._encode_payload(data, encrypt)
+      ack_nr = random.randint(1000, 99999)
+      ack = b"ack:" + str(ack_nr).encode('utf-8')
+      frames.append((ack_nr, ack, payload))
+      total += _FRAME_HEAD.size + len(ack) + _FRAME_BODY.size + len(payload)
+    
+    if len(self._buffer) < total:
+      self._buffer = bytearray(max(total, 2 * len(self._buffer)))
+    buffer = self._buffer
+    
+    offset = 0
+    for ack_nr, ack, payload in frames:
+      _FRAME_HEAD.pack_into(buffer, offset, 0x0005, 0x0003, len(ack))
+      offset += _FRAME_HEAD.size
+      buffer[offset:offset + len(ack)] = ack
+      offset += len(ack)
+      seq_nr = (last_seq_id + ack_nr) & 0xFFFFFFFFFFFFFFFF
+      _FRAME_BODY.pack_into(buffer, offset, len(payload) + 16, seq_nr, product_id, len(payload))
+      offset += _FRAME_BODY.size
+      buffer[offset:offset + len(payload)] = payload
+      offset += len(payload)
+    
+    _LOGGER.debug(f"Encoded {len(frames)} frames with {total} bytes")
+    return memoryview(buffer)[:total], [ack_nr for ack_nr, _, _ in frames]
+    
+  def _encode_payload(self, data: dict, encrypt: bool) -> bytes:
+    if not encrypt:
+      return json.dumps({"data": data, "devType": 3, "encrypt": 0}).encode('utf-8')
+    
+    encrypted = encrypt_data_raw(self.push_key, data)
+    if encrypted is None:
+      # Same envelope Server_Packet.build produces when encryption fails
+      return b'{"data": null, "devType": 3, "encrypt": 1}'
+    # Base64 needs no escaping, so the envelope is not run through json.dumps again
+    return b'{"data": "' + encrypted + b'", "devType": 3, "encrypt": 1}'
+
+class Frame_Splitter:
+  """
+  Finds the ack frames (type 0x0004) in the byte stream the robot sends to the cloud.
+  
+  One read can hold several frames and end in the middle of one. Ack frames are
+  6 + ack length bytes, type 0x0003 frames announce their remaining size, so
+  both can be skipped without copying them. Frames of other types don't tell
+  their length, the rest of the read is passed on and the next read is expected
+  to start with a frame again. A frame head that is cut off is held back until
+  the rest of it arrives.
+  """
+  
+  def __init__(self) -> None:
+    # Bytes of the current frame that are still to come in the next reads
+    self.skip: int = 0
+    self.pending: bytes = b""
+    
+  def reset(self) -> None:
+    self.skip = 0
+    self.pending = b""
+    
+  def feed(self, data: bytes | memoryview, consume) -> list[memoryview]:
+    """
+    Returns the parts of data to pass on. Ack frames for which consume(ack_nr)
+    returns True are left out, everything else is passed on unchanged.
+    """
+    view = memoryview(self.pending + bytes(data)) if self.pending else memoryview(data)
+    self.pending = b""
+    parts = []
+    start = 0
+    offset = min(self.skip, len(view))
+    self.skip -= offset
+    while offset < len(view):
+      head = view[offset:offset + _FRAME_HEAD.size]
+      if len(head) < _FRAME_HEAD.size:
+        prefix = bytes(head)
+        if not b"\x00\x05".startswith(prefix[:2]) or (len(prefix) >= 4 and int.from_bytes(prefix[2:4], byteorder='big') not in (0x0003, 0x0004)):
+          break
+        self.pending = bytes(head)
+        view = view[:offset]
+        break
+      magic, frame_type, len_ack = _FRAME_HEAD.unpack(head)
+      if magic != 0x0005 or frame_type not in (0x0003, 0x0004):
+        break
+      
+      if frame_type == 0x0004:
+        end = offset + _FRAME_HEAD.size + len_ack
+        if end > len(view):
+          self.pending = bytes(view[offset:])
+          view = view[:offset]
+          break
+        ack = bytes(view[offset + _FRAME_HEAD.size:end]).decode("utf-8", errors="replace")
+        try:
+          ack_nr = int(ack.split(":")[1])
+        except (IndexError, ValueError):
+          ack_nr = None
+        if ack_nr is not None and consume(ack_nr):
+          if offset > start:
+            parts.append(view[start:offset])
+          start = end
+        offset = end
+        continue
+      
+      # Type 0x0003: the remaining size follows the ack
+      size_offset = offset + _FRAME_HEAD.size + len_ack
+      if size_offset + 4 > len(view):
+        self.pending = bytes(view[offset:])
+        view = view[:offset]
+        break
+      end = size_offset + 4 + int.from_bytes(view[size_offset:size_offset + 4], byteorder='big')
+      if end > len(view):
+        self.skip = end - len(view)
+        offset = len(view)
+        break
+      offset = end
+    
+    if start < len(view):
+      parts.append(view[start:])
+    return parts
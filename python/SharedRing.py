@@ -0,0 +1,99 @@
+import threading
+import logging
+import struct
+import mmap
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+# magic, version, slot count, slot size, sequence number of the latest message, latest slot
+_HEADER = struct.Struct("<4sHHIQI8x")
+# message length, sequence number
+_SLOT_HEADER = struct.Struct("<IQ4x")
+_MAGIC = b"CN36"
+_VERSION = 1
+
+class SharedRing:
+  """
+  Ring of fixed size slots in a memory mapped file (e.g. in /dev/shm).
+
+  The writer always fills the slot after the latest one and publishes it by
+  updating the header afterwards. Readers copy the latest message out of its
+  slot and check afterwards that the writer did not wrap around and overwrite
+  the slot in the meantime, otherwise they try again with the new latest one.
+
+  Messages are written from several threads, write holds a lock so that no
+  two of them fill the same slot under the same sequence number.
+  """
+
+  def __init__(self, path: str, slots: int = 4, slot_size: int = 1024 * 1024, create: bool = True) -> None:
+    self.path: str = path
+    self._lock = threading.Lock()
+    if create:
+      self.slots: int = slots
+      self.slot_size: int = slot_size
+      size = _HEADER.size + slots * (_SLOT_HEADER.size + slot_size)
+      fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+      try:
+        os.ftruncate(fd, size)
+        self._mmap = mmap.mmap(fd, size)
+      finally:
+        os.close(fd)
+      _HEADER.pack_into(self._mmap, 0, _MAGIC, _VERSION, slots, slot_size, 0, 0)
+      self.seq: int = 0
+      _LOGGER.info(f"Shared ring created at {path} with {slots} slots of {slot_size} bytes")
+    else:
+      fd = os.open(path, os.O_RDONLY)
+      try:
+        self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+      finally:
+        os.close(fd)
+      magic, version, self.slots, self.slot_size, self.seq, _ = _HEADER.unpack_from(self._mmap, 0)
+      if magic != _MAGIC or version != _VERSION:
+        raise Exception(f"{path} is not a shared ring (magic {magic}, version {version})")
+    self._view = memoryview(self._mmap)
+
+  @classmethod
+  def open(cls, path: str) -> "SharedRing":
+    """Open an existing ring for reading"""
+    return cls(path, create=False)
+
+  def _slot_offset(self, slot: int) -> int:
+    return _HEADER.size + slot * (_SLOT_HEADER.size + self.slot_size)
+
+  def write(self, data: bytes) -> int | None:
+    """Publish a message, returns its sequence number or None if it does not fit"""
+    if len(data) > self.slot_size:
+      _LOGGER.warning(f"Message of {len(data)} bytes does not fit into shared ring slot of {self.slot_size} bytes")
+      return None
+
+    with self._lock:
+      seq = self.seq + 1
+      slot = seq % self.slots
+      offset = self._slot_offset(slot)
+      _SLOT_HEADER.pack_into(self._mmap, offset, len(data), seq)
+      self._view[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + len(data)] = data
+      _HEADER.pack_into(self._mmap, 0, _MAGIC, _VERSION, self.slots, self.slot_size, seq, slot)
+      self.seq = seq
+    return seq
+
+  def read_latest(self, attempts: int = 3) -> tuple[int, bytes] | None:
+    """Return the sequence number and a copy of the latest message, None if there is none or the writer kept overtaking"""
+    for _ in range(attempts):
+      _, _, _, _, seq, slot = _HEADER.unpack_from(self._mmap, 0)
+      if seq == 0:
+        return None
+      offset = self._slot_offset(slot)
+      length, slot_seq = _SLOT_HEADER.unpack_from(self._mmap, offset)
+      if slot_seq != seq or length > self.slot_size:
+        # The writer is filling the slot right now
+        continue
+      data = bytes(self._view[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + length])
+      # A view would change under the caller, the copy only has to be checked once
+      if _SLOT_HEADER.unpack_from(self._mmap, offset)[1] == seq:
+        return seq, data
+    return None
+
+  def close(self) -> None:
+    self._view.release()
+    self._mmap.close()
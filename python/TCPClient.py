@@ -1,19 +1,25 @@
 import socket
 import threading
 import logging
-import os
+import time
    
 class TCPSocketClient:
-    def __init__(self, host, port, loggerName="TCPSocketClient") -> None:
+    def __init__(self, host, port, loggerName="TCPSocketClient", connectTimeout: float = 10.0) -> None:
         self.logger = logging.getLogger(loggerName)
-        self.logger.setLevel(os.environ.get(f"LOG_LEVEL_{loggerName.upper()}", 'INFO').upper())
 
         self.host: str = host
         self.port: int = port
+        self.connectTimeout: float = connectTimeout
         self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.running: bool = False
         self.data_listener = None
         self.connection_listener = None
+        self.receive_thread: threading.Thread = None
+        # time.monotonic() of the last chunk in each direction and of a send that has not returned yet
+        self.connected_at: float = None
+        self.last_received: float = None
+        self.last_sent: float = None
+        self.sending_since: float = None
         self.logger.info(f"Client initialized with target {host}:{port}")
     
     def set_data_listener(self, listener) -> None:
@@ -33,25 +39,31 @@ class TCPSocketClient:
             return False
             
         try:
+            self.sending_since = time.monotonic()
             self.socket.sendall(data)
+            self.last_sent = time.monotonic()
             self.logger.debug(f"Sent {len(data)} bytes to server")
             return True
         except Exception as e:
             self.logger.error(f"Error sending message: {e}")
-            self.disconnect()
-            
-            try:
-                self.connection_listener(False)
-            except Exception as e:
-                self.logger.error(f"Error in connection listener: {e}")
+            if self.disconnect():
+                try:
+                    self.connection_listener(False)
+                except Exception as e:
+                    self.logger.error(f"Error in connection listener: {e}")
             return False
+        finally:
+            self.sending_since = None
     
     def connect(self) -> bool:
         """Connect to the server"""
         try:
             self.logger.info(f"Connecting to {self.host}:{self.port}")
+            self.socket.settimeout(self.connectTimeout)
             self.socket.connect((self.host, self.port))
+            self.socket.settimeout(None)
             self.running = True
+            self.connected_at = time.monotonic()
             self.logger.info("Connected successfully")
             try:
                 self.connection_listener(True)
@@ -59,9 +71,9 @@ class TCPSocketClient:
                 self.logger.error(f"Error in connection listener: {e}")
             
             # Start the receiving thread
-            receive_thread = threading.Thread(target=self._receive_data)
-            receive_thread.daemon = True
-            receive_thread.start()
+            self.receive_thread = threading.Thread(target=self._receive_data)
+            self.receive_thread.daemon = True
+            self.receive_thread.start()
             return True
         except Exception as e:
             self.logger.exception(f"Connection failed", exc_info=e)
@@ -77,6 +89,7 @@ class TCPSocketClient:
                     self.logger.info("Server closed connection")
                     break
                     
+                self.last_received = time.monotonic()
                 self.logger.debug(f"Received {len(data)} bytes from server")
                 # Call listener if registered
                 self.logger.debug("Calling message listener")
@@ -92,22 +105,33 @@ class TCPSocketClient:
                 self.logger.error(f"Error receiving data: {e}")
                 break
 
-        # Only now do we tear everything down
-        self.disconnect()
-        try:
-            self.connection_listener(True)
-        except Exception as e:
-            self.logger.error(f"Error in connection listener: {e}")
+        # Only now do we tear everything down. If disconnect() was called
+        # elsewhere, whoever called it already knows about it.
+        if self.disconnect():
+            try:
+                self.connection_listener(False)
+            except Exception as e:
+                self.logger.error(f"Error in connection listener: {e}")
+    
+    def is_alive(self) -> bool:
+        """True while connected and the receive loop is still running"""
+        return self.running and self.receive_thread is not None and self.receive_thread.is_alive()
     
-    def disconnect(self) -> None:
-        """Disconnect from the server"""
+    def disconnect(self) -> bool:
+        """Disconnect from the server, returns False if it was not connected"""
         if not self.running:
-            return
+            return False
             
         self.logger.info("Disconnecting from server")
         self.running = False
+        try:
+            # Wakes up the receive loop and a blocked sendall, close() alone does not
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         try:
             self.socket.close()
             self.logger.info("Socket closed")
         except Exception as e:
-            self.logger.error(f"Error closing socket: {e}")
\ No newline at end of file
+            self.logger.error(f"Error closing socket: {e}")
+        return True
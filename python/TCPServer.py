@@ -1,18 +1,47 @@
 import socket
 import logging
 import threading
+import time
+import json
+import zlib
 import os
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec ids used in the header of compressed frames
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+# Largest message the 2 byte length of the legacy header can describe
+MAX_LEGACY_MESSAGE = 0xFFFF
+
+def _compressors() -> dict:
+    codecs = {"zlib": (COMPRESSION_ZLIB, lambda data: zlib.compress(data, 6))}
+    if zstandard is not None:
+        codecs["zstd"] = (COMPRESSION_ZSTD, zstandard.ZstdCompressor(level=3).compress)
+    return codecs
+
 class TCPSocketServer:
   
-    def __init__(self, host:str="0.0.0.0", port:int=80, includeCustomHeader:bool=False, loggerName="TCPSocketServer") -> None:
+    def __init__(self, host:str="0.0.0.0", port:int=80, includeCustomHeader:bool=False, loggerName="TCPSocketServer", unixPath:str=None, allowCompression:bool=False, compressThreshold:int=1024, negotiationTimeout:float=0.5) -> None:
         self.logger = logging.getLogger(loggerName)
-        self.logger.setLevel(os.environ.get(f"LOG_LEVEL_{loggerName.upper()}", 'INFO').upper())
         self.host: str = host
         self.port: int = port
-        self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self.host, self.port))
+        self.unixPath: str = unixPath
+        if unixPath:
+            # Same protocol on a unix domain socket for clients on this host
+            if os.path.exists(unixPath):
+                os.unlink(unixPath)
+            self.socket: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(unixPath)
+        else:
+            self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.host, self.port))
         self.socket.listen(5)
         self.running: bool = False
         self.clients: list[socket.socket] = []
@@ -20,17 +49,41 @@ class TCPSocketServer:
         self.data_listeners = []
         self.connection_listeners = []
         
+        self.fast_forward = None
+        self.fast_forward_buffer_size: int = 65536
+        
         self.includeCustomHeader: bool = includeCustomHeader
-        self.logger.info(f"Server initialized on port {self.port}")
+        
+        # Compression negotiated per client, only for the custom header protocol
+        self.allowCompression: bool = allowCompression and includeCustomHeader
+        self.compressThreshold: int = compressThreshold
+        # Connection listeners are informed once a new client negotiated compression or this many seconds passed
+        self.negotiationTimeout: float = negotiationTimeout
+        self.compressors: dict = _compressors() if self.allowCompression else {}
+        self.client_compression: dict[socket.socket, str] = {}
+        self._last_compressed: dict[str, tuple[bytes, bytes]] = {}
+        
+        # time.monotonic() of the last connection, the last chunk in each direction and of sends that have not returned yet
+        self.last_connected: float = None
+        self.last_received: float = None
+        self.last_sent: float = None
+        self.sending: dict[socket.socket, float] = {}
+        self.logger.info(f"Server initialized on {self.unixPath if self.unixPath else f'port {self.port}'}")
     
-    def add_data_listener(self, listener):
-        """When a message is received, call the listener with the message"""
-        self.data_listeners.append(listener)
+    def add_data_listener(self, listener, withClient: bool = False):
+        """When a message is received, call the listener with the message and, if withClient is set, the client socket it came from"""
+        self.data_listeners.append((listener, withClient))
         self.logger.debug("Message listener added")
         
     def add_connection_listener(self, listener):
         self.connection_listeners.append(listener)
         self.logger.debug("Connection listener added")
+        
+    def set_fast_forward(self, forward, buffer_size: int = 65536):
+        """Relay received bytes with forward(view), the data listeners only get them if forward returns False"""
+        self.fast_forward = forward
+        self.fast_forward_buffer_size = buffer_size
+        self.logger.info(f"Fast forward enabled with {buffer_size} byte buffer")
 
     def _inform_connection_listeners(self, client_socket, connected: bool):
         """Inform all connection listeners about the connection status"""
@@ -41,34 +94,177 @@ class TCPSocketServer:
                 self.logger.error(f"Error in connection listener: {e}")
                 self.logger.exception("Exception in connection listener", exc_info=True)
 
+    def _inform_data_listeners(self, client_socket, data: bytes):
+        for listener, withClient in self.data_listeners:
+            if withClient:
+                listener(data, client_socket)
+            else:
+                listener(data)
+
+    def send_to(self, client_socket, data: bytes) -> bool:
+        """Send a message to a single client, e.g. the answer to its request"""
+        if self.client_compression.get(client_socket) is None and not self._fits_legacy_frame(data):
+            self.logger.warning(f"Not sending message of {len(data)} bytes to client without compression, it does not fit into a frame")
+            return False
+        try:
+            frame = self._frame(data, self.client_compression.get(client_socket))
+            self.sending[client_socket] = time.monotonic()
+            try:
+                client_socket.sendall(frame)
+            finally:
+                self.sending.pop(client_socket, None)
+            self.last_sent = time.monotonic()
+            self.logger.debug(f"Sent {len(frame)} bytes to client")
+            return True
+        except Exception as e:
+            self.logger.error(f"Error sending to client: {e}")
+            # Its handler thread removes it and informs the listeners
+            self.drop_client(client_socket)
+            return False
+
     def send_data(self, data: bytes):
         """Send a message to all clients"""
             
         disconnected_clients = []
+        frames = {}
+        skipped = 0
         
-        if self.includeCustomHeader:
-            header = b'\x16\x16' + len(data).to_bytes(2, byteorder='big')
-            data = header + data
-            
         for client in self.clients:
             try:
-                client.sendall(data)
-                self.logger.debug(f"Sent {len(data)} bytes to client")
+                codec = self.client_compression.get(client)
+                if codec is None and not self._fits_legacy_frame(data):
+                    # Only this message is lost for the client, the connection stays usable
+                    skipped += 1
+                    continue
+                if codec not in frames:
+                    # Encode once per codec, all clients using it share the frame
+                    frames[codec] = self._frame(data, codec)
+                self.sending[client] = time.monotonic()
+                try:
+                    client.sendall(frames[codec])
+                finally:
+                    self.sending.pop(client, None)
+                self.last_sent = time.monotonic()
+                self.logger.debug(f"Sent {len(frames[codec])} bytes to client")
             except Exception as e:
                 self.logger.error(f"Error sending to client: {e}")
                 disconnected_clients.append(client)
+        
+        if skipped:
+            self.logger.warning(f"Not sending message of {len(data)} bytes to {skipped} clients without compression, it does not fit into a frame")
                 
         # Remove disconnected clients
         for client in disconnected_clients:
+            self.client_compression.pop(client, None)
             if client in self.clients:
                 self.clients.remove(client)
                 self._inform_connection_listeners(client, False)
                 self.logger.info(f"Removed disconnected client. {len(self.clients)} clients remaining")
                 
+    def _fits_legacy_frame(self, data: bytes) -> bool:
+        return not self.includeCustomHeader or len(data) <= MAX_LEGACY_MESSAGE
+    
+    def _frame(self, data: bytes, codec: str = None) -> bytes:
+        if not self.includeCustomHeader:
+            return data
+        if codec is None:
+            return b'\x16\x16' + len(data).to_bytes(2, byteorder='big') + data
+        
+        # Compressed clients get 0x1617, codec id and a 4 byte length
+        codec_id = COMPRESSION_NONE
+        if len(data) >= self.compressThreshold:
+            codec_id, compress = self.compressors[codec]
+            last = self._last_compressed.get(codec)
+            if last is not None and last[0] == data:
+                # Snapshots like the cache are often sent again unchanged
+                data = last[1]
+            else:
+                compressed = compress(data)
+                self._last_compressed[codec] = (data, compressed)
+                data = compressed
+        return b'\x16\x17' + codec_id.to_bytes(1, byteorder='big') + len(data).to_bytes(4, byteorder='big') + data
+    
+    def _negotiate_compression(self, client_socket, data: bytes) -> bool:
+        """Handle a {"compression": [codecs]} request, returns True if data was one"""
+        if not self.allowCompression or b'"compression"' not in data:
+            return False
+        try:
+            request = json.loads(data.decode("utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return False
+        if not isinstance(request, dict) or list(request.keys()) != ["compression"]:
+            return False
+        self.negotiate_compression(client_socket, request["compression"])
+        return True
+    
+    def negotiate_compression(self, client_socket, offered: list[str] | str | None):
+        """Answer a compression request, also if it arrived together with other messages"""
+        if not self.allowCompression:
+            self.logger.debug("Ignoring compression request, compression is not enabled")
+            return
+        offered = [offered] if isinstance(offered, str) else offered or []
+        codec = next((name for name in offered if name in self.compressors), None)
+        
+        # The answer still uses the old framing, everything after it the new one
+        answer = json.dumps({"origin": "proxy", "compression": codec}).encode("utf-8")
+        client_socket.sendall(self._frame(answer, self.client_compression.get(client_socket)))
+        if codec:
+            self.client_compression[client_socket] = codec
+        else:
+            self.client_compression.pop(client_socket, None)
+        self.logger.info(f"Client negotiated compression: {codec}")
+        
     def _handle_client(self, client_socket, address):
         """Handle communication with a connected client"""
+        data = self._wait_for_negotiation(client_socket, address) if self.allowCompression else None
         self._inform_connection_listeners(client_socket, True)
+        if data:
+            try:
+                self._inform_data_listeners(client_socket, data)
+            except Exception as e:
+                self.logger.error(f"Error handling client {address}: {e}")
         
+        if self.fast_forward:
+            self._relay_client(client_socket, address)
+        else:
+            self._receive_client(client_socket, address)
+                
+        # Remove client when disconnected
+        self.client_compression.pop(client_socket, None)
+        if client_socket in self.clients:
+            self._inform_connection_listeners(client_socket, False)
+            self.clients.remove(client_socket)
+            self.logger.info(f"Removed client {address}. {len(self.clients)} clients remaining")
+            
+        try:
+            client_socket.close()
+        except Exception as e:
+            self.logger.error(f"Error closing client socket: {e}")
+            
+    def _wait_for_negotiation(self, client_socket, address) -> bytes | None:
+        """
+        Give a new client negotiationTimeout seconds to ask for compression, so
+        what the connection listeners send it is already compressed. Returns the
+        first data if it was something else.
+        """
+        try:
+            client_socket.settimeout(self.negotiationTimeout)
+            try:
+                data = client_socket.recv(1024)
+            finally:
+                client_socket.settimeout(None)
+        except OSError:
+            # Timed out, or the connection failed, which the receive loop notices
+            return None
+        if data:
+            self.last_received = time.monotonic()
+            self.logger.debug(f"Received {len(data)} bytes from {address}")
+            if self._negotiate_compression(client_socket, data):
+                return None
+        return data
+    
+    def _receive_client(self, client_socket, address):
+        """Pass every received chunk to the data listeners"""
         while self.running:
             try:
                 data = client_socket.recv(1024)
@@ -76,30 +272,57 @@ class TCPSocketServer:
                     self.logger.info(f"Client {address} disconnected")
                     break
                 
+                self.last_received = time.monotonic()
                 self.logger.debug(f"Received {len(data)} bytes from {address}")
+                if self._negotiate_compression(client_socket, data):
+                    continue
                 # Call listener if registered
-                for listener in self.data_listeners:
-                    listener(data)
+                self._inform_data_listeners(client_socket, data)
                     
             except Exception as e:
                 self.logger.error(f"Error handling client {address}: {e}")
                 break
                 
-        # Remove client when disconnected
-        if client_socket in self.clients:
-            self._inform_connection_listeners(client_socket, False)
-            self.clients.remove(client_socket)
-            self.logger.info(f"Removed client {address}. {len(self.clients)} clients remaining")
-            
+    def _relay_client(self, client_socket, address):
+        """Receive into a reused buffer and relay chunks without copying them"""
+        buffer = bytearray(self.fast_forward_buffer_size)
+        view = memoryview(buffer)
+        
+        while self.running:
+            try:
+                size = client_socket.recv_into(buffer)
+                if not size:
+                    self.logger.info(f"Client {address} disconnected")
+                    break
+                
+                self.last_received = time.monotonic()
+                chunk = view[:size]
+                if self.fast_forward(chunk):
+                    continue
+                
+                self.logger.debug(f"Received {size} bytes from {address} that could not be relayed")
+                self._inform_data_listeners(client_socket, bytes(chunk))
+                    
+            except Exception as e:
+                self.logger.error(f"Error handling client {address}: {e}")
+                break
+    
+    def stuck_clients(self, timeout: float) -> list[socket.socket]:
+        """Clients a send to which has been blocked for longer than timeout seconds"""
+        now = time.monotonic()
+        return [client for client, since in list(self.sending.items()) if now - since > timeout]
+    
+    def drop_client(self, client_socket):
+        """Shut a client connection down, its handler thread cleans up and informs the listeners"""
         try:
-            client_socket.close()
-        except Exception as e:
-            self.logger.error(f"Error closing client socket: {e}")
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            self.logger.debug(f"Error shutting down client socket: {e}")
     
     def start(self):
         """Start the server in a new thread"""
         self.running = True
-        self.logger.info(f"Starting server on {self.host}:{self.port}")
+        self.logger.info(f"Starting server on {self.unixPath if self.unixPath else f'{self.host}:{self.port}'}")
         server_thread = threading.Thread(target=self._accept_connections)
         server_thread.daemon = True
         server_thread.start()
@@ -111,8 +334,9 @@ class TCPSocketServer:
         while self.running:
             try:
                 client_socket, address = self.socket.accept()
+                self.last_connected = time.monotonic()
                 self.clients.append(client_socket)
-                self.logger.info(f"New client connected from {address[0]}")
+                self.logger.info(f"New client connected from {address[0] if address else self.unixPath}")
                 
                 # Start a new thread to handle this client
                 client_thread = threading.Thread(target=self._handle_client, 
@@ -143,6 +367,8 @@ class TCPSocketServer:
         # Close server socket
         try:
             self.socket.close()
+            if self.unixPath and os.path.exists(self.unixPath):
+                os.unlink(self.unixPath)
             self.logger.info("Server socket closed")
         except Exception as e:
             self.logger.error(f"Error closing server socket: {e}")
@@ -0,0 +1,283 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import threading
+import logging
+import struct
+import time
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+# Block header on disk: name length, point count. Followed by the name, the timestamps and the values.
+_BLOCK_HEADER = struct.Struct("<HI")
+
+class TelemetrySeries:
+  """
+  Ring buffer of (timestamp, value) pairs stored in two float arrays. The arrays
+  grow with the points until capacity is reached, most metrics never get there.
+  """
+
+  def __init__(self, name: str, capacity: int) -> None:
+    self.name: str = name
+    self.capacity: int = capacity
+    self.times: array = array("d")
+    self.values: array = array("d")
+    self.start: int = 0
+    self.size: int = 0
+    self.unflushed: int = 0
+
+  def append(self, timestamp: float, value: float) -> None:
+    if self.size and timestamp < self._time(self.size - 1):
+      # Keep the buffer sorted, late samples are clamped to the newest timestamp
+      timestamp = self._time(self.size - 1)
+    if self.size < self.capacity:
+      # start stays 0 until the buffer is full
+      self.times.append(timestamp)
+      self.values.append(value)
+      self.size += 1
+    else:
+      self.times[self.start] = timestamp
+      self.values[self.start] = value
+      self.start = (self.start + 1) % self.capacity
+    self.unflushed = min(self.unflushed + 1, self.capacity)
+
+  def __len__(self) -> int:
+    return self.size
+
+  def __getitem__(self, index: int) -> float:
+    return self._time(index)
+
+  def _time(self, index: int) -> float:
+    return self.times[(self.start + index) % self.capacity]
+
+  def _value(self, index: int) -> float:
+    return self.values[(self.start + index) % self.capacity]
+
+  def tail(self, count: int) -> tuple[array, array]:
+    """Return the newest count points as two arrays"""
+    first = self.size - count
+    times = array("d", (self._time(i) for i in range(first, self.size)))
+    values = array("d", (self._value(i) for i in range(first, self.size)))
+    return times, values
+
+  def query(self, start: float = None, end: float = None, buckets: int = None) -> list:
+    """Return [timestamp, value] points in range, or [timestamp, min, max, avg, count] per bucket"""
+    lo = bisect_left(self, start) if start is not None else 0
+    hi = bisect_right(self, end) if end is not None else self.size
+    if lo >= hi:
+      return []
+
+    if not buckets:
+      return [[self._time(i), self._value(i)] for i in range(lo, hi)]
+
+    first = self._time(lo)
+    width = (self._time(hi - 1) - first) / buckets or 1.0
+    result = []
+    current = None
+    for i in range(lo, hi):
+      bucket = min(int((self._time(i) - first) / width), buckets - 1)
+      value = self._value(i)
+      if current is None or current[0] != bucket:
+        if current is not None:
+          result.append(self._finish_bucket(current, first, width))
+        current = [bucket, value, value, 0.0, 0]
+      current[1] = min(current[1], value)
+      current[2] = max(current[2], value)
+      current[3] += value
+      current[4] += 1
+    result.append(self._finish_bucket(current, first, width))
+    return result
+
+  @staticmethod
+  def _finish_bucket(bucket: list, first: float, width: float) -> list:
+    return [first + bucket[0] * width, bucket[1], bucket[2], bucket[3] / bucket[4], bucket[4]]
+
+class TelemetryStore:
+  """
+  History of numeric values seen in robot and cloud payloads.
+
+  Nested keys are flattened with dots ("materialStatus.percent.filter"). Points are
+  kept in memory per metric and appended to a binary file in batches.
+  """
+
+  def __init__(self, path: str, capacity: int = 10000, max_metrics: int = 256, flush_interval: float = 60.0, max_file_size: int = 16 * 1024 * 1024) -> None:
+    self.path: str = path
+    self.capacity: int = capacity
+    self.max_metrics: int = max_metrics
+    self.flush_interval: float = flush_interval
+    self.max_file_size: int = max_file_size
+    self.series: dict[str, TelemetrySeries] = {}
+    self._lock = threading.Lock()
+    self.running: bool = False
+    self._load()
+
+  def start(self) -> None:
+    """Start the flush worker in a new thread"""
+    self.running = True
+    worker = threading.Thread(target=self._run)
+    worker.daemon = True
+    worker.start()
+    _LOGGER.info(f"Telemetry store started with {len(self.series)} metrics from {self.path}")
+
+  def stop(self) -> None:
+    self.running = False
+    self.flush()
+
+  def record(self, data: dict, timestamp: float = None) -> int:
+    """Record all numeric values of a payload, returns the number of points added"""
+    if not isinstance(data, dict):
+      return 0
+    timestamp = time.time() if timestamp is None else timestamp
+    points = []
+    self._flatten(data, "", points, 0)
+    with self._lock:
+      added = 0
+      for name, value in points:
+        series = self.series.get(name)
+        if series is None:
+          if len(self.series) >= self.max_metrics:
+            continue
+          series = self.series[name] = TelemetrySeries(name, self.capacity)
+        series.append(timestamp, value)
+        added += 1
+    return added
+
+  def metrics(self) -> list[str]:
+    return sorted(self.series.keys())
+
+  def query(self, metric: str, start: float = None, end: float = None, buckets: int = None) -> list:
+    with self._lock:
+      series = self.series.get(metric)
+      if series is None:
+        return []
+      return series.query(start, end, buckets)
+
+  def handle_query(self, request: dict) -> dict:
+    """Answer a telemetry request from local control, invalid requests are answered with an error"""
+    metric = request.get("metric")
+    if not metric:
+      return {"metrics": self.metrics()}
+
+    start = request.get("start")
+    end = request.get("end")
+    buckets = request.get("buckets")
+    error = None
+    if not isinstance(metric, str):
+      error = "metric must be a string"
+    elif not all(self._is_number(value) for value in (start, end) if value is not None):
+      error = "start and end must be unix timestamps"
+    elif start is not None and end is not None and start > end:
+      error = "start must not be after end"
+    elif buckets is not None and (not isinstance(buckets, int) or isinstance(buckets, bool) or buckets <= 0):
+      error = "buckets must be a positive integer"
+    if error:
+      return {"metric": metric, "error": error}
+
+    return {
+      "metric": metric,
+      "start": start,
+      "end": end,
+      "buckets": buckets,
+      "points": self.query(metric, start, end, buckets),
+    }
+
+  def flush(self) -> int:
+    """Append all unflushed points to disk"""
+    blocks = []
+    with self._lock:
+      for series in self.series.values():
+        if series.unflushed:
+          blocks.append((series.name, *series.tail(series.unflushed)))
+          series.unflushed = 0
+    if not blocks:
+      return 0
+
+    try:
+      os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+      with open(self.path, "ab") as f:
+        for name, times, values in blocks:
+          self._write_block(f, name, times, values)
+      if os.path.getsize(self.path) > self.max_file_size:
+        self._compact()
+    except Exception as e:
+      _LOGGER.error(f"Error writing telemetry to {self.path}: {e}")
+      return 0
+
+    points = sum(len(times) for _, times, _ in blocks)
+    _LOGGER.debug(f"Flushed {points} telemetry points for {len(blocks)} metrics")
+    return points
+
+  def _run(self) -> None:
+    while self.running:
+      time.sleep(self.flush_interval)
+      self.flush()
+
+  @staticmethod
+  def _is_number(value) -> bool:
+    # bool is an int as well, but flags are no measurements
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+  def _flatten(self, data: dict, prefix: str, points: list, depth: int) -> None:
+    if depth > 4:
+      return
+    for key, value in data.items():
+      name = f"{prefix}{key}"
+      if self._is_number(value):
+        points.append((name, float(value)))
+      elif isinstance(value, dict):
+        self._flatten(value, name + ".", points, depth + 1)
+
+  @staticmethod
+  def _write_block(f, name: str, times: array, values: array) -> None:
+    name_raw = name.encode("utf-8")
+    f.write(_BLOCK_HEADER.pack(len(name_raw), len(times)))
+    f.write(name_raw)
+    f.write(times.tobytes())
+    f.write(values.tobytes())
+
+  def _compact(self) -> None:
+    """Rewrite the file with only the points that are still held in memory"""
+    tmp_path = self.path + ".tmp"
+    with self._lock:
+      with open(tmp_path, "wb") as f:
+        for series in self.series.values():
+          if series.size:
+            self._write_block(f, series.name, *series.tail(series.size))
+    os.replace(tmp_path, self.path)
+    _LOGGER.info(f"Compacted telemetry file {self.path}")
+
+  def _load(self) -> None:
+    try:
+      with open(self.path, "rb") as f:
+        raw = f.read()
+    except FileNotFoundError:
+      return
+    except Exception as e:
+      _LOGGER.error(f"Error loading telemetry from {self.path}: {e}")
+      return
+
+    offset = 0
+    while offset + _BLOCK_HEADER.size <= len(raw):
+      name_len, count = _BLOCK_HEADER.unpack_from(raw, offset)
+      offset += _BLOCK_HEADER.size
+      end = offset + name_len + 16 * count
+      if end > len(raw):
+        _LOGGER.warning(f"Truncated telemetry block in {self.path}, ignoring the rest")
+        break
+      name = raw[offset:offset + name_len].decode("utf-8")
+      offset += name_len
+      times = array("d", raw[offset:offset + 8 * count])
+      offset += 8 * count
+      values = array("d", raw[offset:offset + 8 * count])
+      offset += 8 * count
+
+      series = self.series.get(name)
+      if series is None:
+        if len(self.series) >= self.max_metrics:
+          continue
+        series = self.series[name] = TelemetrySeries(name, self.capacity)
+      for timestamp, value in zip(times, values):
+        series.append(timestamp, value)
+
+    for series in self.series.values():
+      series.unflushed = 0
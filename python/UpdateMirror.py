@@ -0,0 +1,339 @@
+from urllib.parse import urlsplit
+import urllib.request
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+import re
+
+_LOGGER = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 1024 * 1024
+_HEX_MD5 = re.compile(r"^[0-9a-fA-F]{32}$")
+_HEX_SHA256 = re.compile(r"^[0-9a-fA-F]{64}$")
+_VERSION_KEYS = ("version", "newversion", "versionname", "ver", "romversion")
+_SIZE_KEYS = ("size", "filesize", "packagesize", "length")
+
+class FirmwareImage:
+  """A firmware file announced in an update manifest and its local copy"""
+
+  def __init__(self, url: str, version: str = None, md5: str = None, sha256: str = None, size: int = None, path: str = None, verified: bool = False) -> None:
+    self.url: str = url
+    self.version: str = version
+    self.md5: str = md5.lower() if md5 else None
+    self.sha256: str = sha256.lower() if sha256 else None
+    self.size: int = size
+    self.path: str = path
+    self.verified: bool = verified
+
+  @property
+  def key(self) -> str:
+    """Host and path (with query) the robot requests the image with"""
+    url = urlsplit(self.url)
+    return url.hostname + (url.path or "/") + (f"?{url.query}" if url.query else "")
+
+  def to_dict(self) -> dict:
+    return {
+      "url": self.url,
+      "version": self.version,
+      "md5": self.md5,
+      "sha256": self.sha256,
+      "size": self.size,
+      "path": self.path,
+      "verified": self.verified,
+    }
+
+class UpdateMirror:
+  """
+  Local copy of the firmware images offered by the update server.
+
+  Every distinct update manifest is saved, the last max_manifests are kept.
+  Images of pinned versions, or of every version if mirror_all is set, are
+  downloaded once in the background, checked against the checksums of the
+  manifest and then served to the robot from disk. An update is only let
+  through if its version is pinned in versions and all of its images are
+  verified.
+  """
+
+  def __init__(self, path: str, versions: list[str] = None, mirror_all: bool = False, max_manifests: int = 50, timeout: float = 60.0, retries: int = 3) -> None:
+    self.path: str = path
+    self.versions: list[str] = versions or []
+    self.mirror_all: bool = mirror_all
+    self.max_manifests: int = max_manifests
+    self.timeout: float = timeout
+    self.retries: int = retries
+    self.images: dict[str, FirmwareImage] = {}
+    self._queue: list[FirmwareImage] = []
+    self._lock = threading.Lock()
+    self._wakeup = threading.Event()
+    self.running: bool = False
+    self._load()
+
+  def start(self) -> None:
+    """Start the download worker in a new thread, images queued before are downloaded right away"""
+    self.running = True
+    if self._queue:
+      self._wakeup.set()
+    worker = threading.Thread(target=self._run)
+    worker.daemon = True
+    worker.start()
+    _LOGGER.info(f"Update mirror started with {sum(image.verified for image in self.images.values())} verified images and {len(self._queue)} queued in {self.path}")
+
+  def stop(self) -> None:
+    self.running = False
+    self._wakeup.set()
+
+  def configure(self, versions: list[str], mirror_all: bool) -> None:
+    """Change the pinned versions at runtime, known images that are wanted now are queued"""
+    with self._lock:
+      self.versions = versions
+      self.mirror_all = mirror_all
+      queued = self._queue_wanted(self.images.values())
+    if queued:
+      _LOGGER.info(f"Queued {queued} known images for download")
+      self._wakeup.set()
+
+  def wanted(self, image: FirmwareImage) -> bool:
+    """Images are only downloaded if their version is pinned or everything is mirrored"""
+    return self.mirror_all or image.version in self.versions
+
+  def _queue_wanted(self, images) -> int:
+    queued = 0
+    for image in images:
+      if not image.verified and self.wanted(image) and all(queued_image.key != image.key for queued_image in self._queue):
+        self._queue.append(image)
+        queued += 1
+    return queued
+
+  def record_manifest(self, manifest: dict) -> list[FirmwareImage]:
+    """Save a manifest and queue the wanted images in it for download, returns the images"""
+    self._save_manifest(manifest)
+
+    found = []
+    self._find_images(manifest, None, found, 0)
+    images = []
+    with self._lock:
+      for image in found:
+        known = self.images.get(image.key)
+        if known is not None and known.url == image.url and self._same_checksums(known, image):
+          images.append(known)
+          continue
+        self.images[image.key] = image
+        images.append(image)
+      queued = self._queue_wanted(images)
+    if queued:
+      self._wakeup.set()
+
+    for image in images:
+      state = "mirrored" if image.verified else "queued for download" if self.wanted(image) else "not pinned"
+      _LOGGER.info(f"Update manifest offers version {image.version} at {image.url} ({state})")
+    return images
+
+  def _save_manifest(self, manifest: dict) -> None:
+    """Save a manifest unless the same one was saved before, and remove the oldest ones over max_manifests"""
+    raw = json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True)
+    digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+    directory = os.path.join(self.path, "manifests")
+    try:
+      os.makedirs(directory, exist_ok=True)
+      names = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+      if any(name.endswith(f"-{digest}.json") for name in names):
+        # The robot asks for updates regularly and mostly gets the same answer
+        return
+      # Nanoseconds, so that sorting by name keeps the order even for several manifests per second
+      name = f"{time.time_ns()}-{digest}.json"
+      with open(os.path.join(directory, name), "w") as f:
+        f.write(raw)
+      names.append(name)
+      for old in names[:max(len(names) - self.max_manifests, 0)]:
+        os.remove(os.path.join(directory, old))
+    except Exception as e:
+      _LOGGER.error(f"Error saving update manifest: {e}")
+
+  def approved(self, images: list[FirmwareImage]) -> bool:
+    """True if the images belong to a pinned version and are all available locally"""
+    return bool(images) and all(image.verified and image.version in self.versions for image in images)
+
+  def lookup(self, host: str, path: str) -> FirmwareImage | None:
+    """Return the verified image the robot is requesting, if there is one"""
+    image = self.images.get(host + path)
+    if image is not None and image.verified and os.path.isfile(image.path):
+      return image
+    return None
+
+  def is_firmware(self, host: str, path: str) -> bool:
+    return host + path in self.images
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "images": len(self.images),
+        "verified": sum(image.verified for image in self.images.values()),
+        "queued": len(self._queue),
+        "versions": self.versions,
+      }
+
+  @staticmethod
+  def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse a single "bytes=start-end" range into inclusive offsets. Returns None
+    if the whole file should be sent, raises ValueError if the range cannot be
+    satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+      return None
+    start_raw, sep, end_raw = header[len("bytes="):].strip().partition("-")
+    if not sep:
+      return None
+    try:
+      if not start_raw:
+        # Suffix range: the last n bytes
+        length = int(end_raw)
+        if length <= 0:
+          raise ValueError(f"Empty suffix range {header}")
+        return max(size - length, 0), size - 1
+      start = int(start_raw)
+      end = int(end_raw) if end_raw else size - 1
+    except ValueError:
+      raise ValueError(f"Invalid range {header}")
+    if start >= size or end < start:
+      raise ValueError(f"Range {header} not satisfiable for {size} bytes")
+    return start, min(end, size - 1)
+
+  def _run(self) -> None:
+    while self.running:
+      self._wakeup.wait()
+      self._wakeup.clear()
+      while self.running:
+        with self._lock:
+          if not self._queue:
+            break
+          image = self._queue.pop(0)
+        if image.verified:
+          # Queued again by a manifest while it was downloaded
+          continue
+        for attempt in range(1, self.retries + 1):
+          try:
+            if self._download(image):
+              break
+          except Exception as e:
+            _LOGGER.error(f"Error downloading {image.url} (attempt {attempt}/{self.retries}): {e}")
+          if attempt < self.retries:
+            time.sleep(min(60, 5 * attempt))
+        self._save()
+
+  def _download(self, image: FirmwareImage) -> bool:
+    """Download an image into a .part file, resuming it if possible, and verify it"""
+    name = os.path.basename(urlsplit(image.url).path) or "firmware.bin"
+    directory = os.path.join(self.path, "images", image.sha256 or image.md5)
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, name)
+    part = target + ".part"
+
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    offset = 0
+    if os.path.isfile(part):
+      with open(part, "rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+          md5.update(chunk)
+          sha256.update(chunk)
+          offset += len(chunk)
+
+    request = urllib.request.Request(image.url)
+    if offset:
+      request.add_header("Range", f"bytes={offset}-")
+    _LOGGER.info(f"Downloading {image.url}" + (f" from byte {offset}" if offset else ""))
+    with urllib.request.urlopen(request, timeout=self.timeout) as response:
+      if offset and response.status != 206:
+        # Server ignored the range, start over
+        offset = 0
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+      with open(part, "ab" if offset else "wb") as f:
+        while chunk := response.read(_CHUNK_SIZE):
+          f.write(chunk)
+          md5.update(chunk)
+          sha256.update(chunk)
+          offset += len(chunk)
+
+    if image.size is not None and offset != image.size:
+      _LOGGER.error(f"Size of {image.url} is {offset} bytes, manifest says {image.size}")
+      os.remove(part)
+      return False
+    if (image.md5 and md5.hexdigest() != image.md5) or (image.sha256 and sha256.hexdigest() != image.sha256):
+      _LOGGER.error(f"Checksum mismatch for {image.url}, discarding download")
+      os.remove(part)
+      return False
+
+    os.replace(part, target)
+    with self._lock:
+      image.path = target
+      image.size = offset
+      image.md5 = md5.hexdigest()
+      image.sha256 = sha256.hexdigest()
+      image.verified = True
+    _LOGGER.info(f"Mirrored version {image.version} ({offset} bytes) to {target}")
+    return True
+
+  def _find_images(self, data, version: str, found: list[FirmwareImage], depth: int) -> None:
+    if depth > 6:
+      return
+    if isinstance(data, list):
+      for item in data:
+        self._find_images(item, version, found, depth + 1)
+      return
+    if not isinstance(data, dict):
+      return
+
+    fields = {key.lower(): value for key, value in data.items() if isinstance(key, str)}
+    version = next((str(fields[key]) for key in _VERSION_KEYS if fields.get(key) not in (None, "")), version)
+    md5 = next((value for key, value in fields.items() if "md5" in key and isinstance(value, str) and _HEX_MD5.match(value)), None)
+    sha256 = next((value for key, value in fields.items() if "sha" in key and isinstance(value, str) and _HEX_SHA256.match(value)), None)
+    size = next((int(fields[key]) for key in _SIZE_KEYS if str(fields.get(key, "")).isdigit()), None)
+
+    for value in data.values():
+      if isinstance(value, str) and value.startswith(("http://", "https://")) and "." in urlsplit(value).path.split("/")[-1]:
+        # Only files with a checksum next to them can be verified, other links are left alone
+        if md5 or sha256:
+          found.append(FirmwareImage(value, version, md5, sha256, size))
+        else:
+          _LOGGER.debug(f"Not mirroring {value}, manifest has no checksum for it")
+      elif isinstance(value, (dict, list)):
+        self._find_images(value, version, found, depth + 1)
+
+  @staticmethod
+  def _same_checksums(known: FirmwareImage, image: FirmwareImage) -> bool:
+    return (not image.md5 or image.md5 == known.md5) and (not image.sha256 or image.sha256 == known.sha256)
+
+  def _save(self) -> None:
+    with self._lock:
+      index = [image.to_dict() for image in self.images.values()]
+    try:
+      os.makedirs(self.path, exist_ok=True)
+      tmp_path = os.path.join(self.path, "index.json.tmp")
+      with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+      os.replace(tmp_path, os.path.join(self.path, "index.json"))
+    except Exception as e:
+      _LOGGER.error(f"Error saving update mirror index: {e}")
+
+  def _load(self) -> None:
+    try:
+      with open(os.path.join(self.path, "index.json"), "r") as f:
+        index = json.load(f)
+    except FileNotFoundError:
+      return
+    except Exception as e:
+      _LOGGER.error(f"Error loading update mirror index: {e}")
+      return
+
+    for entry in index:
+      image = FirmwareImage(**entry)
+      if image.verified and not (image.path and os.path.isfile(image.path)):
+        image.verified = False
+      self.images[image.key] = image
+    # Downloads that were interrupted by a restart or failed are tried again
+    self._queue_wanted(self.images.values())
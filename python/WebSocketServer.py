@@ -0,0 +1,419 @@
+import threading
+import logging
+import hashlib
+import base64
+import socket
+import struct
+import json
+import time
+import zlib
+
+_WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+class WebSocketClient:
+    """A connected websocket client and its topic subscriptions"""
+
+    def __init__(self, sock: socket.socket, address, deflate: bool, buffer: bytes = b"") -> None:
+        self.socket: socket.socket = sock
+        self.address = address
+        self.deflate: bool = deflate
+        # Received but not yet parsed, e.g. frames sent right behind the handshake
+        self.buffer: bytearray = bytearray(buffer)
+        self.topics: set[str] | None = None
+        self.lock = threading.Lock()
+        # time.monotonic() when the running send started, None while idle
+        self.sending_since: float | None = None
+        # Clients may keep their compression context, so we need one decompressor per connection
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS) if deflate else None
+
+    def wants(self, topics: list[str]) -> bool:
+        return self.topics is None or any(topic in self.topics for topic in topics)
+
+    def send_frame(self, frame: bytes) -> None:
+        with self.lock:
+            self.sending_since = time.monotonic()
+            try:
+                self.socket.sendall(frame)
+            finally:
+                self.sending_since = None
+
+class WebSocketServer:
+    """
+    WebSocket and HTTP endpoint for local control.
+
+    Websocket clients receive the same JSON messages as the TCP clients and can
+    send the same commands. They can limit the messages they get by sending
+    {"subscribe": [topics]} / {"unsubscribe": [topics]}. Plain HTTP GET requests
+    to /state and /state/<key> return the current state.
+
+    Frames larger than maxFrameSize and messages larger than maxMessageSize,
+    after decompression, close the connection with 1009, unmasked frames with 1002.
+
+    Browsers send the Origin of the page with every request and let any page
+    open websockets to other hosts. Requests with an Origin that is not in
+    allowedOrigins are rejected, so a website cannot control the robot.
+    Requests without Origin don't come from a browser and are accepted.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 4469, compressThreshold: int = 1024, maxFrameSize: int = 1024 * 1024,
+                 maxMessageSize: int = 4 * 1024 * 1024, allowedOrigins: list[str] = None, loggerName="WebSocketServer") -> None:
+        self.logger = logging.getLogger(loggerName)
+        self.host: str = host
+        self.port: int = port
+        self.compressThreshold: int = compressThreshold
+        self.maxFrameSize: int = maxFrameSize
+        self.maxMessageSize: int = maxMessageSize
+        self.allowedOrigins: list[str] = allowedOrigins or []
+        self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(5)
+        self.running: bool = False
+        self.clients: list[WebSocketClient] = []
+
+        self.data_listeners = []
+        self.connection_listeners = []
+        self.state_provider = None
+        self.health_provider = None
+        self.logger.info(f"Server initialized on port {self.port}")
+
+    def add_data_listener(self, listener, withClient: bool = False):
+        """When a command is received, call the listener with the message and, if withClient is set, the client it came from"""
+        self.data_listeners.append((listener, withClient))
+
+    def add_connection_listener(self, listener):
+        self.connection_listeners.append(listener)
+
+    def set_state_provider(self, provider):
+        """provider() returns the state dict served at /state"""
+        self.state_provider = provider
+
+    def set_health_provider(self, provider):
+        """provider(kind) returns (healthy, body) for /health/live, /health/ready and /health"""
+        self.health_provider = provider
+
+    def _inform_connection_listeners(self, client, connected: bool):
+        for listener in self.connection_listeners:
+            try:
+                listener(client, connected)
+            except Exception as e:
+                self.logger.exception("Exception in connection listener", exc_info=e)
+
+    def send_data(self, data: bytes, topics: list[str] = None):
+        """Send a message to all clients subscribed to one of the topics"""
+        receivers = [client for client in self.clients if topics is None or client.wants(topics)]
+        if not receivers:
+            return
+
+        # Frames are encoded and compressed once and shared by all receivers
+        plain = None
+        compressed = None
+        disconnected_clients = []
+        for client in receivers:
+            if client.deflate and len(data) >= self.compressThreshold:
+                if compressed is None:
+                    compressed = self._encode_frame(OP_TEXT, self._deflate(data), compressed=True)
+                frame = compressed
+            else:
+                if plain is None:
+                    plain = self._encode_frame(OP_TEXT, data)
+                frame = plain
+            try:
+                client.send_frame(frame)
+            except Exception as e:
+                self.logger.error(f"Error sending to client: {e}")
+                disconnected_clients.append(client)
+
+        for client in disconnected_clients:
+            self._remove_client(client)
+
+    def send_to(self, client: WebSocketClient, data: bytes) -> bool:
+        """Send a message to a single client regardless of its subscriptions, e.g. the answer to its request"""
+        if client.deflate and len(data) >= self.compressThreshold:
+            frame = self._encode_frame(OP_TEXT, self._deflate(data), compressed=True)
+        else:
+            frame = self._encode_frame(OP_TEXT, data)
+        try:
+            client.send_frame(frame)
+            return True
+        except Exception as e:
+            self.logger.error(f"Error sending to client: {e}")
+            self._remove_client(client)
+            return False
+
+    @staticmethod
+    def _deflate(data: bytes) -> bytes:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        # RFC 7692: the trailing empty block is removed from each message
+        return compressed[:-4]
+
+    @staticmethod
+    def _encode_frame(opcode: int, payload: bytes, compressed: bool = False) -> bytes:
+        first = 0x80 | opcode | (0x40 if compressed else 0)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", first, length)
+        elif length < 0x10000:
+            header = struct.pack("!BBH", first, 126, length)
+        else:
+            header = struct.pack("!BBQ", first, 127, length)
+        return header + payload
+
+    def _remove_client(self, client: WebSocketClient):
+        if client in self.clients:
+            self.clients.remove(client)
+            self._inform_connection_listeners(client, False)
+            self.logger.info(f"Removed client {client.address}. {len(self.clients)} clients remaining")
+        try:
+            client.socket.close()
+        except Exception as e:
+            self.logger.error(f"Error closing client socket: {e}")
+
+    def stuck_clients(self, timeout: float) -> list[WebSocketClient]:
+        """Clients a send to which has been blocked for longer than timeout seconds"""
+        now = time.monotonic()
+        return [client for client in list(self.clients) if client.sending_since is not None and now - client.sending_since > timeout]
+
+    def drop_client(self, client: WebSocketClient):
+        """Shut a client connection down, its handler thread cleans up and informs the listeners"""
+        try:
+            client.socket.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            self.logger.debug(f"Error shutting down client socket: {e}")
+
+    def _read_request(self, client_socket) -> tuple[str, str, dict, bytes] | None:
+        """Read the HTTP request line and headers, returns the bytes received after them as well"""
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = client_socket.recv(4096)
+            if not chunk or len(data) > 65536:
+                return None
+            data += chunk
+        head, rest = data.split(b"\r\n\r\n", 1)
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) < 2:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        return parts[0], parts[1], headers, rest
+
+    def _send_http(self, client_socket, status: int, body: dict):
+        reasons = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+        payload = json.dumps(body).encode("utf-8")
+        header = (
+            f"HTTP/1.1 {status} {reasons.get(status, 'Error')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1")
+        client_socket.sendall(header + payload)
+
+    def _origin_allowed(self, origin: str | None) -> bool:
+        if origin is None:
+            return True
+        origin = origin.rstrip("/").lower()
+        return any(allowed == "*" or allowed.rstrip("/").lower() == origin for allowed in self.allowedOrigins)
+
+    def _handle_http(self, client_socket, method: str, path: str):
+        path = path.split("?", 1)[0].rstrip("/")
+        if method != "GET":
+            self._send_http(client_socket, 405, {"error": "Only GET is supported"})
+        elif path == "/state" or path.startswith("/state/"):
+            state = self.state_provider() if self.state_provider else {}
+            key = path[len("/state/"):] if path.startswith("/state/") else None
+            if key is None:
+                self._send_http(client_socket, 200, state)
+            elif key in state.get("cache", {}):
+                self._send_http(client_socket, 200, {key: state["cache"][key]})
+            else:
+                self._send_http(client_socket, 404, {"error": f"Unknown key {key}"})
+        elif path in ("/health", "/health/live", "/health/ready") and self.health_provider:
+            healthy, body = self.health_provider(path[len("/health/"):] if path != "/health" else "report")
+            self._send_http(client_socket, 200 if healthy else 503, body)
+        else:
+            self._send_http(client_socket, 404, {"error": f"Unknown path {path}"})
+
+    def _handle_client(self, client_socket, address):
+        try:
+            request = self._read_request(client_socket)
+            if request is None:
+                client_socket.close()
+                return
+            method, path, headers, rest = request
+
+            if not self._origin_allowed(headers.get("origin")):
+                self.logger.warning(f"Rejecting request from {address[0]} with origin {headers.get('origin')!r}")
+                self._send_http(client_socket, 403, {"error": "Origin not allowed"})
+                client_socket.close()
+                return
+
+            if headers.get("upgrade", "").lower() != "websocket":
+                self._handle_http(client_socket, method, path)
+                client_socket.close()
+                return
+
+            key = headers.get("sec-websocket-key")
+            if not key:
+                self._send_http(client_socket, 400, {"error": "Missing Sec-WebSocket-Key"})
+                client_socket.close()
+                return
+
+            accept = base64.b64encode(hashlib.sha1(key.encode("latin-1") + _WS_GUID).digest()).decode("latin-1")
+            deflate = "permessage-deflate" in headers.get("sec-websocket-extensions", "")
+            response = (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n"
+            )
+            if deflate:
+                response += "Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover\r\n"
+            client_socket.sendall((response + "\r\n").encode("latin-1"))
+        except Exception as e:
+            self.logger.error(f"Error handling request from {address}: {e}")
+            client_socket.close()
+            return
+
+        client = WebSocketClient(client_socket, address, deflate, rest)
+        self.clients.append(client)
+        self.logger.info(f"Websocket client connected from {address[0]}{' with compression' if deflate else ''}")
+        self._inform_connection_listeners(client, True)
+
+        try:
+            self._receive_messages(client)
+        except Exception as e:
+            self.logger.error(f"Error handling client {address}: {e}")
+        self._remove_client(client)
+
+    def _recv_exact(self, client: WebSocketClient, length: int) -> bytes:
+        data = client.buffer[:length]
+        del client.buffer[:length]
+        while len(data) < length:
+            chunk = client.socket.recv(min(length - len(data), 65536))
+            if not chunk:
+                raise ConnectionError("Client closed connection")
+            data.extend(chunk)
+        return bytes(data)
+
+    def _close(self, client: WebSocketClient, code: int, reason: str):
+        self.logger.warning(f"Closing connection to {client.address}: {reason}")
+        client.send_frame(self._encode_frame(OP_CLOSE, struct.pack("!H", code) + reason.encode("utf-8")[:120]))
+
+    def _receive_messages(self, client: WebSocketClient):
+        message = bytearray()
+        message_compressed = False
+        while self.running:
+            first, second = self._recv_exact(client, 2)
+            fin = first & 0x80
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self._recv_exact(client, 2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self._recv_exact(client, 8))[0]
+            if length > self.maxFrameSize:
+                self._close(client, CLOSE_TOO_BIG, f"Frame of {length} bytes exceeds {self.maxFrameSize} bytes")
+                return
+            if opcode < OP_CLOSE and (len(message) if opcode == OP_CONTINUATION else 0) + length > self.maxMessageSize:
+                self._close(client, CLOSE_TOO_BIG, f"Message exceeds {self.maxMessageSize} bytes")
+                return
+            if not second & 0x80:
+                # RFC 6455 5.1: clients must mask every frame
+                self._close(client, CLOSE_PROTOCOL_ERROR, "Unmasked frame")
+                return
+            mask = self._recv_exact(client, 4)
+            payload = self._recv_exact(client, length)
+            if length:
+                key = (mask * (length // 4 + 1))[:length]
+                payload = (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+            if opcode == OP_CLOSE:
+                client.send_frame(self._encode_frame(OP_CLOSE, payload[:2]))
+                return
+            if opcode == OP_PING:
+                client.send_frame(self._encode_frame(OP_PONG, payload))
+                continue
+            if opcode == OP_PONG:
+                continue
+
+            if opcode != OP_CONTINUATION:
+                message_compressed = bool(first & 0x40)
+                message.clear()
+            message.extend(payload)
+            if not fin:
+                continue
+
+            data = bytes(message)
+            message.clear()
+            if message_compressed and client.inflater:
+                # Stop inflating as soon as the limit is exceeded, a few KB can expand to gigabytes
+                data = client.inflater.decompress(data + b"\x00\x00\xff\xff", self.maxMessageSize + 1)
+                if len(data) > self.maxMessageSize:
+                    self._close(client, CLOSE_TOO_BIG, f"Decompressed message exceeds {self.maxMessageSize} bytes")
+                    return
+            self._handle_message(client, data)
+
+    def _handle_message(self, client: WebSocketClient, data: bytes):
+        try:
+            request = json.loads(data.decode("utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            request = None
+
+        if isinstance(request, dict) and ("subscribe" in request or "unsubscribe" in request):
+            if "subscribe" in request:
+                client.topics = (client.topics or set()) | set(request["subscribe"])
+            if "unsubscribe" in request and client.topics is not None:
+                client.topics -= set(request["unsubscribe"])
+            self.logger.debug(f"Client {client.address} subscribed to {client.topics}")
+            return
+
+        for listener, withClient in self.data_listeners:
+            if withClient:
+                listener(data, client)
+            else:
+                listener(data)
+
+    def start(self):
+        """Start the server in a new thread"""
+        self.running = True
+        self.logger.info(f"Starting server on {self.host}:{self.port}")
+        server_thread = threading.Thread(target=self._accept_connections)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def _accept_connections(self):
+        while self.running:
+            try:
+                client_socket, address = self.socket.accept()
+                client_thread = threading.Thread(target=self._handle_client, args=(client_socket, address))
+                client_thread.daemon = True
+                client_thread.start()
+            except Exception as e:
+                if self.running:
+                    self.logger.error(f"Error accepting connection: {e}")
+                break
+
+    def stop(self):
+        """Stop the server and close all connections"""
+        self.running = False
+        for client in list(self.clients):
+            self._remove_client(client)
+        try:
+            self.socket.close()
+        except Exception as e:
+            self.logger.error(f"Error closing server socket: {e}")
@@ -0,0 +1,274 @@
+"""
+Microbenchmarks and round-trip fuzzing for the per-frame hot path.
+
+  python3 benchmark.py                 # fuzz, then benchmark
+  python3 benchmark.py --fuzz-only --iterations 5000 --seed 42
+  python3 benchmark.py --bench-only --sizes 256,4096,51200
+  python3 benchmark.py --corpus ./corpus  # save failing seeds / replay saved ones
+
+Reports frames/sec and peak bytes allocated per frame for parse, build,
+encrypt and decrypt. Exits with 1 if any fuzz case fails.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+# Keep per-frame INFO logging of decrypted payloads out of the measurements
+logging.basicConfig(level=logging.CRITICAL)
+
+from CryptoHelper import decrypt_data, encrypt_data
+from PacketParser import Server_Packet, Packet_Encoder
+
+PUSH_KEY = "0123456789abcdef0123456789abcdef"
+
+def _random_text(rng: random.Random, length: int) -> str:
+  alphabet = string.ascii_letters + string.digits + " _-:,{}\"\\/äöü中文"
+  return "".join(rng.choice(alphabet) for _ in range(length))
+
+def _random_key(rng: random.Random) -> str:
+  return "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(32))
+
+def _random_value(rng: random.Random, depth: int = 0):
+  kind = rng.randrange(6 if depth < 3 else 4)
+  if kind == 0:
+    return rng.randint(-2**31, 2**31)
+  if kind == 1:
+    return rng.random() * 1000
+  if kind == 2:
+    return _random_text(rng, rng.randrange(0, 40))
+  if kind == 3:
+    return rng.choice([True, False, None])
+  if kind == 4:
+    return [_random_value(rng, depth + 1) for _ in range(rng.randrange(0, 5))]
+  return {_random_text(rng, rng.randrange(1, 10)): _random_value(rng, depth + 1) for _ in range(rng.randrange(0, 5))}
+
+def _command(rng: random.Random, size: int) -> dict:
+  """Build a local control style command whose inner data is roughly size bytes"""
+  inner = {"mapData": _random_text(rng, size)} if size else _random_value(rng)
+  return {
+    "data": json.dumps(inner),
+    "extend": {"taskid": _random_text(rng, 36), "usid": "admin"},
+    "infoType": str(rng.randint(20000, 40000)),
+    "sn": _random_text(rng, 16),
+  }
+
+def _build(data: dict, key: str = PUSH_KEY, encrypt: bool = True, last_seq_id: int = 0x5A61111111111111, product_id: int = 60008) -> tuple[Server_Packet, bytes]:
+  packet = Server_Packet(None, key)
+  frame = packet.build(data=data, encrypt=encrypt, last_seq_id=last_seq_id, product_id=product_id)
+  return packet, frame
+
+# -------------------------------------
+# Fuzzing
+
+def _check_roundtrip(rng: random.Random) -> str | None:
+  data = _command(rng, rng.choice([0, 0, 64, 1024]))
+  key = _random_key(rng)
+  encrypt = rng.random() < 0.8
+  product_id = rng.randrange(0, 2**32)
+  packet, frame = _build(data, key, encrypt, rng.randrange(0, 2**64), product_id)
+
+  parsed = Server_Packet(frame, key)
+  if parsed.type != 0x0003:
+    return f"type {parsed.type} != 3"
+  if parsed.seq_nr != packet.seq_nr or parsed.product_id != product_id:
+    return "header mismatch"
+  if parsed.ack_nr != str(packet.ack_nr):
+    return f"ack {parsed.ack_nr} != {packet.ack_nr}"
+  if parsed.payload_json is None or parsed.payload_json.get("data") != data:
+    return "payload mismatch"
+  return None
+
+def _check_truncated(rng: random.Random) -> str | None:
+  _, frame = _build(_command(rng, 0))
+  cut = rng.randrange(0, len(frame))
+  try:
+    Server_Packet(frame[:cut], PUSH_KEY)
+  except Exception:
+    return None
+  return f"truncated frame of {cut}/{len(frame)} bytes was accepted"
+
+def _check_other_type(rng: random.Random) -> str | None:
+  _, frame = _build(_command(rng, 0))
+  packet_type = rng.choice([t for t in range(0, 16) if t != 3] + [rng.randrange(4, 0x10000)])
+  frame = frame[:2] + packet_type.to_bytes(2, byteorder="big") + frame[4:]
+  parsed = Server_Packet(frame, PUSH_KEY)
+  if parsed.type != packet_type:
+    return f"type {parsed.type} != {packet_type}"
+  return None
+
+def _check_wrong_key(rng: random.Random) -> str | None:
+  data = _command(rng, 0)
+  _, frame = _build(data)
+  parsed = Server_Packet(frame, "fedcba9876543210fedcba9876543210")
+  if parsed.payload_json is not None and parsed.payload_json.get("data") == data:
+    return "payload decrypted with the wrong key"
+  return None
+
+def _encapsulate(payloads: list[bytes]) -> bytes:
+  return b"\x00\x00\x00\x00" + b"".join(len(payload).to_bytes(4, byteorder="big") + payload for payload in payloads)
+
+def _check_encapsulated(rng: random.Random) -> str | None:
+  packet, frame = _build(_command(rng, 0))
+  header = frame[:-packet.payload_size - 4]
+
+  expected = []
+  payloads = []
+  for _ in range(rng.randrange(1, 6)):
+    inner = [_command(rng, 0) for _ in range(rng.randrange(1, 4))]
+    inner_payloads = [json.dumps({"data": encrypt_data(PUSH_KEY, data), "devType": 3, "encrypt": 1}).encode("utf-8") for data in inner]
+    expected += inner
+    # Batches can be nested
+    payloads += [_encapsulate(inner_payloads)] if rng.random() < 0.3 else inner_payloads
+  payload = _encapsulate(payloads)
+  if rng.random() < 0.3:
+    payload += bytes(rng.randrange(256) for _ in range(rng.randrange(1, 16)))
+
+  parsed = Server_Packet(header + len(payload).to_bytes(4, byteorder="big") + payload, PUSH_KEY)
+  if not parsed.encapsulated:
+    return "encapsulated payload not detected"
+  decoded = [message.get("data") for message in parsed.messages]
+  if decoded[:len(expected)] != expected:
+    return f"decoded {len(decoded)} inner messages, expected {len(expected)}"
+  return None
+
+def _check_batch(rng: random.Random) -> str | None:
+  commands = [(_command(rng, rng.choice([0, 256])), rng.random() < 0.8) for _ in range(rng.randrange(1, 10))]
+  last_seq_id = rng.randrange(0, 2**64)
+  frames, ack_nrs = Packet_Encoder(PUSH_KEY).encode(commands, last_seq_id=last_seq_id)
+  frames = bytes(frames)
+
+  offset = 0
+  for (data, _), ack_nr in zip(commands, ack_nrs):
+    parsed = Server_Packet(frames[offset:], PUSH_KEY)
+    if parsed.ack_nr != str(ack_nr) or parsed.seq_nr != (last_seq_id + ack_nr) & 0xFFFFFFFFFFFFFFFF:
+      return f"header mismatch at offset {offset}"
+    if parsed.payload_json is None or parsed.payload_json.get("data") != data:
+      return f"payload mismatch at offset {offset}"
+    offset += 6 + parsed.len_ack + 4 + parsed.remaining_size
+  if offset != len(frames):
+    return f"{len(frames) - offset} trailing bytes after batch"
+  return None
+
+def _check_crypto(rng: random.Random) -> str | None:
+  data = _random_value(rng)
+  if not data:
+    return None
+  key = _random_key(rng)
+  encrypted = encrypt_data(key, data)
+  if decrypt_data(key, encrypted) != data:
+    return "crypto round trip mismatch"
+  return None
+
+FUZZ_CHECKS = {
+  "roundtrip": _check_roundtrip,
+  "truncated": _check_truncated,
+  "other_type": _check_other_type,
+  "wrong_key": _check_wrong_key,
+  "encapsulated": _check_encapsulated,
+  "batch": _check_batch,
+  "crypto": _check_crypto,
+}
+
+def fuzz(iterations: int, seed: int, corpus: str = None) -> int:
+  failures = 0
+  for name, check in FUZZ_CHECKS.items():
+    failed = 0
+    for i in range(iterations):
+      case_seed = seed * 1_000_003 + i
+      try:
+        error = check(random.Random(case_seed))
+      except Exception as e:
+        error = f"unexpected {type(e).__name__}: {e}"
+      if error:
+        failed += 1
+        print(f"  FAIL {name} seed={case_seed}: {error}")
+        if corpus:
+          os.makedirs(corpus, exist_ok=True)
+          with open(os.path.join(corpus, f"{name}-{case_seed}.seed"), "w") as f:
+            f.write(f"{case_seed}\n{error}\n")
+    print(f"{name:<14} {iterations - failed}/{iterations} passed")
+    failures += failed
+  return failures
+
+def replay(corpus: str) -> int:
+  """Re-run all saved failing cases"""
+  failures = 0
+  for filename in sorted(os.listdir(corpus)):
+    if not filename.endswith(".seed"):
+      continue
+    name = filename.split("-", 1)[0]
+    with open(os.path.join(corpus, filename)) as f:
+      case_seed = int(f.readline())
+    try:
+      error = FUZZ_CHECKS[name](random.Random(case_seed))
+    except Exception as e:
+      error = f"unexpected {type(e).__name__}: {e}"
+    print(f"  {'FAIL' if error else 'ok  '} {filename}{': ' + error if error else ''}")
+    failures += 1 if error else 0
+  return failures
+
+# -------------------------------------
+# Benchmarks
+
+def _measure(label: str, func, frames: int, size: int) -> None:
+  func()
+  start = time.perf_counter()
+  for _ in range(frames):
+    func()
+  elapsed = time.perf_counter() - start
+
+  tracemalloc.start()
+  tracemalloc.reset_peak()
+  func()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  print(f"{label:<10} {size:>8} B {frames / elapsed:>12.0f} frames/s {elapsed / frames * 1e6:>10.1f} us/frame {peak / 1024:>10.1f} KiB peak/frame")
+
+def bench(sizes: list[int], frames: int, seed: int) -> None:
+  rng = random.Random(seed)
+  print(f"{'op':<10} {'payload':>10} {'throughput':>19} {'latency':>19} {'allocation':>25}")
+  for size in sizes:
+    data = _command(rng, size)
+    packet, frame = _build(data)
+    encrypted = encrypt_data(PUSH_KEY, data)
+    count = max(10, frames * 256 // max(size, 256))
+
+    encoder = Packet_Encoder(PUSH_KEY)
+    _measure("build", lambda: _build(data), count, size)
+    _measure("encode", lambda: encoder.encode([(data, True)]), count, size)
+    _measure("parse", lambda: Server_Packet(frame, PUSH_KEY), count, size)
+    _measure("encrypt", lambda: encrypt_data(PUSH_KEY, data), count, size)
+    _measure("decrypt", lambda: decrypt_data(PUSH_KEY, encrypted), count, size)
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--iterations", type=int, default=500, help="fuzz cases per check")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--sizes", default="256,4096,51200", help="comma separated payload sizes in bytes")
+  parser.add_argument("--frames", type=int, default=2000, help="frames per benchmark at 256 bytes, scaled down for larger payloads")
+  parser.add_argument("--corpus", help="directory for failing fuzz seeds, replayed before fuzzing")
+  parser.add_argument("--fuzz-only", action="store_true")
+  parser.add_argument("--bench-only", action="store_true")
+  args = parser.parse_args()
+
+  failures = 0
+  if not args.bench_only:
+    if args.corpus and os.path.isdir(args.corpus):
+      print(f"Replaying corpus {args.corpus}")
+      failures += replay(args.corpus)
+    print(f"Fuzzing with seed {args.seed}")
+    failures += fuzz(args.iterations, args.seed, args.corpus)
+  if not args.fuzz_only:
+    print()
+    bench([int(size) for size in args.sizes.split(",")], args.frames, args.seed)
+  return 1 if failures else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Docker healthcheck, exits with 0 while the proxy is alive and 1 otherwise.
+
+  python3 healthcheck.py
+
+Reads the same settings as the proxy (environment and CONFIG_FILE). If the
+websocket server is enabled, /health/live is requested on LOCAL_CONTROL_HOST
+and LOCAL_CONTROL_WS_PORT. Otherwise the file the health monitor writes after
+every check (HEALTH_FILE) has to be recent and report the proxy as alive.
+"""
+import urllib.request
+import json
+import time
+import sys
+
+from Config import ProxyConfig
+
+# Addresses that mean "all interfaces" are reached via loopback
+_ANY_HOSTS = {"": "127.0.0.1", "0.0.0.0": "127.0.0.1", "::": "::1"}
+
+def _url(host: str, port: int) -> str:
+  host = _ANY_HOSTS.get(host, host)
+  if ":" in host:
+    host = f"[{host}]"
+  return f"http://{host}:{port}/health/live"
+
+def check_endpoint(host: str, port: int, timeout: float = 5.0) -> str | None:
+  """Returns the problem or None if /health/live answered with 200"""
+  try:
+    with urllib.request.urlopen(_url(host, port), timeout=timeout) as response:
+      return None if response.status == 200 else f"/health/live answered {response.status}"
+  except Exception as e:
+    return f"/health/live failed: {e}"
+
+def check_file(path: str, now: float = None) -> str | None:
+  """Returns the problem or None if the health file is recent and reports the proxy as alive"""
+  now = time.time() if now is None else now
+  try:
+    with open(path, "r") as f:
+      health = json.load(f)
+  except (OSError, ValueError) as e:
+    return f"cannot read {path}: {e}"
+  age = now - health.get("time", 0)
+  if age > health.get("max_age", 0):
+    return f"{path} was last written {age:.0f}s ago"
+  if health.get("status") != "ok":
+    return f"{path} reports {health.get('status')}"
+  return None
+
+def main() -> int:
+  try:
+    config = ProxyConfig.load()
+  except ValueError as e:
+    print(e)
+    return 1
+  if config.local_control_ws_port:
+    problem = check_endpoint(config.local_control_host, config.local_control_ws_port)
+  else:
+    problem = check_file(config.health_file)
+  if problem:
+    print(problem)
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -2,46 +2,88 @@ import os
 import logging
 from mitmproxy import http, tcp
 from EchoServer import EchoServer
+from Blocklist import FirewallBlocklist
+from Config import ProxyConfig
+from HttpFlow import HttpFlow
+from HttpServer import HttpServer
 import HttpHandler
 import logging
 from CustomFormatter import CustomFormatter
 
+config = ProxyConfig.load_or_exit()
+
 sh = logging.StreamHandler()
-sh.setLevel(os.environ.get('LOG_LEVEL_MITM', 'INFO').upper())
+sh.setLevel(config.log_level("MITM"))
 sh.setFormatter(CustomFormatter())
 
-os.makedirs(os.environ.get("LOG_PATH", "/root/logs"), exist_ok=True)
+os.makedirs(config.log_path, exist_ok=True)
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)',
     handlers=[
       sh, 
-      logging.FileHandler(os.path.join(os.environ.get("LOG_PATH", "/root/logs"), "360proxy.log"))
+      logging.FileHandler(os.path.join(config.log_path, "360proxy.log"))
     ]
 )
 
 _LOGGER = logging.getLogger("CN360_mitm")
 _LOGGER.addHandler(sh)
+config.apply_log_levels()
+
+class MitmHttpFlow(HttpFlow):
+  """HttpFlow backed by a mitmproxy flow, its request and response are used as they are"""
+
+  def __init__(self, flow: http.HTTPFlow):
+    self.flow = flow
+    self.request = flow.request
+
+  @property
+  def response(self):
+    return self.flow.response
+
+  def respond(self, status_code: int, content: bytes, headers: dict = None):
+    self.flow.response = http.Response.make(status_code, content, headers or {})
+
+  def respond_file(self, status_code: int, path: str, offset: int, length: int, headers: dict = None):
+    with open(path, "rb") as f:
+      f.seek(offset)
+      self.respond(status_code, f.read(length), headers)
 
 class TcpPacketAddon:
-  def __init__(self):
+  def __init__(self, config: ProxyConfig):
+    self.config = config
     # Initialize the EchoServer instance
-    self.echo_server = EchoServer()
+    self.echo_server = EchoServer(config)
+    self.blocklist = FirewallBlocklist(
+      backend=config.blocklist_backend,
+      timeout=config.blocklist_timeout,
+    )
+    self.blocklist.start()
+    if config.http_port:
+      # Plain HTTP of the robot is redirected to this port instead of mitmproxy
+      self.http_server = HttpServer(self.echo_server, config.http_host, config.http_port, blocklist=self.blocklist)
+      self.http_server.start()
+    config.add_reload_listener(self._apply_config)
+    config.watch()
+
+  def _apply_config(self, config: ProxyConfig):
+    sh.setLevel(config.log_level("MITM"))
+    self.blocklist.timeout = config.blocklist_timeout
       
   def tcp_start(self, flow: tcp.TCPFlow):
     """Robot should only be able to connect to local echo server."""
-    if flow.server_conn.address[0] != os.environ.get("LOCAL_PROXY_IP", "192.168.0.254"):
+    if flow.server_conn.address[0] != self.config.local_proxy_ip:
       _LOGGER.warning(f"Robot tried to connect to non-local server: {flow.server_conn.address}")
       if flow.killable:
         flow.kill()
-      os.system(f"iptables -A FORWARD -s \"{flow.client_conn.address[0]}\" -d \"{flow.server_conn.address[0]}\" -p tcp --dport \"{flow.server_conn.address[1]}\" -j REJECT")
-      _LOGGER.warning(f"Blocked connection from {flow.client_conn.address[0]} to {flow.server_conn.address[0]}")
+      if self.blocklist.block(flow.client_conn.address[0], flow.server_conn.address[0], flow.server_conn.address[1]):
+        _LOGGER.warning(f"Blocked connection from {flow.client_conn.address[0]} to {flow.server_conn.address[0]}")
       return
     
   def tcp_message(self, flow: tcp.TCPFlow):
     """Clear messages for remote echo server communication."""
-    if flow.server_conn.address[0] != os.environ.get("LOCAL_PROXY_IP", "192.168.0.254") and flow.messages[-1].content[0:2] == b'\x00\x05':
+    if flow.server_conn.address[0] != self.config.local_proxy_ip and flow.messages[-1].content[0:2] == b'\x00\x05':
       _LOGGER.warning(f"Robot tried to send messages to non-local server: {flow.server_conn.address}")
       if flow.killable:
         flow.kill()
@@ -50,26 +92,12 @@ class TcpPacketAddon:
     
   def request(self, flow: http.HTTPFlow):
     """Handle HTTP requests and serve the local CA certificate."""
-    if flow.request.path == "/ca/cacert.pem":
-      # Serve the local mitmproxy CA certificate
-      ca_file = os.path.expanduser("~/.mitmproxy/mitmproxy-ca-cert.pem")
-      try:
-        with open(ca_file, "rb") as f:
-          cert = f.read()
-        flow.response = http.Response.make(
-          200,
-          cert,
-          {"Content-Type": "application/x-pem-file"}
-        )
-      except FileNotFoundError:
-        _LOGGER.error(f"CA file not found: {ca_file}")
-    else:
-      HttpHandler.request(self.echo_server, flow)
+    HttpHandler.request(self.echo_server, MitmHttpFlow(flow))
 
   def response(self, flow: http.HTTPFlow):
     """Handle HTTP responses and process the data."""
-    HttpHandler.response(self.echo_server, flow)
+    HttpHandler.response(self.echo_server, MitmHttpFlow(flow))
 
 addons = [
-  TcpPacketAddon()
+  TcpPacketAddon(config)
 ]
@@ -0,0 +1,167 @@
+import time
+
+from Blocklist import DryRunExecutor, FirewallBlocklist
+
+class FailingExecutor(DryRunExecutor):
+  """Fails the first failures batch writes, everything else succeeds like a dry run"""
+
+  def __init__(self, failures: int = 1) -> None:
+    super().__init__()
+    self.failures: int = failures
+
+  def run(self, args: list[str], input: str = None) -> bool:
+    ok = super().run(args, input)
+    if args[:2] == ["ipset", "restore"] and self.failures > 0:
+      self.failures -= 1
+      return False
+    return ok
+
+def restores(executor: DryRunExecutor) -> list[str]:
+  return [input for args, input in executor.commands if args[:2] == ["ipset", "restore"]]
+
+def test_flush_writes_pending_entries_in_one_batch(monkeypatch):
+  monkeypatch.setattr(time, "monotonic", lambda: 1000.0)
+  executor = DryRunExecutor()
+  blocklist = FirewallBlocklist("ipset", executor=executor)
+  assert blocklist.block("10.0.0.2", "1.2.3.4", 443)
+  assert blocklist.block("10.0.0.2", "1.2.3.5", 80)
+  assert not blocklist.block("10.0.0.2", "1.2.3.4", 443)
+
+  assert blocklist.flush() == 2
+  assert restores(executor) == [
+    "add cn360-blocklist 1.2.3.4,tcp:443,10.0.0.2 timeout 3600\n"
+    "add cn360-blocklist 1.2.3.5,tcp:80,10.0.0.2 timeout 3600\n"
+  ]
+  # The set and the rule are only set up once
+  assert blocklist.flush() == 0
+  assert sum(args[:2] == ["ipset", "create"] for args, _ in executor.commands) == 1
+
+def test_failed_flush_is_requeued():
+  executor = FailingExecutor()
+  blocklist = FirewallBlocklist("ipset", executor=executor)
+  blocklist.block("10.0.0.2", "1.2.3.4", 443)
+
+  assert blocklist.flush() == 0
+  assert blocklist._pending == [("1.2.3.4", 443, "10.0.0.2")]
+  blocklist.block("10.0.0.2", "1.2.3.5", 443)
+  assert blocklist.flush() == 2
+  assert blocklist._pending == []
+  assert len(restores(executor)) == 2
+
+def test_failed_flush_is_retried_without_new_entries():
+  executor = FailingExecutor()
+  blocklist = FirewallBlocklist("ipset", flush_interval=0.01, retry_interval=0.05, executor=executor)
+  blocklist.start()
+  try:
+    blocklist.block("10.0.0.2", "1.2.3.4", 443)
+    deadline = time.monotonic() + 5
+    while len(restores(executor)) < 2 and time.monotonic() < deadline:
+      time.sleep(0.01)
+  finally:
+    blocklist.stop()
+  assert len(restores(executor)) == 2
+  assert blocklist._pending == []
+
+def test_entries_expire(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, "monotonic", lambda: now[0])
+  executor = DryRunExecutor()
+  blocklist = FirewallBlocklist("ipset", timeout=60, executor=executor)
+  blocklist.block("10.0.0.2", "1.2.3.4", 443)
+  blocklist.flush()
+  assert blocklist.is_blocked("10.0.0.2", "1.2.3.4", 443)
+
+  now[0] += 61
+  assert not blocklist.is_blocked("10.0.0.2", "1.2.3.4", 443)
+  blocklist.flush()
+  assert blocklist.entries == {}
+  # The kernel dropped it as well, so it is written again
+  assert blocklist.block("10.0.0.2", "1.2.3.4", 443)
+  assert blocklist.flush() == 1
+
+def test_expired_entries_are_not_retried(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, "monotonic", lambda: now[0])
+  blocklist = FirewallBlocklist("ipset", timeout=60, executor=FailingExecutor(failures=2))
+  blocklist.block("10.0.0.2", "1.2.3.4", 443)
+  blocklist.flush()
+  now[0] += 61
+  assert blocklist.flush() == 0
+  assert blocklist._pending == []
+
+def test_changed_timeout_applies_to_new_entries(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, "monotonic", lambda: now[0])
+  executor = DryRunExecutor()
+  blocklist = FirewallBlocklist("ipset", timeout=60, executor=executor)
+  blocklist.block("10.0.0.2", "1.2.3.4", 443)
+  blocklist.timeout = 0
+  blocklist.block("10.0.0.2", "1.2.3.5", 443)
+  now[0] += 30
+  blocklist.flush()
+  # The set is created independent of the timeout, each entry has its own
+  assert ["ipset", "create", "cn360-blocklist", "hash:ip,port,ip", "timeout", "0", "-exist"] in [args for args, _ in executor.commands]
+  assert restores(executor) == [
+    "add cn360-blocklist 1.2.3.4,tcp:443,10.0.0.2 timeout 30\n"
+    "add cn360-blocklist 1.2.3.5,tcp:443,10.0.0.2 timeout 0\n"
+  ]
+  now[0] += 31
+  assert not blocklist.is_blocked("10.0.0.2", "1.2.3.4", 443)
+  assert blocklist.is_blocked("10.0.0.2", "1.2.3.5", 443)
+
+def test_nftables_elements_carry_their_timeout(monkeypatch):
+  monkeypatch.setattr(time, "monotonic", lambda: 1000.0)
+  executor = DryRunExecutor()
+  blocklist = FirewallBlocklist("nftables", timeout=60, executor=executor)
+  blocklist.block("10.0.0.2", "1.2.3.4", 443)
+  blocklist.timeout = 0
+  blocklist.block("10.0.0.2", "1.2.3.5", 443)
+  blocklist.flush()
+  assert executor.commands[-1][1] == "add element inet cn360 blocklist { 1.2.3.4 . 443 . 10.0.0.2 timeout 60s, 1.2.3.5 . 443 . 10.0.0.2 }\n"
+
+class RejectingExecutor(DryRunExecutor):
+  """Like ipset restore, rejects a whole batch if one of its lines contains rejected"""
+
+  def __init__(self, rejected: str) -> None:
+    super().__init__()
+    self.rejected: str = rejected
+
+  def run(self, args: list[str], input: str = None) -> bool:
+    ok = super().run(args, input)
+    return ok and not (args[:2] == ["ipset", "restore"] and self.rejected in input)
+
+def test_rejected_entry_does_not_hold_back_the_others():
+  executor = RejectingExecutor("1.2.3.5")
+  blocklist = FirewallBlocklist("ipset", max_attempts=3, executor=executor)
+  for dst in ("1.2.3.4", "1.2.3.5", "1.2.3.6"):
+    blocklist.block("10.0.0.2", dst, 443)
+
+  assert blocklist.flush() == 2
+  # The batch, then every entry on its own
+  assert len(restores(executor)) == 4
+  assert blocklist._pending == [("1.2.3.5", 443, "10.0.0.2")]
+
+  blocklist.block("10.0.0.2", "1.2.3.7", 443)
+  assert blocklist.flush() == 1
+  assert blocklist._pending == [("1.2.3.5", 443, "10.0.0.2")]
+  assert blocklist.flush() == 0
+  # Given up after max_attempts, blocking it again starts over
+  assert blocklist._pending == []
+  assert not blocklist.is_blocked("10.0.0.2", "1.2.3.5", 443)
+  assert blocklist.is_blocked("10.0.0.2", "1.2.3.7", 443)
+  assert blocklist.block("10.0.0.2", "1.2.3.5", 443)
+
+def test_only_ipv4_destinations_are_blocked():
+  executor = DryRunExecutor()
+  blocklist = FirewallBlocklist("ipset", executor=executor)
+  assert not blocklist.block("10.0.0.2", "2001:db8::1", 443)
+  assert not blocklist.block("fe80::1", "1.2.3.4", 443)
+  assert not blocklist.block("10.0.0.2", "update.example.com", 443)
+  assert not blocklist.block("10.0.0.2", "1.2.3.4", 0)
+  assert blocklist._pending == []
+
+  # mitmproxy reports IPv4 peers of dual stack sockets as IPv4-mapped addresses
+  assert blocklist.block("::ffff:10.0.0.2", "::ffff:1.2.3.4", 443)
+  assert blocklist.is_blocked("10.0.0.2", "1.2.3.4", 443)
+  assert blocklist.flush() == 1
+  assert restores(executor)[-1] == "add cn360-blocklist 1.2.3.4,tcp:443,10.0.0.2 timeout 3600\n"
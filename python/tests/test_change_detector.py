@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+from ChangeDetector import ChangeDetector
+
+@pytest.fixture
+def clock(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, "monotonic", lambda: now[0])
+  return now
+
+def test_unchanged_keys_are_suppressed(clock):
+  detector = ChangeDetector(keyframe_interval=60)
+  cache = {"battery": 80, "mode": "idle"}
+  assert detector.changes(cache, {"battery": 80, "mode": "cleaning"}) == {"mode": "cleaning"}
+  assert detector.changes(cache, {"battery": 80, "mode": "idle"}) == {}
+  assert detector.changes(cache, {"map": [1, 2]}) == {"map": [1, 2]}
+  assert detector.stats() == {"events_emitted": 2, "events_suppressed": 1, "keys_emitted": 2, "keys_suppressed": 3, "keyframes": 0}
+
+def test_keyframe_passes_the_whole_update(clock):
+  detector = ChangeDetector(keyframe_interval=60)
+  cache = {"battery": 80, "mode": "idle"}
+  clock[0] += 59
+  assert detector.changes(cache, dict(cache)) == {}
+  clock[0] += 1
+  assert detector.changes(cache, dict(cache)) == cache
+  # The next keyframe is due an interval after this one
+  clock[0] += 59
+  assert detector.changes(cache, dict(cache)) == {}
+  clock[0] += 1
+  assert detector.changes(cache, dict(cache)) == cache
+  assert detector.keyframes == 2
+  assert detector.events_suppressed == 2
+
+def test_keyframes_can_be_turned_off(clock):
+  detector = ChangeDetector(keyframe_interval=0)
+  clock[0] += 3600
+  assert detector.changes({"battery": 80}, {"battery": 80}) == {}
+  assert detector.keyframes == 0
+
+def test_disabled_detector_passes_everything(clock):
+  detector = ChangeDetector(enabled=False)
+  update = {"battery": 80, "mode": "idle"}
+  assert detector.changes(dict(update), update) is update
+  assert detector.stats() == {"events_emitted": 1, "events_suppressed": 0, "keys_emitted": 2, "keys_suppressed": 0, "keyframes": 0}
@@ -0,0 +1,138 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from Config import ProxyConfig
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_SCRIPT = os.path.join(os.path.dirname(PYTHON_DIR), "start.sh")
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+  deadline = time.monotonic() + timeout
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def test_defaults_and_derived_paths():
+  config = ProxyConfig.load({"DATA_PATH": "/data"})
+  assert config.local_control_port == 4468
+  assert config.local_control_ws_port == 0
+  assert config.blocklist_timeout == 3600
+  assert config.health_probe_command == {"infoType": "30000", "data": {}}
+  assert config.telemetry_file == "/data/telemetry.bin"
+  assert config.update_path == "/data/updates"
+  assert config.health_file == "/data/health.json"
+  assert config.health_probe_interval == 0
+
+def test_every_invalid_setting_is_reported():
+  with pytest.raises(ValueError) as error:
+    ProxyConfig.load({
+      "LOCAL_CONTROL_PORT": "-1",
+      "CHANGE_DETECTION": "maybe",
+      "BLOCKLIST_BACKEND": "pf",
+      "HEALTH_PROBE_COMMAND": "[1]",
+      "CACHE_POLICIES": "map*:size=1",
+      "LOG_LEVEL_ECHO": "LOUD",
+    })
+  message = str(error.value)
+  for name in ("LOCAL_CONTROL_PORT", "CHANGE_DETECTION", "BLOCKLIST_BACKEND", "HEALTH_PROBE_COMMAND", "CACHE_POLICIES", "LOG_LEVEL_ECHO"):
+    assert name in message
+
+def test_invalid_config_exits_the_process():
+  environ = dict(os.environ, PYTHONPATH=PYTHON_DIR, LOCAL_CONTROL_PORT="port")
+  result = subprocess.run([sys.executable, "-c", "from Config import ProxyConfig; ProxyConfig.load_or_exit(); print('running')"],
+                          env=environ, capture_output=True, text=True, timeout=30)
+  assert result.returncode == 2
+  assert "LOCAL_CONTROL_PORT" in result.stderr
+  assert "running" not in result.stdout
+
+def test_config_file_overrides_environment(tmp_path):
+  config_file = tmp_path / "proxy.env"
+  config_file.write_text("# comment\nSTATUS_INTV=5\nUPDATE_VERSIONS='1.2.3, 1.2.4'\n")
+  config = ProxyConfig.load({"CONFIG_FILE": str(config_file), "STATUS_INTV": "2", "MAP_INTV": "3"})
+  assert config.status_intv == 5
+  assert config.map_intv == 3
+  assert config.update_versions == ["1.2.3", "1.2.4"]
+
+def test_reload_applies_only_reloadable_settings(tmp_path, monkeypatch):
+  config_file = tmp_path / "proxy.env"
+  config_file.write_text("STATUS_INTV=1\nLOCAL_CONTROL_PORT=4468\n")
+  monkeypatch.setenv("CONFIG_FILE", str(config_file))
+  config = ProxyConfig.load()
+  applied = []
+  config.add_reload_listener(lambda config: applied.append(config.status_intv))
+
+  config_file.write_text("STATUS_INTV=7\nLOCAL_CONTROL_PORT=5000\nLOG_LEVEL_ECHO=DEBUG\n")
+  assert config.reload()
+  assert applied == [7]
+  assert config.local_control_port == 4468
+  assert config.local_control_ws_port == 0
+  assert config.log_level("ECHO") == "DEBUG"
+
+  # An invalid file keeps the running settings
+  config_file.write_text("STATUS_INTV=often\n")
+  assert not config.reload()
+  assert config.status_intv == 7
+  assert applied == [7]
+
+def test_sighup_reloads_settings(tmp_path, monkeypatch):
+  config_file = tmp_path / "proxy.env"
+  config_file.write_text("STATUS_INTV=1\n")
+  monkeypatch.setenv("CONFIG_FILE", str(config_file))
+  config = ProxyConfig.load()
+  previous = signal.getsignal(signal.SIGHUP)
+  try:
+    config.watch(interval=3600)
+    config_file.write_text("STATUS_INTV=9\n")
+    os.kill(os.getpid(), signal.SIGHUP)
+    assert wait_for(lambda: config.status_intv == 9)
+  finally:
+    config._watching = False
+    signal.signal(signal.SIGHUP, previous)
+
+FAKE_MITMWEB = """\
+#!{python}
+import os, sys, time
+sys.path.insert(0, {python_dir!r})
+from Config import ProxyConfig
+
+status = os.environ["STATUS_FILE"]
+config = ProxyConfig.load_or_exit()
+config.add_reload_listener(lambda config: open(status, "w").write(str(config.status_intv)))
+config.watch(interval=3600)
+open(status, "w").write(str(config.status_intv))
+while True:
+  time.sleep(1)
+"""
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="needs bash")
+def test_start_script_passes_sighup_to_the_proxy(tmp_path):
+  """start.sh is PID 1 of the container, a SIGHUP sent to it has to reach the proxy"""
+  bin_dir = tmp_path / "bin"
+  bin_dir.mkdir()
+  mitmweb = bin_dir / "mitmweb"
+  mitmweb.write_text(FAKE_MITMWEB.format(python=sys.executable, python_dir=PYTHON_DIR))
+  mitmweb.chmod(0o755)
+  # Don't create /root/logs on the machine running the tests
+  (bin_dir / "mkdir").write_text("#!/bin/sh\n")
+  (bin_dir / "mkdir").chmod(0o755)
+
+  config_file = tmp_path / "proxy.env"
+  config_file.write_text("STATUS_INTV=1\n")
+  status = tmp_path / "status"
+  environ = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}", CONFIG_FILE=str(config_file), STATUS_FILE=str(status))
+  process = subprocess.Popen(["bash", START_SCRIPT], env=environ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    assert wait_for(lambda: status.exists() and status.read_text() == "1", timeout=30)
+    config_file.write_text("STATUS_INTV=4\n")
+    process.send_signal(signal.SIGHUP)
+    assert wait_for(lambda: status.read_text() == "4", timeout=10)
+    assert process.poll() is None
+  finally:
+    process.kill()
+    process.wait()
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from DataCache import CachePolicy, DataCache
+
+def test_size_accounting_and_eviction():
+  cache = DataCache(max_bytes=100, max_keys=3)
+  cache.update({"a": "x" * 40, "b": "y" * 40}, sizes={"a": 42})
+  assert cache.sizes == {"a": 42, "b": 42}
+  assert cache.total_bytes == 84
+  cache["c"] = "z" * 40
+  # The least recently updated key makes room
+  assert "a" not in cache
+  assert cache.total_bytes == 84
+  assert cache.evictions["size"] == 1
+  assert cache.pop("b") == "y" * 40
+  assert cache.total_bytes == 42
+
+def test_values_over_the_key_limit_are_not_cached():
+  cache = DataCache(max_bytes=1000, policies=CachePolicy.parse("map*:max=10"))
+  cache.update({"mapData": "x" * 20, "status": "x" * 20})
+  assert "mapData" not in cache
+  assert cache.total_bytes == 22
+  assert cache.evictions["too_large"] == 1
+
+def test_cache_cannot_be_changed_past_the_accounting():
+  cache = DataCache()
+  assert not isinstance(cache, dict)
+  for name in ("setdefault", "copy", "__ior__", "popitem"):
+    assert not hasattr(cache, name)
+
+def test_snapshot_is_a_copy_and_expires_keys(monkeypatch):
+  now = [100.0]
+  monkeypatch.setattr(time, "monotonic", lambda: now[0])
+  cache = DataCache(policies=CachePolicy.parse("status:ttl=10"))
+  cache.update({"status": 1, "battery": 80})
+  snapshot = cache.snapshot()
+  cache["battery"] = 79
+  assert snapshot == {"status": 1, "battery": 80}
+  now[0] += 11
+  assert cache.snapshot() == {"battery": 79}
+  assert cache.evictions["ttl"] == 1
+
+def test_expire_runs_safely_next_to_updates():
+  cache = DataCache(max_keys=64, policies=CachePolicy.parse("*:ttl=0.001"))
+  errors = []
+  running = True
+
+  def update():
+    i = 0
+    while running:
+      cache.update({f"key{i % 200}": i})
+      i += 1
+
+  worker = threading.Thread(target=update)
+  worker.start()
+  try:
+    deadline = time.monotonic() + 0.5
+    while time.monotonic() < deadline:
+      try:
+        cache.snapshot()
+      except RuntimeError as e:
+        errors.append(e)
+  finally:
+    running = False
+    worker.join()
+  assert errors == []
+  assert cache.total_bytes == sum(cache.sizes.values())
+
+def test_keys_sent_again_unchanged_are_not_evicted_first(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, "monotonic", lambda: now[0])
+  cache = DataCache(max_keys=2, policies=CachePolicy.parse("status:ttl=60"))
+  cache.update({"status": "idle", "map": [1]})
+  now[0] += 50
+  # The change detector drops the unchanged status, the cache is only touched
+  cache.touch(["status", "unknown"])
+  cache["path"] = [2]
+  assert "status" in cache
+  assert "map" not in cache
+  assert "unknown" not in cache
+  # Being seen again also restarts the ttl
+  now[0] += 50
+  assert cache.snapshot() == {"status": "idle", "path": [2]}
@@ -0,0 +1,251 @@
+import json
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import healthcheck
+from EchoServer import EchoServer
+from Health import HealthMonitor
+from TCPServer import TCPSocketServer
+from WebSocketServer import WebSocketClient, WebSocketServer
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+  deadline = time.monotonic() + timeout
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+class FakeServer:
+  def __init__(self) -> None:
+    self.stuck = []
+    self.dropped = []
+    self.last_received = None
+    self.last_sent = None
+    self.last_connected = None
+
+  def stuck_clients(self, timeout: float) -> list:
+    return list(self.stuck)
+
+  def drop_client(self, client) -> None:
+    self.stuck.remove(client)
+    self.dropped.append(client)
+
+class Clock:
+  def __init__(self, monkeypatch) -> None:
+    self.now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: self.now)
+
+@pytest.fixture
+def clock(monkeypatch):
+  return Clock(monkeypatch)
+
+@pytest.fixture
+def echo_server(clock):
+  cloud = SimpleNamespace(alive=True, sending_since=None, last_received=None, last_sent=None, connected_at=clock.now)
+  cloud.is_alive = lambda: cloud.alive
+  echo_server = SimpleNamespace(
+    robot_socket=FakeServer(), local_control_socket=FakeServer(), local_unix_socket=None, local_websocket=FakeServer(),
+    robot_connected=False, cloud_connected=False, remote_ip=None, cloud_client=cloud, push_key=None, local_ack_nr=[],
+    resets=0,
+  )
+  echo_server.robot_socket.last_connected = clock.now
+
+  def reset_robot_session():
+    echo_server.resets += 1
+    echo_server.robot_connected = False
+    echo_server.cloud_connected = False
+  echo_server.reset_robot_session = reset_robot_session
+  return echo_server
+
+def connect(echo_server, clock) -> None:
+  echo_server.robot_connected = True
+  echo_server.cloud_connected = True
+  echo_server.remote_ip = "203.0.113.1"
+  echo_server.robot_socket.last_received = clock.now
+  echo_server.cloud_client.last_received = clock.now
+
+def test_liveness_follows_the_watchdog(echo_server, clock):
+  monitor = HealthMonitor(echo_server, interval=10, stuck_after=30)
+  assert not monitor.liveness()[0]
+
+  monitor.running = True
+  assert monitor.liveness()[0]
+  monitor.check()
+  clock.now += monitor.max_check_age()
+  assert monitor.liveness()[0]
+
+  # The worker hangs
+  clock.now += 1
+  live, body = monitor.liveness()
+  assert not live
+  assert body["status"] == "fail"
+
+  monitor.check()
+  assert monitor.liveness()[0]
+  monitor.stop()
+  assert not monitor.liveness()[0]
+
+def test_readiness_needs_robot_cloud_and_no_problems(echo_server, clock):
+  monitor = HealthMonitor(echo_server, stale_after=300, reconnect_interval=30)
+  monitor.running = True
+  monitor.check()
+  ready, body = monitor.readiness()
+  assert not ready
+  assert body["robot_connected"] is False
+
+  connect(echo_server, clock)
+  assert monitor.check() == []
+  ready, body = monitor.readiness()
+  assert ready
+  assert body["status"] == "ok"
+
+  # Robot keeps talking, the cloud went silent: both are dropped so the robot reconnects
+  clock.now += 301
+  echo_server.robot_socket.last_received = clock.now
+  assert monitor.check() == ["no frames from cloud for more than 300s"]
+  assert echo_server.resets == 1
+  assert not monitor.readiness()[0]
+
+  # Back once the robot reconnected and the cloud answers
+  connect(echo_server, clock)
+  assert monitor.check() == []
+  assert monitor.readiness()[0]
+
+def test_lost_cloud_resets_the_session_at_most_every_interval(echo_server, clock):
+  monitor = HealthMonitor(echo_server, reconnect_interval=30)
+  connect(echo_server, clock)
+  echo_server.cloud_client.alive = False
+  monitor.check()
+  # The robot did not reconnect yet
+  connect(echo_server, clock)
+  echo_server.cloud_client.alive = False
+  clock.now += 10
+  assert monitor.check() == ["cloud connection lost"]
+  assert echo_server.resets == 1
+  clock.now += 21
+  monitor.check()
+  assert echo_server.resets == 2
+
+  monitor.reconnect = False
+  clock.now += 31
+  monitor.check()
+  assert echo_server.resets == 2
+
+def test_stuck_clients_of_every_server_are_dropped(echo_server, clock):
+  monitor = HealthMonitor(echo_server)
+  echo_server.robot_socket.stuck.append("robot")
+  echo_server.local_websocket.stuck.append("websocket")
+  problems = monitor.check()
+  assert len(problems) == 2
+  assert echo_server.robot_socket.dropped == ["robot"]
+  assert echo_server.local_websocket.dropped == ["websocket"]
+  assert monitor.dropped_clients == 2
+  assert monitor.check() == []
+
+def test_probe_is_disabled_by_default(echo_server, clock):
+  sent = []
+  echo_server.send_probe = lambda command: sent.append(command) or [1]
+  echo_server.push_key = "key"
+  connect(echo_server, clock)
+  HealthMonitor(echo_server).check()
+  assert sent == []
+
+  monitor = HealthMonitor(echo_server, probe_interval=60, probe_timeout=15)
+  monitor.check()
+  assert len(sent) == 1
+  clock.now += 16
+  assert monitor.check() == ["robot did not ack the last probe"]
+  assert not monitor.readiness()[0]
+
+def test_blocked_websocket_send_is_detected_and_dropped():
+  server = WebSocketServer("127.0.0.1", 0)
+  ours, theirs = socket.socketpair()
+  ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+  client = WebSocketClient(ours, "test", deflate=False)
+  server.clients.append(client)
+  errors = []
+
+  def send():
+    try:
+      client.send_frame(b"x" * 10 * 1024 * 1024)
+    except OSError as e:
+      errors.append(e)
+  sender = threading.Thread(target=send, daemon=True)
+  sender.start()
+  try:
+    assert wait_for(lambda: server.stuck_clients(0.05) == [client])
+    server.drop_client(client)
+    sender.join(5)
+    assert errors
+    assert client.sending_since is None
+    assert server.stuck_clients(0) == []
+  finally:
+    ours.close()
+    theirs.close()
+    server.socket.close()
+
+def test_reset_drops_the_robot_instead_of_replacing_the_cloud():
+  robot_socket = TCPSocketServer("127.0.0.1", 0)
+  robot_socket.port = robot_socket.socket.getsockname()[1]
+  robot_socket.start()
+  robot = socket.create_connection(("127.0.0.1", robot_socket.port), timeout=5)
+  try:
+    assert wait_for(lambda: len(robot_socket.clients) == 1)
+    disconnected = []
+    echo_server = EchoServer.__new__(EchoServer)
+    echo_server.cloud_client = SimpleNamespace(disconnect=lambda: disconnected.append(True))
+    echo_server.cloud_connected = True
+    echo_server.robot_socket = robot_socket
+    echo_server.update_local_control = lambda: None
+
+    echo_server.reset_robot_session()
+    assert disconnected == [True]
+    assert not echo_server.cloud_connected
+    # The robot sees the connection close and connects again
+    assert robot.recv(1) == b""
+  finally:
+    robot.close()
+    robot_socket.stop()
+
+@pytest.fixture
+def health_endpoint():
+  server = WebSocketServer("127.0.0.1", 0)
+  server.port = server.socket.getsockname()[1]
+  server.live = True
+  server.set_health_provider(lambda kind: (server.live, {"status": "ok" if server.live else "fail"}))
+  server.start()
+  yield server
+  server.stop()
+
+def test_healthcheck_asks_the_configured_endpoint(health_endpoint):
+  assert healthcheck.check_endpoint("127.0.0.1", health_endpoint.port) is None
+  health_endpoint.live = False
+  assert "503" in healthcheck.check_endpoint("127.0.0.1", health_endpoint.port)
+
+def test_healthcheck_reads_the_health_file(tmp_path, echo_server):
+  path = str(tmp_path / "health" / "health.json")
+  monitor = HealthMonitor(echo_server, interval=10, stuck_after=30, health_file=path)
+  assert "cannot read" in healthcheck.check_file(path)
+
+  monitor.start()
+  try:
+    assert wait_for(lambda: healthcheck.check_file(path) is None)
+    with open(path) as f:
+      health = json.load(f)
+    assert "last written" in healthcheck.check_file(path, now=health["time"] + health["max_age"] + 1)
+  finally:
+    monitor.stop()
+
+def test_healthcheck_uses_the_config_file(tmp_path, monkeypatch, health_endpoint):
+  config_file = tmp_path / "proxy.env"
+  config_file.write_text(f"LOCAL_CONTROL_HOST=0.0.0.0\nLOCAL_CONTROL_WS_PORT={health_endpoint.port}\n")
+  monkeypatch.setenv("CONFIG_FILE", str(config_file))
+  monkeypatch.setenv("LOCAL_CONTROL_WS_PORT", "4469")
+  assert healthcheck.main() == 0
+
+  # Without websocket server only the health file is checked, and there is none
+  config_file.write_text(f"LOCAL_CONTROL_WS_PORT=0\nHEALTH_FILE={tmp_path / 'missing.json'}\n")
+  assert healthcheck.main() == 1
@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+import socket
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import HttpHandler
+from HttpServer import HttpServer
+from UpdateMirror import FirmwareImage, UpdateMirror
+
+FIRMWARE = bytes(range(256)) * 40
+
+class FakeBlocklist:
+  def __init__(self) -> None:
+    self.blocked = []
+
+  def block(self, source: str, ip: str, port: int) -> bool:
+    self.blocked.append((ip, port))
+    return True
+
+@pytest.fixture
+def echo_server():
+  config = SimpleNamespace(local_proxy_ip="192.0.2.1", robot_port=80, cache_static=False)
+  return SimpleNamespace(config=config, update_mirror=None)
+
+@pytest.fixture
+def server(echo_server):
+  server = HttpServer(echo_server, "127.0.0.1", 0, timeout=0.5, blocklist=FakeBlocklist())
+  server.port = server.socket.getsockname()[1]
+  server.start()
+  yield server
+  server.stop()
+
+def listen(handle) -> int:
+  """Accept one connection on a free port and pass it to handle in a thread"""
+  listener = socket.create_server(("127.0.0.1", 0))
+
+  def accept():
+    connection, _ = listener.accept()
+    listener.close()
+    with connection:
+      handle(connection)
+  threading.Thread(target=accept, daemon=True).start()
+  return listener.getsockname()[1]
+
+def read_head(sock: socket.socket) -> bytes:
+  data = b""
+  while b"\r\n\r\n" not in data:
+    chunk = sock.recv(1)
+    assert chunk, f"connection closed after {data!r}"
+    data += chunk
+  return data
+
+def read_response(sock: socket.socket) -> tuple[int, dict, bytes]:
+  lines = read_head(sock).decode("latin-1").split("\r\n")
+  headers = {}
+  for line in lines[1:]:
+    name, sep, value = line.partition(":")
+    if sep:
+      headers[name.strip().lower()] = value.strip()
+  length = int(headers["content-length"])
+  body = sock.recv(length, socket.MSG_WAITALL) if length else b""
+  return int(lines[0].split(" ")[1]), headers, body
+
+def connect(server: HttpServer) -> socket.socket:
+  return socket.create_connection(("127.0.0.1", server.port), timeout=5)
+
+def test_requests_are_answered_on_a_kept_alive_connection(server, tmp_path, monkeypatch):
+  ca_file = tmp_path / "ca.pem"
+  ca_file.write_bytes(b"-----BEGIN CERTIFICATE-----\n")
+  monkeypatch.setattr(HttpHandler, "CA_FILE", str(ca_file))
+  client = connect(server)
+  for _ in range(2):
+    client.sendall(b"GET /ca/cacert.pem HTTP/1.1\r\nHost: proxy\r\n\r\n")
+    status, headers, body = read_response(client)
+    assert status == 200
+    assert headers["connection"] == "keep-alive"
+    assert headers["content-type"] == "application/x-pem-file"
+    assert body == ca_file.read_bytes()
+
+  client.sendall(b"HEAD /ca/cacert.pem HTTP/1.0\r\nHost: proxy\r\n\r\n")
+  head = read_head(client)
+  assert f"Content-Length: {ca_file.stat().st_size}".encode() in head
+  assert client.recv(1) == b""
+
+def test_chunked_request_is_forwarded_and_response_decoded(server):
+  received = []
+
+  def upstream(connection):
+    head = read_head(connection)
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    received.append((head, connection.recv(length, socket.MSG_WAITALL)))
+    body = gzip.compress(b'{"errno": 0}')
+    connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nTransfer-Encoding: chunked\r\n\r\n"
+                       + f"{len(body):x}\r\n".encode() + body + b"\r\n0\r\n\r\n")
+  port = listen(upstream)
+
+  client = connect(server)
+  client.sendall(f"POST /clean/dev/ping HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nTransfer-Encoding: chunked\r\nAccept-Encoding: gzip\r\n\r\n".encode()
+                 + b"5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\n\r\n")
+  status, headers, body = read_response(client)
+  assert status == 200
+  assert body == b'{"errno": 0}'
+  assert "content-encoding" not in headers
+  assert "transfer-encoding" not in headers
+
+  head, content = received[0]
+  assert head.startswith(b"POST /clean/dev/ping HTTP/1.1\r\n")
+  assert b"Connection: close" in head
+  assert b"Transfer-Encoding" not in head
+  assert b"Accept-Encoding" not in head
+  assert content == b"hello world"
+
+def test_unreachable_upstream_is_answered_with_502(server):
+  port = socket.create_server(("127.0.0.1", 0))
+  closed = port.getsockname()[1]
+  port.close()
+  client = connect(server)
+  client.sendall(f"GET /clean/dev/ping HTTP/1.1\r\nHost: 127.0.0.1:{closed}\r\n\r\n".encode())
+  assert read_response(client)[0] == 502
+
+def test_firmware_range_is_sent_from_the_file(server, echo_server, tmp_path):
+  path = tmp_path / "firmware.bin"
+  path.write_bytes(FIRMWARE)
+  mirror = UpdateMirror(str(tmp_path / "updates"))
+  image = FirmwareImage("http://update.example.com/rom/firmware.bin", "1.2.3", sha256=hashlib.sha256(FIRMWARE).hexdigest(),
+                        size=len(FIRMWARE), path=str(path), verified=True)
+  mirror.images[image.key] = image
+  echo_server.update_mirror = mirror
+
+  client = connect(server)
+  client.sendall(b"GET /rom/firmware.bin HTTP/1.1\r\nHost: update.example.com\r\nRange: bytes=1000-4999\r\n\r\n")
+  status, headers, body = read_response(client)
+  assert status == 206
+  assert headers["content-range"] == f"bytes 1000-4999/{len(FIRMWARE)}"
+  assert body == FIRMWARE[1000:5000]
+
+  client.sendall(b"GET /rom/firmware.bin HTTP/1.1\r\nHost: update.example.com\r\n\r\n")
+  assert read_response(client)[2] == FIRMWARE
+
+def test_echo_connection_of_the_robot_is_relayed(server, echo_server):
+  def echo(connection):
+    while data := connection.recv(4096):
+      connection.sendall(data)
+  port = listen(echo)
+  echo_server.config.local_proxy_ip = "127.0.0.1"
+  echo_server.config.robot_port = port
+  server._original_destination = lambda writer: ("127.0.0.1", port)
+
+  client = connect(server)
+  frame = b"\x00\x05\x00\x04" + bytes(range(256))
+  client.sendall(frame)
+  assert client.recv(len(frame), socket.MSG_WAITALL) == frame
+  client.close()
+
+@pytest.mark.parametrize("data", [b"\x00\x05\x00\x04\x01\x02\r\n\r\n", b"\x00\x05\x00\x04\x01\x02"])
+def test_other_protocols_to_remote_hosts_are_blocked(server, data):
+  server._original_destination = lambda writer: ("203.0.113.5", 80)
+  client = connect(server)
+  client.sendall(data)
+  # Invalid requests are closed right away, incomplete ones after the timeout
+  assert client.recv(1) == b""
+  assert server.blocklist.blocked == [("203.0.113.5", 80)]
+
+def test_invalid_request_to_the_proxy_is_answered_with_400(server):
+  client = connect(server)
+  client.sendall(b"BROKEN\r\n\r\n")
+  assert read_response(client)[0] == 400
+  assert server.blocklist.blocked == []
@@ -0,0 +1,83 @@
+import json
+import socket
+
+from EchoServer import EchoServer
+from TCPServer import TCPSocketServer
+
+def split(message: str) -> tuple[list, str]:
+  return EchoServer._split_local_messages(message)
+
+def test_concatenated_documents_are_split():
+  assert split('{"infoType": 1} [{"infoType": 2}]\n{"infoType": 3}') == ([{"infoType": 1}, [{"infoType": 2}], {"infoType": 3}], "")
+
+def test_invalid_document_does_not_drop_the_others():
+  assert split('{"infoType": 1}{"infoType": }{"infoType": 3}') == ([{"infoType": 1}, {"infoType": 3}], "")
+  assert split('{"a": [1}{"infoType": 3}') == ([{"infoType": 3}], "")
+
+def test_data_that_is_not_json_is_dropped():
+  assert split('garbage{"infoType": 3}') == ([], "")
+  assert split('{"infoType": 1} x {"infoType": 3}') == ([{"infoType": 1}], "")
+  assert split('{"infoType": 1} 42') == ([{"infoType": 1}], "")
+
+def test_truncated_document_is_returned_as_tail():
+  assert split('{"infoType": 1}{"data": {"text": "a}b') == ([{"infoType": 1}], '{"data": {"text": "a}b')
+  assert split('{"infoType": 1}  [') == ([{"infoType": 1}], "[")
+
+def local_echo_server(sent: list) -> EchoServer:
+  echo_server = EchoServer.__new__(EchoServer)
+  echo_server.local_buffers = {}
+  echo_server.local_websocket = None
+  echo_server.sn = "sn"
+  echo_server._send_local_commands = lambda commands: sent.extend(data["infoType"] for data, _ in commands)
+  return echo_server
+
+def test_command_split_across_reads_is_sent_once():
+  sent = []
+  echo_server = local_echo_server(sent)
+  client, server = object(), object()
+
+  encoded = '{"infoType": 21005, "data": {"name": "Küche"}}{"infoType": 2'.encode("utf-8")
+  # Split inside the two bytes of the umlaut as well
+  cut = encoded.index(b"\xc3") + 1
+  echo_server._handle_local_data(encoded[:cut], client, server)
+  assert sent == []
+  echo_server._handle_local_data(encoded[cut:], client, server)
+  assert sent == ["21005"]
+  echo_server._handle_local_data(b'1006}', client, server)
+  assert sent == ["21005", "21006"]
+  assert echo_server.local_buffers[client][1] == ""
+
+  echo_server._handle_local_connection(client, False, server)
+  assert client not in echo_server.local_buffers
+
+def test_http_request_from_a_web_page_is_not_a_command():
+  sent = []
+  echo_server = local_echo_server(sent)
+  client, server = object(), object()
+  request = ('POST / HTTP/1.1\r\nHost: 192.168.0.254:4468\r\nContent-Type: text/plain\r\n\r\n'
+             '{"infoType": "21005", "data": {"mode": "smartClean"}}')
+  echo_server._handle_local_data(request.encode("utf-8"), client, server)
+  assert sent == []
+  assert echo_server.local_buffers[client][1] == ""
+
+  # The connection is still usable for real commands
+  echo_server._handle_local_data(b'{"infoType": "21011"}', client, server)
+  assert sent == ["21011"]
+
+def test_compression_request_sent_with_a_command_is_not_a_command():
+  sent = []
+  echo_server = local_echo_server(sent)
+  server = TCPSocketServer("127.0.0.1", 0, includeCustomHeader=True, allowCompression=True)
+  client, peer = socket.socketpair()
+  try:
+    echo_server._handle_local_data(b'{"compression": ["zlib"]}{"infoType": "21011"}', client, server)
+    assert sent == ["21011"]
+    # Answered in the old framing, then zlib is used
+    header = peer.recv(4)
+    assert header[:2] == b"\x16\x16"
+    assert json.loads(peer.recv(int.from_bytes(header[2:], "big"))) == {"origin": "proxy", "compression": "zlib"}
+    assert server.client_compression[client] == "zlib"
+  finally:
+    client.close()
+    peer.close()
+    server.socket.close()
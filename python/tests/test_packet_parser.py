@@ -0,0 +1,121 @@
+import json
+import socket
+import struct
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from EchoServer import EchoServer
+from PacketParser import Frame_Splitter, Server_Packet
+from TCPServer import TCPSocketServer
+
+def ack_frame(ack_nr: int) -> bytes:
+  ack = f"ack:{ack_nr}".encode()
+  return b"\x00\x05\x00\x04" + len(ack).to_bytes(2, "big") + ack
+
+def command_frame(text: str) -> bytes:
+  return Server_Packet(None).build({"text": text}, encrypt=False)
+
+def server_frame(payload: bytes) -> bytes:
+  ack = b"ack:1234"
+  return (struct.pack(">HHH", 0x0005, 0x0003, len(ack)) + ack
+          + struct.pack(">IQII", len(payload) + 16, 42, 60008, len(payload)) + payload)
+
+def payload(number: int) -> bytes:
+  return json.dumps({"data": {"number": number}, "encrypt": 0}).encode()
+
+def encapsulate(*payloads: bytes) -> bytes:
+  return bytes(4) + b"".join(len(inner).to_bytes(4, "big") + inner for inner in payloads)
+
+def numbers(packet: Server_Packet) -> list[int]:
+  return [message["data"]["number"] for message in packet.messages]
+
+def test_nested_batches_are_unpacked_in_order():
+  packet = Server_Packet(server_frame(encapsulate(payload(1), encapsulate(payload(2), encapsulate(payload(3))), payload(4))))
+  assert packet.encapsulated
+  assert numbers(packet) == [1, 2, 3, 4]
+
+def test_truncated_inner_length_keeps_the_messages_before_it():
+  batch = encapsulate(payload(1), payload(2))
+  truncated = batch + (1000).to_bytes(4, "big") + payload(3)
+  assert numbers(Server_Packet(server_frame(truncated))) == [1, 2]
+  # A zero length would never advance
+  assert numbers(Server_Packet(server_frame(batch + bytes(4) + payload(3)))) == [1, 2]
+
+def test_trailing_bytes_of_a_batch_are_dropped():
+  assert numbers(Server_Packet(server_frame(encapsulate(payload(1)) + b"\x00\x07"))) == [1]
+
+@pytest.mark.parametrize("data", [b"", b"\x00", b"\x00\x00\x00"])
+def test_short_payloads_are_no_batch(data):
+  packet = Server_Packet(server_frame(data))
+  assert not packet.encapsulated
+  assert packet.messages == []
+
+def test_plain_payload_is_one_message():
+  packet = Server_Packet(server_frame(payload(7)))
+  assert not packet.encapsulated
+  assert numbers(packet) == [7]
+
+STREAM = [command_frame("first"), ack_frame(111), ack_frame(222), command_frame("x" * 3000), ack_frame(333), command_frame("last")]
+LOCAL = {111, 333}
+
+def split(data: bytes, chunk_size: int) -> tuple[bytes, list[int]]:
+  splitter = Frame_Splitter()
+  consumed = []
+
+  def consume(ack_nr: int) -> bool:
+    if ack_nr in LOCAL:
+      consumed.append(ack_nr)
+      return True
+    return False
+  forwarded = b"".join(bytes(part) for offset in range(0, len(data), chunk_size)
+                       for part in splitter.feed(data[offset:offset + chunk_size], consume))
+  return forwarded, consumed
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 7, 64, 1024, 65536])
+def test_local_acks_are_taken_out_of_coalesced_frames(chunk_size):
+  forwarded, consumed = split(b"".join(STREAM), chunk_size)
+  assert consumed == [111, 333]
+  assert forwarded == b"".join(frame for frame in STREAM if frame not in (ack_frame(111), ack_frame(333)))
+
+def test_reads_without_local_acks_are_passed_on_as_one_view():
+  data = b"".join(STREAM)
+  parts = Frame_Splitter().feed(memoryview(data), lambda ack_nr: False)
+  assert len(parts) == 1
+  assert parts[0].obj is data
+
+def test_unknown_frames_pass_the_rest_of_the_read():
+  splitter = Frame_Splitter()
+  unknown = b"\x00\x05\x00\x01" + bytes(20) + ack_frame(111)
+  # Without its length the ack inside could also be part of the unknown frame
+  assert b"".join(bytes(part) for part in splitter.feed(unknown, lambda ack_nr: True)) == unknown
+  # The next read starts with a frame again
+  assert splitter.feed(ack_frame(111), lambda ack_nr: True) == []
+
+def test_robot_frames_are_relayed_without_local_acks():
+  echo_server = EchoServer.__new__(EchoServer)
+  echo_server.robot_frames = Frame_Splitter()
+  echo_server.local_ack_nr = [111, 333]
+  acked = []
+  echo_server.health = SimpleNamespace(ack_received=acked.append)
+  sent = []
+  echo_server.cloud_client = SimpleNamespace(send_data=lambda data: sent.append(bytes(data)) or True)
+
+  robot_socket = TCPSocketServer("127.0.0.1", 0)
+  robot_socket.port = robot_socket.socket.getsockname()[1]
+  robot_socket.set_fast_forward(echo_server._forward_robot_data)
+  robot_socket.start()
+  expected = b"".join(frame for frame in STREAM if frame not in (ack_frame(111), ack_frame(333)))
+  try:
+    robot = socket.create_connection(("127.0.0.1", robot_socket.port), timeout=5)
+    robot.sendall(b"".join(STREAM))
+    deadline = time.monotonic() + 5
+    while len(b"".join(sent)) < len(expected) and time.monotonic() < deadline:
+      time.sleep(0.01)
+    robot.close()
+  finally:
+    robot_socket.stop()
+  assert b"".join(sent) == expected
+  assert acked == [111, 333]
+  assert echo_server.local_ack_nr == []
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from SharedRing import SharedRing
+
+def test_latest_message_is_copied(tmp_path):
+  writer = SharedRing(str(tmp_path / "ring"), slots=2, slot_size=64)
+  reader = SharedRing.open(writer.path)
+  assert reader.read_latest() is None
+
+  writer.write(b"first")
+  seq, data = reader.read_latest()
+  assert (seq, data) == (1, b"first")
+  writer.write(b"second")
+  writer.write(b"third")
+  # The slot of the first message was reused, the copy is unaffected
+  assert data == b"first"
+  assert reader.read_latest() == (3, b"third")
+  assert writer.write(b"x" * 65) is None
+
+def test_reader_retries_when_the_writer_overwrites_the_slot(tmp_path):
+  writer = SharedRing(str(tmp_path / "ring"), slots=2, slot_size=64)
+  reader = SharedRing.open(writer.path)
+  writer.write(b"first")
+
+  class OvertakingView:
+    """Lets the writer wrap around while the reader copies the first message"""
+
+    def __init__(self, view: memoryview) -> None:
+      self.view = view
+      self.overtaken = False
+
+    def __getitem__(self, key):
+      if not self.overtaken:
+        self.overtaken = True
+        writer.write(b"second")
+        writer.write(b"third")
+      return self.view[key]
+
+  reader._view = OvertakingView(reader._view)
+  assert reader.read_latest() == (3, b"third")
+
+def test_concurrent_writers_never_share_a_slot(tmp_path):
+  writer = SharedRing(str(tmp_path / "ring"), slots=4, slot_size=4096)
+  reader = SharedRing.open(writer.path)
+  slot_offset = writer._slot_offset
+
+  def slow_slot_offset(slot: int) -> int:
+    # Let the other writers run between picking the sequence number and publishing it
+    time.sleep(0.0001)
+    return slot_offset(slot)
+  writer._slot_offset = slow_slot_offset
+  seqs = []
+  mixed = []
+  done = threading.Event()
+
+  def write(byte: int):
+    for length in range(1000, 1100):
+      seqs.append(writer.write(bytes([byte]) * length))
+
+  def read():
+    while not done.is_set():
+      latest = reader.read_latest()
+      # Every message consists of one repeated byte, anything else is a mix of two writes
+      if latest and latest[1].strip(latest[1][:1]):
+        mixed.append(latest)
+
+  checker = threading.Thread(target=read)
+  checker.start()
+  writers = [threading.Thread(target=write, args=(byte,)) for byte in range(1, 5)]
+  for thread in writers:
+    thread.start()
+  for thread in writers:
+    thread.join()
+  done.set()
+  checker.join()
+
+  assert sorted(seqs) == list(range(1, 401))
+  assert writer.seq == 400
+  assert reader.read_latest()[0] == 400
+  assert mixed == []
@@ -0,0 +1,114 @@
+import socket
+import time
+import zlib
+
+import pytest
+
+from TCPServer import TCPSocketServer
+
+@pytest.fixture
+def server():
+  server = TCPSocketServer("127.0.0.1", 0, includeCustomHeader=True, allowCompression=True)
+  server.port = server.socket.getsockname()[1]
+  server.start()
+  yield server
+  server.stop()
+
+def connect(server: TCPSocketServer) -> socket.socket:
+  """Connect and wait until the server accepted the connection"""
+  clients = len(server.clients)
+  client = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+  deadline = time.monotonic() + 5
+  while len(server.clients) <= clients and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return client
+
+def read_frame(client: socket.socket) -> bytes:
+  header = client.recv(4, socket.MSG_WAITALL)
+  assert header[:2] == b"\x16\x16"
+  return client.recv(int.from_bytes(header[2:], "big"), socket.MSG_WAITALL)
+
+def test_answer_goes_only_to_the_requesting_client(server):
+  server.add_data_listener(lambda data, client: server.send_to(client, b"answer to " + data), withClient=True)
+  asking = connect(server)
+  other = connect(server)
+
+  asking.sendall(b"query")
+  assert read_frame(asking) == b"answer to query"
+  other.settimeout(0.2)
+  with pytest.raises(socket.timeout):
+    other.recv(1)
+  asking.close()
+  other.close()
+
+def read_compressed_frame(client: socket.socket) -> tuple[int, bytes]:
+  header = client.recv(7, socket.MSG_WAITALL)
+  assert header[:2] == b"\x16\x17"
+  return header[2], client.recv(int.from_bytes(header[3:], "big"), socket.MSG_WAITALL)
+
+def test_greeting_waits_for_compression_negotiation(server):
+  greeting = b"x" * 2000
+  server.add_connection_listener(lambda client, connected: connected and server.send_to(client, greeting))
+  client = connect(server)
+  client.sendall(b'{"compression": ["zlib"]}')
+  assert read_frame(client) == b'{"origin": "proxy", "compression": "zlib"}'
+  codec, payload = read_compressed_frame(client)
+  assert (codec, zlib.decompress(payload)) == (1, greeting)
+  client.close()
+
+def test_greeting_is_sent_after_negotiation_timeout(server):
+  server.negotiationTimeout = 0.1
+  server.add_connection_listener(lambda client, connected: connected and server.send_to(client, b"hello"))
+  received = []
+  server.add_data_listener(received.append)
+  client = connect(server)
+  assert read_frame(client) == b"hello"
+  client.sendall(b'{"infoType": 1}')
+  deadline = time.monotonic() + 5
+  while not received and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert received == [b'{"infoType": 1}']
+  client.close()
+
+def test_oversized_message_is_skipped_for_legacy_clients(server):
+  server.negotiationTimeout = 0
+  legacy = connect(server)
+  compressed = connect(server)
+  compressed.sendall(b'{"compression": ["zlib"]}')
+  read_frame(compressed)
+  deadline = time.monotonic() + 5
+  while not server.client_compression and time.monotonic() < deadline:
+    time.sleep(0.01)
+
+  large = b"y" * 70000
+  server.send_data(large)
+  server.send_data(b"small")
+  assert read_frame(legacy) == b"small"
+  assert zlib.decompress(read_compressed_frame(compressed)[1]) == large
+  assert read_compressed_frame(compressed) == (0, b"small")
+  assert len(server.clients) == 2
+  assert not server.send_to(legacy, large)
+  legacy.close()
+  compressed.close()
+
+def test_relayed_chunks_reach_the_listeners_only_if_forwarding_fails():
+  server = TCPSocketServer("127.0.0.1", 0)
+  server.port = server.socket.getsockname()[1]
+  forwarded = []
+  received = []
+  server.set_fast_forward(lambda view: b"cloud" in bytes(view) and not forwarded.append(bytes(view)), buffer_size=64)
+  server.add_data_listener(received.append)
+  server.start()
+  try:
+    client = connect(server)
+    client.sendall(b"to cloud")
+    deadline = time.monotonic() + 5
+    while not forwarded and time.monotonic() < deadline:
+      time.sleep(0.01)
+    client.sendall(b"no connection")
+    while not received and time.monotonic() < deadline:
+      time.sleep(0.01)
+  finally:
+    server.stop()
+  assert forwarded == [b"to cloud"]
+  assert received == [b"no connection"]
@@ -0,0 +1,37 @@
+from Telemetry import TelemetrySeries, TelemetryStore
+
+def test_series_grows_until_capacity_then_wraps():
+  series = TelemetrySeries("battery", 3)
+  assert len(series.times) == 0
+  for i in range(5):
+    series.append(float(i), i * 10.0)
+  assert len(series.times) == 3
+  assert series.query() == [[2.0, 20.0], [3.0, 30.0], [4.0, 40.0]]
+
+def test_buckets_are_returned_even_for_few_points():
+  series = TelemetrySeries("battery", 100)
+  series.append(0.0, 1.0)
+  series.append(10.0, 3.0)
+  assert series.query(buckets=10) == [[0.0, 1.0, 1.0, 1.0, 1], [9.0, 3.0, 3.0, 3.0, 1]]
+  assert series.query(buckets=1) == [[0.0, 1.0, 3.0, 2.0, 2]]
+
+def test_bools_are_not_recorded(tmp_path):
+  store = TelemetryStore(str(tmp_path / "telemetry.bin"))
+  assert store.record({"charging": True, "battery": 80, "status": {"percent": 5.5, "fan": False}}, 1.0) == 2
+  assert store.metrics() == ["battery", "status.percent"]
+
+def test_invalid_queries_are_answered_with_an_error(tmp_path):
+  store = TelemetryStore(str(tmp_path / "telemetry.bin"))
+  store.record({"battery": 80}, 100.0)
+  for request in (
+    {"metric": "battery", "start": "yesterday"},
+    {"metric": "battery", "start": True},
+    {"metric": "battery", "start": 200, "end": 100},
+    {"metric": "battery", "buckets": 0},
+    {"metric": "battery", "buckets": 2.5},
+    {"metric": ["battery"]},
+  ):
+    assert "error" in store.handle_query(request), request
+  answer = store.handle_query({"metric": "battery", "start": 50, "end": 150, "buckets": 4})
+  assert answer["points"] == [[100.0, 80.0, 80.0, 80.0, 1]]
+  assert store.handle_query({}) == {"metrics": ["battery"]}
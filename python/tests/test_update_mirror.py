@@ -0,0 +1,135 @@
+import functools
+import hashlib
+import http.server
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import HttpHandler
+from HttpFlow import HttpFlow, HttpHeaders, HttpRequest
+from UpdateMirror import FirmwareImage, UpdateMirror
+
+FIRMWARE = bytes(range(256)) * 40
+
+def manifest(url: str, version: str = "1.2.3") -> dict:
+  return {"errorCode": 0, "result": {"hasNew": 1, "version": version, "url": url, "md5": hashlib.md5(FIRMWARE).hexdigest(), "size": len(FIRMWARE)}}
+
+@pytest.mark.parametrize("header, expected", [
+  (None, None),
+  ("bytes=0-99", (0, 99)),
+  ("bytes=10000-", (10000, 10239)),
+  ("bytes=-240", (10000, 10239)),
+  ("bytes=10000-99999", (10000, 10239)),
+  ("bytes=0-9,20-29", None),
+  ("items=0-9", None),
+])
+def test_parse_range(header, expected):
+  assert UpdateMirror.parse_range(header, len(FIRMWARE)) == expected
+
+@pytest.mark.parametrize("header", ["bytes=10240-", "bytes=20-10", "bytes=a-b", "bytes=-0"])
+def test_unsatisfiable_ranges_raise(header):
+  with pytest.raises(ValueError):
+    UpdateMirror.parse_range(header, len(FIRMWARE))
+
+@pytest.fixture
+def mirrored(tmp_path):
+  path = tmp_path / "firmware.bin"
+  path.write_bytes(FIRMWARE)
+  mirror = UpdateMirror(str(tmp_path / "updates"))
+  image = FirmwareImage("http://update.example.com/rom/firmware.bin", "1.2.3", sha256=hashlib.sha256(FIRMWARE).hexdigest(),
+                        size=len(FIRMWARE), path=str(path), verified=True)
+  mirror.images[image.key] = image
+  return SimpleNamespace(update_mirror=mirror, config=SimpleNamespace(cache_static=False)), image
+
+def firmware_request(echo_server, headers: dict) -> HttpFlow:
+  flow = HttpFlow(HttpRequest("GET", "/rom/firmware.bin", HttpHeaders(dict(headers, Host="update.example.com"))))
+  HttpHandler.request(echo_server, flow)
+  return flow
+
+def test_firmware_is_served_with_ranges(mirrored):
+  echo_server, image = mirrored
+  flow = firmware_request(echo_server, {})
+  assert flow.response.status_code == 200
+  assert flow.response.file == (image.path, 0, len(FIRMWARE))
+
+  flow = firmware_request(echo_server, {"Range": "bytes=100-199"})
+  assert flow.response.status_code == 206
+  assert flow.response.headers["Content-Range"] == f"bytes 100-199/{len(FIRMWARE)}"
+  assert flow.response.file == (image.path, 100, 100)
+
+  flow = firmware_request(echo_server, {"Range": "bytes=100-199", "If-Range": '"other"'})
+  assert flow.response.status_code == 200
+
+  flow = firmware_request(echo_server, {"Range": "bytes=99999-"})
+  assert flow.response.status_code == 416
+  assert flow.response.headers["Content-Range"] == f"bytes */{len(FIRMWARE)}"
+
+def test_only_pinned_versions_are_queued(tmp_path):
+  mirror = UpdateMirror(str(tmp_path))
+  images = mirror.record_manifest(manifest("http://update.example.com/rom/firmware.bin"))
+  assert [image.version for image in images] == ["1.2.3"]
+  assert mirror._queue == []
+
+  mirror.configure(["1.2.3"], mirror_all=False)
+  assert mirror._queue == images
+  assert not mirror.approved(images)
+
+def test_unchanged_manifests_are_saved_once_and_pruned(tmp_path):
+  mirror = UpdateMirror(str(tmp_path), max_manifests=2)
+  directory = tmp_path / "manifests"
+  mirror.record_manifest(manifest("http://update.example.com/a.bin"))
+  mirror.record_manifest(manifest("http://update.example.com/a.bin"))
+  assert len(os.listdir(directory)) == 1
+  mirror.record_manifest(manifest("http://update.example.com/b.bin"))
+  mirror.record_manifest(manifest("http://update.example.com/c.bin"))
+  names = sorted(os.listdir(directory))
+  assert len(names) == 2
+  assert all("a.bin" not in (directory / name).read_text() for name in names)
+
+@pytest.fixture
+def update_server(tmp_path):
+  root = tmp_path / "www"
+  (root / "rom").mkdir(parents=True)
+  (root / "rom" / "firmware.bin").write_bytes(FIRMWARE)
+  handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(root))
+  handler.log_message = lambda *args: None
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield f"http://127.0.0.1:{server.server_port}"
+  server.shutdown()
+
+def wait_for(condition) -> bool:
+  deadline = time.monotonic() + 10
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.02)
+  return condition()
+
+def test_pinned_image_is_downloaded_and_verified(tmp_path, update_server):
+  mirror = UpdateMirror(str(tmp_path / "updates"), versions=["1.2.3"])
+  mirror.start()
+  try:
+    images = mirror.record_manifest(manifest(f"{update_server}/rom/firmware.bin"))
+    assert wait_for(lambda: mirror.approved(images))
+  finally:
+    mirror.stop()
+  with open(images[0].path, "rb") as f:
+    assert f.read() == FIRMWARE
+
+def test_unverified_images_are_queued_again_after_restart(tmp_path, update_server):
+  mirror = UpdateMirror(str(tmp_path / "updates"), versions=["1.2.3"])
+  # Recorded, but the proxy stopped before the download finished
+  mirror.record_manifest(manifest(f"{update_server}/rom/firmware.bin"))
+  mirror._save()
+
+  restarted = UpdateMirror(str(tmp_path / "updates"), versions=["1.2.3"])
+  assert len(restarted._queue) == 1
+  restarted.start()
+  try:
+    # The index is saved right after the download was verified
+    assert wait_for(lambda: not UpdateMirror(str(tmp_path / "updates"), versions=["1.2.3"])._queue)
+  finally:
+    restarted.stop()
+  assert restarted.stats()["verified"] == 1
@@ -0,0 +1,148 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import time
+import zlib
+
+import pytest
+
+from WebSocketServer import WebSocketServer
+
+@pytest.fixture
+def server():
+  server = WebSocketServer("127.0.0.1", 0, maxFrameSize=1024, maxMessageSize=4096)
+  server.port = server.socket.getsockname()[1]
+  server.received = []
+  server.add_data_listener(server.received.append)
+  server.start()
+  yield server
+  server.stop()
+
+def frame(opcode: int, payload: bytes, fin: bool = True, compressed: bool = False) -> bytes:
+  """A masked client frame"""
+  first = (0x80 if fin else 0) | (0x40 if compressed else 0) | opcode
+  if len(payload) < 126:
+    header = struct.pack("!BB", first, 0x80 | len(payload))
+  elif len(payload) < 0x10000:
+    header = struct.pack("!BBH", first, 0x80 | 126, len(payload))
+  else:
+    header = struct.pack("!BBQ", first, 0x80 | 127, len(payload))
+  mask = os.urandom(4)
+  return header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+def upgrade(server: WebSocketServer, key: str, extensions: str = None, after: bytes = b"", origin: str = None) -> tuple[socket.socket, bytes]:
+  client = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+  request = f"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+  if extensions:
+    request += f"Sec-WebSocket-Extensions: {extensions}\r\n"
+  if origin:
+    request += f"Origin: {origin}\r\n"
+  client.sendall((request + "\r\n").encode() + after)
+
+  response = b""
+  while b"\r\n\r\n" not in response:
+    response += client.recv(1)
+  return client, response
+
+def handshake(server: WebSocketServer, extensions: str = None, after: bytes = b"", origin: str = None) -> socket.socket:
+  key = base64.b64encode(os.urandom(16)).decode()
+  client, response = upgrade(server, key, extensions, after, origin)
+  accept = base64.b64encode(hashlib.sha1(key.encode() + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest()).decode()
+  assert response.startswith(b"HTTP/1.1 101")
+  assert f"Sec-WebSocket-Accept: {accept}".encode() in response
+  return client
+
+def read_frame(client: socket.socket) -> tuple[int, bytes]:
+  first, second = client.recv(2, socket.MSG_WAITALL)
+  length = second & 0x7F
+  if length == 126:
+    length = struct.unpack("!H", client.recv(2, socket.MSG_WAITALL))[0]
+  elif length == 127:
+    length = struct.unpack("!Q", client.recv(8, socket.MSG_WAITALL))[0]
+  return first & 0x0F, client.recv(length, socket.MSG_WAITALL)
+
+def wait_for(condition) -> None:
+  deadline = time.monotonic() + 5
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+
+def deflate(data: bytes) -> bytes:
+  compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+def test_messages_are_passed_on_and_broadcast(server):
+  client = handshake(server)
+  client.sendall(frame(0x1, b'{"infoType": ', fin=False) + frame(0x0, b'21005}'))
+  wait_for(lambda: server.received)
+  assert server.received == [b'{"infoType": 21005}']
+
+  server.send_data(json.dumps({"origin": "robot"}).encode())
+  assert read_frame(client) == (0x1, b'{"origin": "robot"}')
+  client.sendall(frame(0x9, b"ping"))
+  assert read_frame(client) == (0xA, b"ping")
+  client.close()
+
+def test_frame_sent_with_the_handshake_is_kept(server):
+  client = handshake(server, after=frame(0x1, b'{"infoType": 1}'))
+  wait_for(lambda: server.received)
+  assert server.received == [b'{"infoType": 1}']
+  client.close()
+
+def test_compressed_messages_are_inflated(server):
+  client = handshake(server, "permessage-deflate")
+  client.sendall(frame(0x1, deflate(b'{"infoType": 2}'), compressed=True))
+  wait_for(lambda: server.received)
+  assert server.received == [b'{"infoType": 2}']
+  client.close()
+
+@pytest.mark.parametrize("frames", [
+  [frame(0x1, b"x" * 1025)],
+  [frame(0x1, b"x" * 1024, fin=False)] + [frame(0x0, b"x" * 1024, fin=False)] * 3 + [frame(0x0, b"x")],
+  [frame(0x1, deflate(b" " * 100000), compressed=True)],
+], ids=["frame", "message", "decompressed"])
+def test_oversized_messages_close_with_1009(server, frames):
+  client = handshake(server, "permessage-deflate")
+  client.sendall(b"".join(frames))
+  opcode, payload = read_frame(client)
+  assert opcode == 0x8
+  assert struct.unpack("!H", payload[:2])[0] == 1009
+  # The rest of the oversized message is never read, so the close may come as a reset
+  try:
+    assert client.recv(1) == b""
+  except ConnectionResetError:
+    pass
+  assert server.received == []
+  wait_for(lambda: not server.clients)
+  assert server.clients == []
+
+def test_unmasked_frames_close_with_1002(server):
+  client = handshake(server)
+  client.sendall(struct.pack("!BB", 0x81, 15) + b'{"infoType": 1}')
+  opcode, payload = read_frame(client)
+  assert opcode == 0x8
+  assert struct.unpack("!H", payload[:2])[0] == 1002
+  assert server.received == []
+  client.close()
+
+def test_only_allowed_origins_are_accepted(server):
+  server.set_state_provider(lambda: {"cache": {}})
+  key = base64.b64encode(os.urandom(16)).decode()
+  client, response = upgrade(server, key, origin="https://evil.example")
+  assert response.startswith(b"HTTP/1.1 403")
+  client.close()
+
+  client = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+  client.sendall(b"GET /state HTTP/1.1\r\nHost: localhost\r\nOrigin: https://evil.example\r\n\r\n")
+  assert client.recv(4096).startswith(b"HTTP/1.1 403")
+  client.close()
+  assert server.clients == []
+
+  server.allowedOrigins = ["http://homeassistant.local:8123"]
+  client = handshake(server, origin="http://HomeAssistant.local:8123")
+  client.sendall(frame(0x1, b'{"infoType": 1}'))
+  wait_for(lambda: server.received)
+  assert server.received == [b'{"infoType": 1}']
+  client.close()
@@ -15,6 +15,10 @@ iptables -t mangle -X
 iptables -t raw -X
 iptables -t security -X
 
+# Remove proxy blocklist sets
+ipset destroy cn360-blocklist 2>/dev/null || true
+nft delete table inet cn360 2>/dev/null || true
+
 # Reset default policies to ACCEPT
 iptables -P INPUT ACCEPT
 iptables -P FORWARD ACCEPT
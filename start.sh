@@ -2,7 +2,9 @@
 
 echo "Starting..."
 mkdir -p /root/logs
-PYTHONUNBUFFERED=1 mitmweb \
+export PYTHONUNBUFFERED=1
+# exec, so mitmweb is PID 1 and gets SIGHUP (reload settings) and SIGTERM from docker directly
+exec mitmweb \
      --mode transparent \
      --listen-port 8080 \
      --scripts /root/python/mitm.py \